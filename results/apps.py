@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ResultsConfig(AppConfig):
     name = 'results'
+
+    def ready(self):
+        # record the movies touched by model signals, see changelog.py
+        from . import changelog  # noqa: F401
@@ -0,0 +1,423 @@
+from django.db import connections
+from concurrent.futures import ProcessPoolExecutor
+from .corpus import CHUNK_SIZE, iter_chunks, iter_movies
+from .models import Movies
+from .postings import Segment, SegmentWriter
+from .scoring import TermFrequencies, lexicon, field_postings, term_postings
+import numpy as np
+import bisect
+import django
+import os
+
+
+# Streaming calibration pipeline, memory stays bounded whatever the size of the corpus
+#
+#   movies -> tokens -> per-field TF:  the corpus is read in chunks (corpus.iter_chunks) and every chunk
+#                                      is tokenized into its own TermFrequencies
+#   spilled sorted runs:               the entries of a chunk are sorted by term and movie and spilled to
+#                                      scratch .npy files, then the chunk is dropped
+#   merged postings:                   the runs are merged a batch of terms at a time, every entry of a term
+#                                      is in the same batch, and the weighted postings are appended to the
+#                                      segment (postings.SegmentWriter) along with their DF
+#   field lengths:                     the token count of every field of every movie is spilled with the runs
+#                                      and stored in the segment for BM25F, see scorers.py
+#
+# Parallel calibration spills the runs of shards of movies on a pool of processes, then merges ranges of terms
+# on the pool, every range into its own segment, and concatenates them.
+#
+# Incremental updates re-index the movies touched since the last update into a delta segment,
+# with the DF adjustments of every term their postings were added to or removed from.
+
+SHARDS_PER_WORKER = 4
+# entries read from the runs per merge batch, a window of terms larger than this is merged on its own
+MERGE_BATCH = 1 << 19
+_RUN_ARRAYS = ['terms', 'term_ptr', 'counts', 'movies', 'fields', 'tf', 'length_ids', 'lengths']
+
+
+def _init_worker():
+    """
+    Make sure Django is ready in processes that were spawned rather than forked
+    :return: None
+    """
+    django.setup()
+
+
+def spill_run(term_freq, prefix):
+    """
+    Sort the entries of a TermFrequencies by term then movie and write them to scratch .npy files
+    :param term_freq: TermFrequencies
+    :param prefix: str, path prefix of the run's files
+    :return: str, prefix
+    """
+    terms, position = lexicon(term_freq.vocabulary)
+    movies, fields, term_ids, tf = term_freq.arrays()
+    sorted_terms = position[term_ids]
+    order = np.lexsort((movies, sorted_terms))
+    encoded_terms = [term.encode('utf-8') for term in terms]
+    length_ids, lengths = term_freq.field_lengths()
+    arrays = {
+        'terms': np.frombuffer(b''.join(encoded_terms), dtype=np.uint8),
+        'term_ptr': np.cumsum([0] + [len(term) for term in encoded_terms]),
+        'counts': np.bincount(sorted_terms, minlength=len(terms)),
+        'movies': movies[order],
+        'fields': fields[order],
+        'tf': tf[order],
+        'length_ids': length_ids,
+        'lengths': lengths,
+    }
+    for name in _RUN_ARRAYS:
+        np.save("{}_{}.npy".format(prefix, name), arrays[name])
+    return prefix
+
+
+class Run:
+    """
+    Memory-mapped view of a run written by spill_run, read once from the first term to the last
+    A part of the run, the terms from first up to last, can be read instead, see merge_parallel
+    """
+
+    def __init__(self, prefix, first=None, last=None):
+        """
+        :param prefix: str, path prefix of the run's files
+        :param first: bytes, first term of the part read, None from the first term
+        :param last: bytes, the part read ends before this term, None to the last term
+        """
+        for name in _RUN_ARRAYS:
+            setattr(self, name, np.load("{}_{}.npy".format(prefix, name), mmap_mode='r'))
+        # next term and next entry to be merged, the term the read ends at
+        self.term = 0 if first is None else self._bisect(first)
+        self.entry = int(np.sum(self.counts[:self.term], dtype=np.int64))
+        self.end = len(self.counts) if last is None else self._bisect(last)
+
+    def __len__(self):
+        return self.end
+
+    def term_at(self, i):
+        """
+        :param i: int
+        :return: bytes, the i-th term of the run's lexicon
+        """
+        return self.terms[int(self.term_ptr[i]):int(self.term_ptr[i + 1])].tobytes()
+
+    def _bisect(self, key):
+        """
+        Binary search the run's lexicon
+        :param key: bytes
+        :return: int position of the first term not lower than key
+        """
+        low, high = 0, len(self.counts)
+        while low < high:
+            mid = (low + high) // 2
+            if self.term_at(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def read_terms(self, start, n_terms):
+        """
+        Decode a slice of the run's lexicon
+        :param start: int, first term
+        :param n_terms: int, fewer are read past the end of the run
+        :return: (list of bytes terms, list of int entries per term)
+        """
+        n_terms = max(min(n_terms, self.end - start), 0)
+        ptr = self.term_ptr[start:start + n_terms + 1].tolist()
+        buf = self.terms[ptr[0]:ptr[-1]].tobytes()
+        return [buf[a - ptr[0]:b - ptr[0]] for a, b in zip(ptr, ptr[1:])], self.counts[start:start + n_terms].tolist()
+
+    def take(self, n_terms):
+        """
+        Read the entries of the next terms
+        :param n_terms: int
+        :return: (numpy array of entries per term, numpy arrays of the entries' movies, fields and tf)
+        """
+        counts = np.array(self.counts[self.term:self.term + n_terms])
+        first, last = self.entry, self.entry + int(counts.sum())
+        self.term += n_terms
+        self.entry = last
+        return counts, self.movies[first:last], self.fields[first:last], self.tf[first:last]
+
+
+def spill_runs(process, prefix, queryset=None, chunk_size=CHUNK_SIZE):
+    """
+    Tokenize the corpus chunk by chunk, spilling one sorted run per chunk
+    :param process: search_index.WordProcessor
+    :param prefix: str, path prefix of the runs' files
+    :param queryset: Movies queryset to restrict the corpus, every movie by default
+    :param chunk_size: int, movies per run
+    :return: (list of str run prefixes, int movies read)
+    """
+    runs = []
+    total_movies = 0
+    for i, chunk in enumerate(iter_chunks(chunk_size, queryset)):
+        term_freq = TermFrequencies()
+        for movie in chunk:
+            for alpha, term_list in movie.terms(process).items():
+                term_freq.add(movie.id, int(alpha), term_list)
+        total_movies += len(chunk)
+        if len(term_freq):
+            runs.append(spill_run(term_freq, "{}_{}".format(prefix, i)))
+    return runs, total_movies
+
+
+def shard_ranges(n_shards):
+    """
+    Split the movies in shards of about the same size
+    :param n_shards: int
+    :return: (list of (first movie id, last movie id), int total movies)
+    """
+    ids = np.fromiter(Movies.objects.order_by('id').values_list('id', flat=True).iterator(), dtype=np.int64)
+    return [(int(x[0]), int(x[-1])) for x in np.array_split(ids, n_shards) if len(x)], len(ids)
+
+
+def _spill_shard(process, first, last, prefix):
+    """
+    Spill the runs of the movies with an id in [first, last]
+    :param process: search_index.WordProcessor
+    :param first: int
+    :param last: int
+    :param prefix: str, path prefix of the shard's runs
+    :return: (list of str run prefixes, int movies read)
+    """
+    return spill_runs(process, prefix, Movies.objects.filter(id__gte=first, id__lte=last))
+
+
+def spill_shards(process, shards, prefix, map_fn=map):
+    """
+    Spill the runs of every shard
+    :param process: search_index.WordProcessor
+    :param shards: list of (first movie id, last movie id)
+    :param prefix: str, path prefix of the runs' files
+    :param map_fn: map or Executor.map
+    :return: (list of str run prefixes, int movies read)
+    """
+    results = map_fn(_spill_shard, [process] * len(shards), [x[0] for x in shards], [x[1] for x in shards],
+                     ["{}_{}".format(prefix, i) for i in range(len(shards))])
+    runs = []
+    total_movies = 0
+    for shard_runs, shard_movies in results:
+        runs.extend(shard_runs)
+        total_movies += shard_movies
+    return runs, total_movies
+
+
+def spill_parallel(process, prefix, workers):
+    """
+    Spill the runs with a pool of worker processes
+    :param process: search_index.WordProcessor
+    :param prefix: str, path prefix of the runs' files
+    :param workers: int
+    :return: (list of str run prefixes, int movies read)
+    """
+    shards, _ = shard_ranges(workers * SHARDS_PER_WORKER)
+    # forked workers must open their own database connections
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        return spill_shards(process, shards, prefix, map_fn=pool.map)
+
+
+def _merge_lexicons(runs, step=4096):
+    """
+    Merge the runs' lexicons a window of terms at a time
+    A window ends at the smallest last term read from a run, so every run's copy of its terms is in it
+    :param runs: list of Run
+    :param step: int, terms read from a run at a time
+    :return: generator of (list of bytes terms in lexicon order, list with for every run the positions
+        in terms of the run's next terms, int entries of the window)
+    """
+    pending = [([], []) for _ in runs]
+    read = [run.term for run in runs]
+    while True:
+        for i, run in enumerate(runs):
+            if not pending[i][0] and read[i] < len(run):
+                pending[i] = run.read_terms(read[i], step)
+                read[i] += len(pending[i][0])
+        if not any(terms for terms, _ in pending):
+            return
+        # bytes sort like the segment's lexicon
+        cut = min(terms[-1] for terms, _ in pending if terms)
+        taken, entries = [], 0
+        for i, (terms, counts) in enumerate(pending):
+            k = bisect.bisect_right(terms, cut)
+            taken.append(terms[:k])
+            entries += sum(counts[:k])
+            pending[i] = (terms[k:], counts[k:])
+        window = sorted(set().union(*taken))
+        position = {term: j for j, term in enumerate(window)}
+        yield window, [np.array([position[term] for term in terms], dtype=np.int64) for terms in taken], entries
+
+
+def _merge_batch(runs, terms, sources, alpha, writer):
+    """
+    Weight a batch of terms and append their postings to the segment
+    :param runs: list of Run
+    :param terms: list of bytes, the batch's terms in lexicon order
+    :param sources: list with, for every run, arrays of the positions in terms of the run's next terms
+    :param alpha: numpy array indexed by field
+    :param writer: postings.SegmentWriter
+    :return: None
+    """
+    term_positions, movies, fields, tf = [], [], [], []
+    for run, positions in zip(runs, sources):
+        positions = np.concatenate(positions)
+        if len(positions):
+            counts, run_movies, run_fields, run_tf = run.take(len(positions))
+            term_positions.append(np.repeat(positions, counts))
+            movies.append(run_movies)
+            fields.append(run_fields)
+            tf.append(run_tf)
+    writer.add(*field_postings([term.decode('utf-8') for term in terms], np.concatenate(term_positions),
+                               np.concatenate(movies), np.concatenate(fields), np.concatenate(tf), alpha))
+
+
+def merge_runs(run_prefixes, alpha, writer, batch_size=MERGE_BATCH, first=None, last=None):
+    """
+    K-way merge of the runs, weighting the postings a batch of terms at a time
+    weight(movie, term) = sum over alpha of TF(movie, alpha, term) * alpha
+    weight(movie, field term) = TF(movie, alpha, term)
+    :param run_prefixes: list of str, runs written by spill_run
+    :param alpha: numpy array indexed by field
+    :param writer: postings.SegmentWriter
+    :param batch_size: int, entries read per batch
+    :param first: bytes, only merge the terms from this one, None from the first term
+    :param last: bytes, only merge the terms before this one, None to the last term
+    :return: None
+    """
+    runs = [Run(prefix, first, last) for prefix in run_prefixes]
+    terms, sources, size = [], [[] for _ in runs], 0
+    for window, positions, entries in _merge_lexicons(runs):
+        if terms and size + entries > batch_size:
+            _merge_batch(runs, terms, sources, alpha, writer)
+            terms, sources, size = [], [[] for _ in runs], 0
+        for i, run_positions in enumerate(positions):
+            sources[i].append(run_positions + len(terms))
+        terms.extend(window)
+        size += entries
+    if terms:
+        _merge_batch(runs, terms, sources, alpha, writer)
+
+
+def split_terms(run_prefixes, parts, samples=256):
+    """
+    Cut the merged lexicon of the runs in parts holding about as many entries
+    Every run's lexicon is sampled every few terms, along with the entries of the terms up to the next sample
+    :param run_prefixes: list of str, runs written by spill_run
+    :param parts: int
+    :param samples: int, sampled terms per run
+    :return: list of bytes, sorted terms starting every part but the first, fewer than parts - 1 for small runs
+    """
+    keys, entries = [], []
+    for run in (Run(prefix) for prefix in run_prefixes):
+        if len(run) == 0:
+            continue
+        positions = np.arange(0, len(run), max(len(run) // samples, 1))
+        keys.extend(run.term_at(i) for i in positions.tolist())
+        entries.extend(np.add.reduceat(np.asarray(run.counts, dtype=np.int64), positions).tolist())
+    if not keys:
+        return []
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    cumulative = np.cumsum([entries[i] for i in order])
+    cuts = set()
+    for k in range(1, parts):
+        j = int(np.searchsorted(cumulative, cumulative[-1] * k / parts))
+        if j + 1 < len(order):
+            cuts.add(keys[order[j + 1]])
+    return sorted(cuts)
+
+
+def _merge_part(run_prefixes, alpha, path, first, last):
+    """
+    Merge the terms of the runs from first up to last into a segment of their own
+    :param run_prefixes: list of str, runs written by spill_run
+    :param alpha: numpy array indexed by field
+    :param path: str, path of the part's segment
+    :param first: bytes, None from the first term
+    :param last: bytes, None to the last term
+    :return: str, path
+    """
+    with SegmentWriter(path) as writer:
+        merge_runs(run_prefixes, alpha, writer, first=first, last=last)
+    return path
+
+
+def merge_parallel(run_prefixes, alpha, writer, workers, scratch):
+    """
+    Merge the runs with a pool of worker processes, like merge_runs
+    The merged lexicon is cut in contiguous ranges of terms, every range is read from the runs, weighted and
+    encoded into a segment of its own by a worker. The ranges' segments are then copied into the writer in
+    lexicon order, which only shifts their pointers
+    :param run_prefixes: list of str, runs written by spill_run
+    :param alpha: numpy array indexed by field
+    :param writer: postings.SegmentWriter
+    :param workers: int
+    :param scratch: str, directory of the ranges' segments
+    :return: None
+    """
+    cuts = split_terms(run_prefixes, workers * SHARDS_PER_WORKER)
+    bounds = list(zip([None] + cuts, cuts + [None]))
+    paths = [os.path.join(scratch, "part_{}.sidx".format(i)) for i in range(len(bounds))]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        for path in pool.map(_merge_part, [run_prefixes] * len(bounds), [alpha] * len(bounds), paths,
+                             [first for first, _ in bounds], [last for _, last in bounds]):
+            writer.add_segment(Segment.load(path))
+            os.remove(path)
+
+
+def merge_lengths(run_prefixes, writer):
+    """
+    Append the field lengths of every movie of the runs to the segment, in id order
+    :param run_prefixes: list of str, runs written by spill_run
+    :param writer: postings.SegmentWriter
+    :return: None
+    """
+    runs = [Run(prefix) for prefix in run_prefixes]
+    if not runs:
+        return
+    ids = np.concatenate([run.length_ids for run in runs])
+    order = np.argsort(ids, kind='stable')
+    writer.add_lengths(ids[order], np.concatenate([run.lengths for run in runs])[order])
+
+
+def delta_postings(process, alpha, index, touched):
+    """
+    Re-index the movies touched since the segments were written
+    Deleted movies simply have no postings left, their current postings only lower the DF
+    :param process: search_index.WordProcessor
+    :param alpha: numpy array indexed by field
+    :param index: scoring.IndexView over the current segments
+    :param touched: numpy array of the touched movie ids, sorted
+    :return: (terms, ptr, doc_ids, weights, doc_freq, field_lengths)
+        terms, ptr, doc_ids, weights: like scoring.term_postings
+        doc_freq: the DF adjustment of every term, terms that only lost postings are listed without postings
+        field_lengths: (movie ids, lengths) of the touched movies, see TermFrequencies.field_lengths
+    """
+    term_freq = TermFrequencies()
+    for first in range(0, len(touched), CHUNK_SIZE):
+        queryset = Movies.objects.filter(id__in=touched[first:first + CHUNK_SIZE].tolist())
+        for movie in iter_movies(queryset=queryset):
+            for alpha_key, term_list in movie.terms(process).items():
+                term_freq.add(movie.id, int(alpha_key), term_list)
+    terms, ptr, doc_ids, weights = term_postings(term_freq, alpha)
+
+    # the touched movies' current postings no longer count, postings masked by a newer segment already do not
+    adjustments = dict()
+    # sized for the whole view, the masks of the older segments cover the ids the newer ones added
+    size = max(index.max_doc, int(touched.max(initial=0))) + 1
+    for segment, masked in zip(index.segments, index.masked):
+        movies = np.zeros(size, dtype=bool)
+        movies[touched] = True
+        if masked is not None:
+            movies[:len(masked)] &= ~masked
+        removed = segment.count_postings(movies)
+        for i in np.flatnonzero(removed).tolist():
+            term = segment.term(i).decode('utf-8')
+            adjustments[term] = adjustments.get(term, 0) - int(removed[i])
+    added = dict(zip(terms, np.diff(ptr).tolist()))
+
+    # the delta postings keep their order, the terms that only lost postings are slotted in between
+    delta_terms = sorted(set(added) | set(adjustments), key=lambda x: x.encode('utf-8'))
+    counts = [added.get(term, 0) for term in delta_terms]
+    doc_freq = np.array([count + adjustments.get(term, 0) for term, count in zip(delta_terms, counts)],
+                        dtype=np.int64)
+    return delta_terms, np.cumsum([0] + counts), doc_ids, weights, doc_freq, term_freq.field_lengths()
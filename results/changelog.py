@@ -0,0 +1,81 @@
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+from .models import Movies, MovieGenres, Casts, Crews, Keywords, IndexChangelog
+from contextlib import contextmanager
+import threading
+
+
+# Changelog of the movies touched since the last calibration, read by SearchIndexWrapper.update
+#
+# Edits made through the ORM are recorded by the signal receivers below. Bulk operations
+# (bulk_create, QuerySet.update, raw SQL) send no signals, their callers record the movie ids themselves.
+
+INDEXED_RELATIONS = [MovieGenres, Casts, Crews, Keywords]
+_batch = threading.local()
+
+
+def record_changes(movie_ids):
+    """
+    Add movies to the changelog
+    :param movie_ids: iterable of int
+    :return: None
+    """
+    movie_ids = set(int(x) for x in movie_ids)
+    if not movie_ids:
+        return
+    pending = getattr(_batch, 'movie_ids', None)
+    if pending is not None:
+        pending.update(movie_ids)
+        return
+    IndexChangelog.objects.bulk_create([IndexChangelog(movie_id=x) for x in sorted(movie_ids)], batch_size=500)
+
+
+@contextmanager
+def batched_changes():
+    """
+    Collect the movies recorded inside the block and write them to the changelog once, on exit
+    Nothing is written if the block raises, use it inside the transaction that writes the movies
+    :return: None
+    """
+    if getattr(_batch, 'movie_ids', None) is not None:
+        # already batching
+        yield
+        return
+    _batch.movie_ids = set()
+    try:
+        yield
+    except BaseException:
+        _batch.movie_ids = None
+        raise
+    movie_ids, _batch.movie_ids = _batch.movie_ids, None
+    record_changes(movie_ids)
+
+
+@receiver(post_save, sender=Movies)
+@receiver(post_delete, sender=Movies)
+def _movie_changed(sender, instance, **kwargs):
+    record_changes([instance.id])
+
+
+def _related_changed(sender, instance, **kwargs):
+    # renaming or deleting a genre, cast, crew or keyword changes the terms of every movie it is attached to
+    if instance.pk is not None:
+        record_changes(instance.movies.values_list('id', flat=True))
+
+
+def _relation_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # movie.keywords_set.add(...), the instance is the movie
+        record_changes([instance.pk])
+    elif action == 'pre_clear':
+        record_changes(instance.movies.values_list('id', flat=True))
+    else:
+        record_changes(pk_set)
+
+
+for _model in INDEXED_RELATIONS:
+    post_save.connect(_related_changed, sender=_model)
+    pre_delete.connect(_related_changed, sender=_model)
+    m2m_changed.connect(_relation_changed, sender=_model.movies.through)
@@ -0,0 +1,113 @@
+from .models import Movies, MovieGenres, Casts, Crews, Keywords
+from collections import namedtuple, defaultdict
+
+
+# Bulk loading of the movie corpus for calibration
+#
+# Movies are streamed in chunks ordered by id. For every chunk each m2m relation is read once
+# through its auto-created through table, by movie id range, instead of one query per movie and relation.
+# Sparse chunks, such as the few movies of an incremental update, read their relations by movie id instead.
+
+CHUNK_SIZE = 2000
+
+
+class MovieDocument(namedtuple('MovieDocument', ['id', 'title', 'original_title', 'overview', 'tagline', 'genres',
+                                                 'cast_characters', 'cast_names', 'crew', 'keywords'])):
+    """
+    A movie with every indexed field, as read by iter_chunks
+    """
+
+    def terms(self, process):
+        """
+        Tokenize every indexed field, keyed by the field's alpha
+        :param process: search_index.WordProcessor
+        :return: dict(key=alpha:value=list of str)
+        """
+        return {
+            '0': process.tokenize(self.title),  # Movie.title
+            '1': process.tokenize(self.original_title),  # Movie.original_title
+            '2': process.tokenize(self.overview),  # Movie.overview
+            '3': process.tokenize(self.tagline),  # Movie.tagline
+            '4': self.genres,  # Genre.name
+            '6': process.tokenize_character(self.cast_characters),  # Cast.character
+            '7': self.cast_names,  # Cast.name
+            '8': self.crew,  # Crew.name
+            '9': self.keywords,  # Keyword.name
+        }
+
+
+def _relation(model, fields, ids):
+    """
+    Read an m2m relation for every movie of a chunk
+    :param model: model with a movies ManyToManyField
+    :param fields: list of field names to read from the model
+    :param ids: list of movie ids, sorted
+    :return: dict(key=movie id:value=list of tuples of the fields)
+    """
+    through = model.movies.through
+    related = model._meta.model_name
+    if ids[-1] - ids[0] < 2 * len(ids):
+        rows = through.objects.filter(movies_id__gte=ids[0], movies_id__lte=ids[-1])
+    else:
+        # most of the id range is not in the chunk, a range would read the relations of other movies
+        rows = through.objects.filter(movies_id__in=ids)
+    rows = rows.values_list('movies_id', *["{}__{}".format(related, field) for field in fields])
+    relation = defaultdict(list)
+    for row in rows.iterator():
+        relation[row[0]].append(row[1:])
+    return relation
+
+
+def _documents(chunk):
+    """
+    Attach the m2m relations to a chunk of movies, five queries per chunk
+    :param chunk: list of (id, title, original_title, overview, tagline), ordered by id
+    :return: list of MovieDocument
+    """
+    ids = [row[0] for row in chunk]
+    genres = _relation(MovieGenres, ['name'], ids)
+    casts = _relation(Casts, ['character', 'name'], ids)
+    crews = _relation(Crews, ['name'], ids)
+    keywords = _relation(Keywords, ['name'], ids)
+    documents = []
+    for row in chunk:
+        movie_id = row[0]
+        documents.append(MovieDocument(
+            *row,
+            genres=[x[0] for x in genres.get(movie_id, [])],
+            cast_characters=[x[0] for x in casts.get(movie_id, [])],
+            cast_names=[x[1] for x in casts.get(movie_id, [])],
+            crew=[x[0] for x in crews.get(movie_id, [])],
+            keywords=[x[0] for x in keywords.get(movie_id, [])],
+        ))
+    return documents
+
+
+def iter_chunks(chunk_size=CHUNK_SIZE, queryset=None):
+    """
+    Stream the corpus in chunks of movies, each with its genres, cast, crew and keywords
+    :param chunk_size: int, movies per chunk
+    :param queryset: Movies queryset to restrict the corpus, every movie by default
+    :return: generator of lists of MovieDocument
+    """
+    queryset = Movies.objects.all() if queryset is None else queryset
+    movies = queryset.order_by('id').values_list('id', 'title', 'original_title', 'overview', 'tagline')
+    chunk = []
+    for row in movies.iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield _documents(chunk)
+            chunk = []
+    if chunk:
+        yield _documents(chunk)
+
+
+def iter_movies(chunk_size=CHUNK_SIZE, queryset=None):
+    """
+    Stream the corpus one movie at a time, see iter_chunks
+    :param chunk_size: int, movies per chunk
+    :param queryset: Movies queryset to restrict the corpus, every movie by default
+    :return: generator of MovieDocument
+    """
+    for chunk in iter_chunks(chunk_size, queryset):
+        yield from chunk
@@ -0,0 +1,106 @@
+from django.conf import settings
+from django.db.models.functions import Substr
+from .models import Movies
+import json
+
+
+# Hydration of ranked movie ids into the results a search page shows
+#
+# A result is the movie's id, title and the beginning of its overview, never the whole row.
+# Calibrate and update store the snippet of every movie they index in the segments, see postings.py,
+# so a page of results is read from the memory-mapped index without a query. Movies without a stored
+# snippet, such as segments written with SEARCH_INDEX_SNIPPETS = False, are read from the database
+# with only those columns. Either way the results keep the rank order of the ids.
+
+SNIPPET_LENGTH = 160
+CHUNK_SIZE = 2000
+
+
+def store_snippets():
+    """
+    Whether calibrate and update store the snippets in the segments, settings.SEARCH_INDEX_SNIPPETS if set
+    :return: bool
+    """
+    return getattr(settings, 'SEARCH_INDEX_SNIPPETS', True)
+
+
+def _snippet_rows(queryset):
+    """
+    Only the columns of a result, the overview cut to SNIPPET_LENGTH by the database
+    :param queryset: Movies queryset
+    :return: values queryset of dict(id, title, snippet)
+    """
+    return queryset.annotate(snippet=Substr('overview', 1, SNIPPET_LENGTH)).values('id', 'title', 'snippet')
+
+
+def encode_snippet(row):
+    """
+    :param row: dict(id, title, snippet)
+    :return: bytes
+    """
+    return json.dumps([row['title'], row['snippet']], ensure_ascii=False).encode('utf-8')
+
+
+def write_snippets(writer, queryset=None):
+    """
+    Store the snippets of the movies in a segment, in id order
+    :param writer: postings.SegmentWriter
+    :param queryset: Movies queryset, every movie by default
+    :return: None
+    """
+    if not store_snippets():
+        return
+    queryset = Movies.objects.all() if queryset is None else queryset
+    ids, snippets = [], []
+    for row in _snippet_rows(queryset.order_by('id')).iterator(chunk_size=CHUNK_SIZE):
+        ids.append(row['id'])
+        snippets.append(encode_snippet(row))
+        if len(ids) == CHUNK_SIZE:
+            writer.add_snippets(ids, snippets)
+            ids, snippets = [], []
+    writer.add_snippets(ids, snippets)
+
+
+def _stored(movie_ids, index):
+    """
+    Results of the movies with a snippet stored in the index
+    :param movie_ids: list of int
+    :param index: scoring.IndexView, None for no stored snippets
+    :return: dict(key=movie id:value=dict(id, title, snippet))
+    """
+    results = dict()
+    if index is not None:
+        for movie_id, snippet in index.snippets(movie_ids).items():
+            title, text = json.loads(snippet)
+            results[movie_id] = {'id': movie_id, 'title': title, 'snippet': text}
+    return results
+
+
+def hydrate(movie_ids, index=None):
+    """
+    Results of ranked movies, in rank order, movies that no longer exist are left out
+    :param movie_ids: list of int, ranked
+    :param index: scoring.IndexView to read the stored snippets from, None to read the database
+    :return: list of dict(id, title, snippet)
+    """
+    results = _stored(movie_ids, index)
+    missing = [movie_id for movie_id in movie_ids if movie_id not in results]
+    if missing:
+        for row in _snippet_rows(Movies.objects.filter(id__in=missing)):
+            results[row['id']] = row
+    return [results[movie_id] for movie_id in movie_ids if movie_id in results]
+
+
+async def ahydrate(movie_ids, index=None):
+    """
+    Async version of hydrate, the movies without a stored snippet are read with the async ORM (Django 4.1 or later)
+    :param movie_ids: list of int, ranked
+    :param index: scoring.IndexView to read the stored snippets from, None to read the database
+    :return: list of dict(id, title, snippet)
+    """
+    results = _stored(movie_ids, index)
+    missing = [movie_id for movie_id in movie_ids if movie_id not in results]
+    if missing:
+        async for row in _snippet_rows(Movies.objects.filter(id__in=missing)):
+            results[row['id']] = row
+    return [results[movie_id] for movie_id in movie_ids if movie_id in results]
@@ -0,0 +1,129 @@
+import numpy as np
+import ast
+import json
+import re
+
+
+# Parsing of the stringified list columns of the dataset
+#
+# genres, production_companies, keywords, cast and crew hold python literals, lists of dicts printed
+# with repr. ast.literal_eval runs the full python parser on every row, instead the rows of a chunk are
+# rewritten as a single JSON document and parsed by json.loads:
+#
+#   string literals:            re-quoted with double quotes, escapes JSON does not know go through literal_eval
+#   None, True, False:          outside of the strings, become null, true, false
+#
+# A chunk that is not valid JSON once rewritten falls back to ast.literal_eval row by row.
+# Chunks are independent and are parsed on a pool of processes.
+
+PARSE_CHUNK = 5000
+# a string literal, with its quotes, as printed by repr
+_STRING = re.compile(r"""('[^'\\]*(?:\\.[^'\\]*)*'|"[^"\\]*(?:\\.[^"\\]*)*")""")
+_KEYWORDS = [('None', 'null'), ('True', 'true'), ('False', 'false')]
+
+
+def _json_string(literal):
+    """
+    Re-quote a python string literal as a JSON string
+    :param literal: str, with its quotes
+    :return: str
+    """
+    if '\\' in literal:
+        # \x, \' and friends, rare enough to leave to python
+        return json.dumps(ast.literal_eval(literal))
+    if literal[0] == '"':
+        return literal
+    return '"' + literal[1:-1].replace('"', '\\"') + '"'
+
+
+def _json_strings(literals):
+    """
+    Re-quote python string literals as JSON strings, in bulk when none of them has an escape sequence
+    :param literals: list of str, with their quotes
+    :return: list of str
+    """
+    if not literals:
+        return []
+    joined = "\x00".join(literals)
+    if '\\' in joined or '\x01' in joined:
+        return [_json_string(literal) for literal in literals]
+    # mark the quotes around every literal, a double quoted literal holds no ", a single quoted one no '
+    joined = ("\x00" + joined + "\x00").replace('\x00"', '\x00\x01').replace('"\x00', '\x01\x00')
+    joined = joined.replace('"', '\\"').replace("\x00'", "\x00\x01").replace("'\x00", "\x01\x00")
+    return joined.replace("\x01", '"')[1:-1].split("\x00")
+
+
+def literals_to_json(rows):
+    """
+    Rewrite python literals as a JSON array
+    :param rows: list of str python literals, empty rows are empty lists
+    :return: str, JSON array with one element per row
+    """
+    text = "[" + ",".join(row or "[]" for row in rows) + "]"
+    if '\x00' in text:
+        raise ValueError("NUL in python literal")
+    # odd pieces are the string literals, even pieces the structure around them
+    pieces = _STRING.split(text)
+    structure = "\x00".join(pieces[0::2])
+    if any(keyword in structure for keyword, _ in _KEYWORDS):
+        for keyword, value in _KEYWORDS:
+            structure = structure.replace(keyword, value)
+        pieces[0::2] = structure.split("\x00")
+    pieces[1::2] = _json_strings(pieces[1::2])
+    return "".join(pieces)
+
+
+def parse_literals(rows):
+    """
+    Parse a chunk of python literals
+    :param rows: list of str
+    :return: (list of parsed rows, int rows that went through ast.literal_eval)
+    """
+    try:
+        parsed = json.loads(literals_to_json(rows))
+        if len(parsed) == len(rows):
+            return parsed, 0
+    except ValueError:
+        pass
+    # find the rows that are not valid JSON
+    parsed, fallbacks = [], 0
+    for row in rows:
+        try:
+            parsed.extend(json.loads(literals_to_json([row])))
+        except ValueError:
+            parsed.append(ast.literal_eval(row or "[]"))
+            fallbacks += 1
+    return parsed, fallbacks
+
+
+def parse_chunk(rows, fields):
+    """
+    Parse a chunk of lists of dicts into columns
+    :param rows: list of str python literals
+    :param fields: list of str, keys read from every dict
+    :return: (list of int dicts per row, dict(key=field:value=list of values), int rows that went through
+        ast.literal_eval)
+    """
+    parsed, fallbacks = parse_literals(rows)
+    columns = {field: [item.get(field) for row in parsed for item in row] for field in fields}
+    return [len(row) for row in parsed], columns, fallbacks
+
+
+def parse_column(rows, fields, map_fn=map, chunk_size=PARSE_CHUNK):
+    """
+    Parse a column of lists of dicts a chunk of rows at a time
+    :param rows: list of str python literals
+    :param fields: list of str, keys read from every dict
+    :param map_fn: map or Executor.map
+    :param chunk_size: int, rows per chunk
+    :return: (numpy array of dicts per row, dict(key=field:value=list of values), int rows that went through
+        ast.literal_eval)
+    """
+    chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+    lengths, columns, fallbacks = [], {field: [] for field in fields}, 0
+    for chunk_lengths, chunk_columns, chunk_fallbacks in map_fn(parse_chunk, chunks, [fields] * len(chunks)):
+        lengths.extend(chunk_lengths)
+        for field in fields:
+            columns[field].extend(chunk_columns[field])
+        fallbacks += chunk_fallbacks
+    return np.array(lengths, dtype=np.int64), columns, fallbacks
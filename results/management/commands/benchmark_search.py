@@ -0,0 +1,146 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, AsyncClient
+from django.urls import reverse
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+from urllib.request import urlopen
+from urllib.error import HTTPError
+from results.models import Movies
+import numpy as np
+import asyncio
+import random
+import time
+
+
+class Command(BaseCommand):
+    help = "Load test the sync (index) and async (search) views, reports latency percentiles per concurrency"
+
+    def add_arguments(self, parser):
+        """
+        Add flags to the command
+        :param parser: parser
+        :return: None
+        """
+        parser.add_argument('--requests', type=int, default=200, required=False, help='requests per run')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32], required=False,
+                            help='concurrent requests of every run')
+        parser.add_argument('--queries', type=int, default=50, required=False,
+                            help='distinct queries, words of random movie titles')
+        parser.add_argument('--url', type=str, required=False,
+                            help='base url of a running server (runserver, gunicorn, uvicorn...), '
+                                 'the views are called in process through the test clients otherwise')
+
+    @staticmethod
+    def _queries(n):
+        """
+        Sample queries from the movie titles
+        :param n: int
+        :return: list of str
+        """
+        titles = list(Movies.objects.order_by('?').values_list('title', flat=True)[:n])
+        random.seed(0)
+        return [" ".join(random.sample(title.split(), min(2, len(title.split())))) for title in titles if title.split()]
+
+    @staticmethod
+    def _host():
+        """
+        Host header the test clients send, one of settings.ALLOWED_HOSTS
+        :return: str
+        """
+        hosts = [host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*']
+        return hosts[0] if hosts else 'localhost'
+
+    @staticmethod
+    def _get_url(url):
+        """
+        :param url: str
+        :return: (float seconds, int status)
+        """
+        start_time = time.perf_counter()
+        try:
+            with urlopen(url) as response:
+                response.read()
+                status = response.status
+        except HTTPError as e:
+            status = e.code
+        return time.perf_counter() - start_time, status
+
+    def _run_sync(self, path, queries, concurrency):
+        """
+        Requests on a pool of threads, like the worker threads of a WSGI server
+        :param path: str
+        :param queries: list of str, one request per query
+        :param concurrency: int
+        :return: list of (float seconds, int status)
+        """
+        def get(query):
+            if self.url:
+                return self._get_url("{}{}?{}".format(self.url, path, urlencode({'query': query})))
+            start_time = time.perf_counter()
+            status = Client(headers={'host': self._host()}).get(path, {'query': query}).status_code
+            return time.perf_counter() - start_time, status
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            return list(pool.map(get, queries))
+
+    async def _run_async(self, path, queries, concurrency):
+        """
+        Concurrent requests on the event loop, like an ASGI server
+        :param path: str
+        :param queries: list of str, one request per query
+        :param concurrency: int
+        :return: list of (float seconds, int status)
+        """
+        slots = asyncio.Semaphore(concurrency)
+        client = AsyncClient(headers={'host': self._host()})
+
+        async def get(query):
+            async with slots:
+                start_time = time.perf_counter()
+                status = (await client.get(path, {'query': query})).status_code
+                return time.perf_counter() - start_time, status
+
+        return await asyncio.gather(*[get(query) for query in queries])
+
+    @staticmethod
+    def _report(name, concurrency, timings, elapsed):
+        """
+        Print the latency percentiles of a run
+        :param name: str
+        :param concurrency: int
+        :param timings: list of (float seconds, int status)
+        :param elapsed: float, seconds of the whole run
+        :return: None
+        """
+        latency = np.array([x[0] for x in timings]) * 1000
+        errors = sum(1 for x in timings if x[1] != 200)
+        print("{:<6} {:>11} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>7}".format(
+            name, concurrency, np.percentile(latency, 50), np.percentile(latency, 99), latency.max(),
+            len(timings) / elapsed, errors))
+
+    def handle(self, *args, **options):
+        """
+        Run the same requests against both views at every concurrency
+        :param args: None
+        :param options: requests, concurrency, queries, url
+        :return: None
+        """
+        self.url = options['url'].rstrip('/') if options['url'] else None
+        queries = self._queries(options['queries'])
+        if not queries:
+            raise CommandError("No movie title to sample queries from, load the movies first.")
+        requests = [queries[i % len(queries)] for i in range(options['requests'])]
+        paths = {'sync': reverse('results:index'), 'async': reverse('results:search')}
+
+        print("{}\n\tSearch views ({} requests, {} queries)\n{}".format("#" * 30, len(requests), len(queries), "#" * 30))
+        print("{:<6} {:>11} {:>9} {:>9} {:>9} {:>9} {:>7}".format(
+            "view", "concurrency", "p50 ms", "p99 ms", "max ms", "req/s", "errors"))
+        for concurrency in options['concurrency']:
+            for name in ['sync', 'async']:
+                start_time = time.perf_counter()
+                if name == 'sync' or self.url:
+                    timings = self._run_sync(paths[name], requests, concurrency)
+                else:
+                    timings = asyncio.run(self._run_async(paths[name], requests, concurrency))
+                self._report(name, concurrency, timings, time.perf_counter() - start_time)
@@ -0,0 +1,99 @@
+from django.core.management.base import BaseCommand
+from results.search_index import WordProcessor
+from results.models import Movies
+import time
+
+
+class BaselineWordProcessor:
+    """
+    The list-based tokenizer WordProcessor replaced, kept to compare both on the same overviews
+    Stop words are looked up in a list before the words are lowercased and stripped, so "The" is kept
+    """
+
+    stop_words = ['a', 'able', 'about', 'across', 'after', 'all', 'almost', 'also', 'am', 'among', 'an', 'and',
+                  'any', 'are', 'as', 'at', 'be', 'because', 'been', 'but', 'by', 'can', 'cannot', 'could',
+                  'dear', 'did', 'do', 'does', 'either', 'else', 'ever', 'every', 'for', 'from', 'get', 'got',
+                  'had', 'has', 'have', 'he', 'her', 'hers', 'him', 'his', 'how', 'however', 'i', 'if', 'in',
+                  'into', 'is', 'it', 'its', 'just', 'least', 'let', 'like', 'likely', 'may', 'me', 'might',
+                  'most', 'must', 'my', 'neither', 'no', 'nor', 'not', 'of', 'off', 'often', 'on', 'only',
+                  'or', 'other', 'our', 'own', 'rather', 'said', 'say', 'says', 'she', 'should', 'since', 'so',
+                  'some', 'than', 'that', 'the', 'their', 'them', 'then', 'there', 'these', 'they', 'this',
+                  'tis', 'to', 'too', 'twas', 'us', 'wants', 'was', 'we', 'were', 'what', 'when', 'where',
+                  'which', 'while', 'who', 'whom', 'why', 'will', 'with', 'would', 'yet', 'you', 'your']
+
+    def __init__(self, k):
+        self.k = k  # k is the maximum length for a phrase
+
+    def tokenize(self, text):
+        """
+        :param text: str
+        :return: list of str
+        """
+        k_phrases = []
+        text_remove_stop = ["".join(char for char in word if char.isalnum()).lower()
+                            for word in text.split(" ")
+                            if word not in self.stop_words]
+        for k in range(self.k):
+            index = 0
+            while index + k + 1 <= len(text_remove_stop):
+                k_phrases.append(" ".join(text_remove_stop[index:index + k + 1]))
+                index += 1
+        return k_phrases
+
+
+class Command(BaseCommand):
+    help = "Benchmark WordProcessor.tokenize against the tokenizer it replaced over the Movies overview column"
+
+    def add_arguments(self, parser):
+        """
+        Add flags to the command
+        :param parser: parser
+        :return: None
+        """
+        parser.add_argument('--k', type=int, default=1, required=False, help='maximum phrase length')
+        parser.add_argument('--repeat', type=int, default=3, required=False, help='passes over the overviews')
+
+    @staticmethod
+    def _time(process, overviews, repeat):
+        """
+        :param process: WordProcessor or BaselineWordProcessor
+        :param overviews: list of str
+        :param repeat: int
+        :return: (int tokens, float seconds)
+        """
+        tokens = 0
+        start_time = time.time()
+        for _ in range(repeat):
+            for overview in overviews:
+                tokens += len(process.tokenize(overview))
+        return tokens, time.time() - start_time
+
+    @staticmethod
+    def _mismatches(overviews):
+        """
+        Overviews whose words differ between both tokenizers once the baseline's words are filtered like
+        WordProcessor filters them: stop words whatever their case, and the empty words of repeated spaces
+        :param overviews: list of str
+        :return: list of str
+        """
+        process, baseline = WordProcessor(k=1), BaselineWordProcessor(k=1)
+        return [overview for overview in overviews
+                if process.tokenize(overview) != [word for word in baseline.tokenize(overview)
+                                                  if word and word not in WordProcessor.stop_words]]
+
+    def handle(self, *args, **options):
+        overviews = list(Movies.objects.values_list('overview', flat=True))
+        words = sum(len(overview.split()) for overview in overviews) * options['repeat']
+
+        print("{}\n\tTokenizer\n{}".format("#" * 30, "#" * 30))
+        print("Overviews: {}".format(len(overviews) * options['repeat']))
+        print("Words: {}".format(words))
+        for name, process in [("baseline", BaselineWordProcessor(k=options['k'])),
+                              ("current", WordProcessor(k=options['k']))]:
+            tokens, elapsed = self._time(process, overviews, options['repeat'])
+            print("{:<8} tokens: {} time: {:.3f} s words/s: {:.0f} tokens/s: {:.0f}".format(
+                name, tokens, elapsed, words / elapsed if elapsed else 0, tokens / elapsed if elapsed else 0))
+        mismatches = self._mismatches(overviews)
+        print("Overviews tokenized differently apart from the stop word case: {}".format(len(mismatches)))
+        if mismatches:
+            print("First one: {!r}".format(mismatches[0][:200]))
@@ -1,5 +1,6 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from results.search_index import SearchIndexWrapper
+from results.segments import SegmentManager
 
 
 class Command(BaseCommand):
@@ -12,12 +13,23 @@ class Command(BaseCommand):
         :return: None
         """
         parser.add_argument('--print', action='store_true', required=False, help='Print details')
+        parser.add_argument('--workers', type=int, default=1, required=False,
+                            help='Number of worker processes, shards the calibration across them')
+        parser.add_argument('--incremental', action='store_true', required=False,
+                            help='Only re-index the movies changed since the last calibration, then compact the segments')
 
     def handle(self, *args, **options):
         print_info = True if options.get('print') else False
+        workers = options['workers']
+        if workers < 1:
+            raise CommandError('--workers must be at least 1.')
+        index = SearchIndexWrapper()
         try:
-            index = SearchIndexWrapper()
-            index.calibrate(print_info=print_info)
-
-        except Exception:
-            pass
+            if options.get('incremental'):
+                index.update(print_info=print_info)
+                # keep the number of segments low, see segments.py
+                SegmentManager(index.search_index.id).compact()
+            else:
+                index.calibrate(print_info=print_info, workers=workers)
+        except Exception as e:
+            raise CommandError("Calibration failed: {}".format(e)) from e
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from results.segments import SegmentManager, Compactor
+import time
+
+
+class Command(BaseCommand):
+    help = "Merge the search index segments written by incremental updates"
+
+    def add_arguments(self, parser):
+        """
+        Add flags to the command
+        :param parser: parser
+        :return: None
+        """
+        parser.add_argument('--full', action='store_true', required=False,
+                            help='Merge every segment into a single base segment')
+        parser.add_argument('--interval', type=float, default=None, required=False,
+                            help='Keep compacting in a background thread every INTERVAL seconds')
+        parser.add_argument('--print', action='store_true', required=False, help='Print details')
+
+    def handle(self, *args, **options):
+        manager = SegmentManager()
+        start_time = time.time()
+        segments = len(manager.get_segments())
+        if options.get('interval'):
+            compactor = Compactor(manager, options['interval'])
+            compactor.start()
+            try:
+                while compactor.is_alive():
+                    compactor.join(1)
+            except KeyboardInterrupt:
+                compactor.stop()
+                compactor.join()
+            merges = compactor.merges
+        else:
+            merges = manager.compact(full=options.get('full'))
+
+        if options.get('print'):
+            print("{}\n\tCompaction\n{}".format("#" * 30, "#" * 30))
+            print("Merges: {}".format(merges))
+            print("Segments: {} -> {}".format(segments, len(manager.get_segments())))
+            print("Finished Compaction: {}".format(time.time() - start_time))
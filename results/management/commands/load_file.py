@@ -1,13 +1,22 @@
-from django.core.management.base import BaseCommand
-from results.models import Movies, MovieGenres, ProductionCompanies, Keywords, Casts, Crews
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from results.models import Movies, MovieGenres, ProductionCompanies, Keywords, Casts, Crews, IngestCheckpoint
+from results.changelog import record_changes, batched_changes
+from results.ingest import parse_column
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+import threading
+import csv
+import io
 import time
-import ast
 
 
 class Command(BaseCommand):
     help = "Loads the file into the database."
+    # rows per INSERT, every relation is loaded with a handful of bulk inserts, or a COPY on PostgreSQL
+    batch_size = 5000
 
     _accepted_columns = {
         1: ['id', 'keywords'],
@@ -18,18 +27,91 @@ class Command(BaseCommand):
             'vote_average', 'vote_count'],
     }
 
+    # the movies are loaded first, every relation needs them
+    _movie_columns = ['id', 'original_title', 'overview', 'tagline', 'title']
+    # then the relation families, independent of each other
+    # family: (file option, list of (list column, model, fields of the dicts, the first one is the id))
+    _families = {
+        'genres': ('movies', [('genres', MovieGenres, ['id', 'name'])]),
+        'production_companies': ('movies', [('production_companies', ProductionCompanies, ['id', 'name'])]),
+        'keywords': ('keywords', [('keywords', Keywords, ['id', 'name'])]),
+        'credits': ('credits', [('cast', Casts, ['id', 'character', 'name']),
+                                ('crew', Crews, ['id', 'department', 'job', 'name'])]),
+    }
+
     def _check(self, num, file):
         """
         3 specific Dataset files are required to run this application
+        Only the header is read
         :param num: int representing the unique file
         :param file: the file path passed through the parser's arguments
-        :return: panda dataframe
+        :return: None
+        """
+        columns = pd.read_csv(file, nrows=0).columns
+        if list(columns) != self._accepted_columns[num]:
+            raise CommandError('Could not match file. {}'.format(file.split("\\")[-1]))
+
+    def _read(self, file, columns, chunksize=None):
+        """
+        Read some columns of a file, a chunk of rows at a time
+        Every value is read as a str, missing values are empty strings
+        :param file: the file path passed through the parser's arguments
+        :param columns: list of str, the columns read
+        :param chunksize: int rows per chunk, None reads the whole file at once
+        :return: generator of panda dataframes
         """
-        df = pd.read_csv(file, low_memory=False)
-        if list(df.columns) == self._accepted_columns[num]:
-            return df.replace({np.nan: ""})
+        reader = pd.read_csv(file, usecols=columns, dtype=str, keep_default_na=False, chunksize=chunksize)
+        if chunksize is None:
+            yield reader
         else:
-            raise Exception('Could not match file. {}'.format(file.split("\\")[-1]))
+            with reader:
+                yield from reader
+
+    @staticmethod
+    def _movie_ids(column):
+        """
+        Movie ids of a column, ids that are not numbers are NaN
+        :param column: Series
+        :return: Series of float64
+        """
+        return pd.to_numeric(column, errors='coerce')
+
+    def _insert(self, model, df):
+        """
+        Insert the rows of a dataframe, rows already in the table are kept
+        COPY through a temporary table on PostgreSQL, bulk_create elsewhere
+        :param model: model, the dataframe's columns are the model's field attnames
+        :param df: DataFrame
+        :return: None
+        """
+        if not self.use_copy:
+            model.objects.bulk_create([model(**x) for x in df.to_dict('records')], batch_size=self.batch_size,
+                                      ignore_conflicts=True)
+            return
+        quote = connection.ops.quote_name
+        table = quote(model._meta.db_table)
+        temp = quote(model._meta.db_table + "_copy")
+        columns = ", ".join(quote(model._meta.get_field(x).column) for x in df.columns)
+        # quoted strings, \N for the missing values so NOT NULL columns still refuse them
+        buffer = io.StringIO()
+        df.to_csv(buffer, header=False, index=False, quoting=csv.QUOTE_NONNUMERIC, na_rep='\\N')
+        copy = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N', FORCE_NULL ({}))".format(temp, columns, columns)
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE TEMPORARY TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA".format(
+                temp, columns, table))
+            raw = cursor.cursor
+            buffer.seek(0)
+            if hasattr(raw, 'copy_expert'):
+                # psycopg2
+                raw.copy_expert(copy, buffer)
+            else:
+                # psycopg 3
+                with raw.copy(copy) as stream:
+                    stream.write(buffer.getvalue())
+            # COPY has no ON CONFLICT, same as ignore_conflicts=True
+            cursor.execute("INSERT INTO {} ({}) SELECT {} FROM {} ON CONFLICT DO NOTHING".format(
+                table, columns, columns, temp))
+            cursor.execute("DROP TABLE {}".format(temp))
 
     def _gen_movies(self, df):
         """
@@ -37,63 +119,53 @@ class Command(BaseCommand):
         :param df: df[['id', 'original_title', 'overview', 'tagline', 'title']]
         :return: None
         """
-        bc = list(map(lambda x: Movies(id=x[1][0],
-                                       original_title=x[1][1],
-                                       overview=x[1][2],
-                                       tagline=x[1][3],
-                                       title=x[1][4]), df.iterrows()))
+        df = df.assign(id=self._movie_ids(df['id'])).dropna(subset=['id']).drop_duplicates('id')
+        df = df.astype({'id': np.int64})
+        self._insert(Movies, df)
+        self.movie_ids = np.union1d(self.movie_ids, df['id'].to_numpy())
+        # bulk inserts send no signals, the incremental index update needs to know about these movies
+        record_changes(df['id'].tolist())
+
+    def _explode(self, ids, column, fields):
+        """
+        Parse a column of python literal lists of dicts, one row per (movie, dict)
+        :param ids: Series of movie ids
+        :param column: Series of str
+        :param fields: list of str, keys read from every dict, the first one is the id
+        :return: DataFrame with a movie column and one column per field, rows of unknown movies are dropped
+        """
+        start = time.time()
+        literals = column.tolist()
+        lengths, values, fallbacks = parse_column(literals, fields, map_fn=self.map_fn)
+        stats = self.parse_stats.setdefault(column.name, [0, 0.0, 0])
+        stats[0] += sum(len(x) for x in literals)
+        stats[1] += time.time() - start
+        stats[2] += fallbacks
 
-        Movies.objects.bulk_create(bc, ignore_conflicts=True)
+        rows = pd.DataFrame(values, columns=fields)
+        rows.insert(0, 'movie', np.repeat(self._movie_ids(ids).to_numpy(), lengths))
+        rows = rows[rows['movie'].isin(self.movie_ids)]
+        return rows.astype({'movie': np.int64, fields[0]: np.int64})
 
-    def _gen_movie_m2m(self, df, mobject):
+    def _gen_relation(self, rows, mobject, fields):
         """
-        Bulk create Movie's m2m relationships (MovieGenres, ProoductionCompanies, Keywords)
-        :param df: df[['id', 'name']]
+        Bulk create the entities of a relation and link them to their movies
+        The first occurrence of an entity wins, entities and links already in the database are kept
+        :param rows: DataFrame returned by _explode
         :param mobject: Movie's m2m model
+        :param fields: list of str, the model's fields, the first one is the id
         :return: None
         """
-        # len(df) * 3 = total db queries; has to be a better way
-        for count, item in df.iterrows():
-            m_id, insert = item[0], item[1]
-            pc_list = ast.literal_eval(insert)
-            pc_id_list = [x['id'] for x in pc_list]
-            m_obj = Movies.objects.get(id=int(m_id))
-            bc = list(map(lambda x: mobject(id=x['id'], name=x['name']), pc_list))
-
-            mobject.objects.bulk_create(bc, ignore_conflicts=True)
-            if mobject == MovieGenres:
-                m_obj.moviegenres_set.add(*mobject.objects.filter(id__in=pc_id_list))
-            elif mobject == ProductionCompanies:
-                m_obj.productioncompanies_set.add(*mobject.objects.filter(id__in=pc_id_list))
-            elif mobject == Keywords:
-                m_obj.keywords_set.add(*mobject.objects.filter(id__in=pc_id_list))
-
-    def _gen_credits(self, df):
-        """
-        Bulk create Cast and Crew
-        :param df: df[['id', 'cast', 'crew']]
-        :return: None
-        """
-        for count, item in df.iterrows():
-            raw_cast, raw_crew, m_id = item[0], item[1], item[2]
-
-            cast_list = ast.literal_eval(raw_cast)
-            crew_list = ast.literal_eval(raw_crew)
-            cast_id_list = [x['id'] for x in cast_list]
-            crew_id_list = [x['id'] for x in crew_list]
-
-            m_obj = Movies.objects.get(id=int(m_id))
-
-            cast_obj = list(map(lambda x: Casts(id=x['id'], character=x['character'], name=x['name']),
-                                cast_list))
-            crew_obj = list(map(lambda x: Crews(id=x['id'], department=x['department'], job=x['job'], name=x['name']),
-                                crew_list))
-
-            Casts.objects.bulk_create(cast_obj, ignore_conflicts=True)
-            Crews.objects.bulk_create(crew_obj, ignore_conflicts=True)
-
-            m_obj.casts_set.add(*Casts.objects.filter(id__in=cast_id_list))
-            m_obj.crews_set.add(*Crews.objects.filter(id__in=crew_id_list))
+        entities = rows.drop_duplicates(fields[0])[fields]
+        self._insert(mobject, entities)
+        # insert the links straight into the auto-created through table
+        through = mobject.movies.through
+        m2m = mobject._meta.get_field('movies')
+        links = rows[['movie', fields[0]]].drop_duplicates()
+        self._insert(through, pd.DataFrame({m2m.m2m_reverse_field_name() + '_id': links['movie'].to_numpy(),
+                                            m2m.m2m_field_name() + '_id': links[fields[0]].to_numpy()}))
+        # no m2m_changed signal either
+        record_changes(links['movie'].unique().tolist())
 
     def add_arguments(self, parser):
         """
@@ -105,59 +177,165 @@ class Command(BaseCommand):
         parser.add_argument('--keywords', nargs='?', required=True, help='keywords.csv')
         parser.add_argument('--credits', nargs='?', required=True, help='credits.csv')
         parser.add_argument('--print', required=False, action='store_true', help='print details')
+        parser.add_argument('--workers', type=int, default=1, required=False,
+                            help='number of processes parsing the list columns and of relations loaded at once')
+        parser.add_argument('--chunksize', type=int, default=None, required=False,
+                            help='rows read from the files at a time, keeps memory flat on large files')
+        parser.add_argument('--resume', required=False, action='store_true',
+                            help='skip the chunks loaded by a previous run that failed')
+        parser.add_argument('--no-copy', required=False, action='store_true',
+                            help='insert with bulk_create on PostgreSQL too, instead of COPY')
+
+    def _timed(self, stage, func, *args):
+        """
+        Run one stage on a chunk, adding up the time spent in every stage
+        :param stage: str
+        :param func: callable
+        :return: the result of func
+        """
+        start = time.time()
+        result = func(*args)
+        self.timings[stage] = self.timings.get(stage, 0.0) + time.time() - start
+        return result
+
+    def _checkpoints(self, name, file, chunksize, resume):
+        """
+        Chunks committed by a previous run
+        :param name: str, the checkpoint name
+        :param file: the file path passed through the parser's arguments
+        :param chunksize: int rows per chunk
+        :param resume: boolean, False starts over
+        :return: set of int chunks to skip
+        """
+        checkpoints = IngestCheckpoint.objects.filter(file=name)
+        if not resume:
+            checkpoints.delete()
+            return set()
+        if checkpoints.exclude(path=file, chunksize=chunksize).exists():
+            raise CommandError("{} was loaded from another file or with another --chunksize, "
+                               "load it again without --resume".format(name))
+        return set(checkpoints.values_list('chunk', flat=True))
+
+    def _load(self, name, file, columns, chunksize, done, stages):
+        """
+        Load a file chunk by chunk, every chunk is committed along with its checkpoint
+        :param name: str, the checkpoint name
+        :param file: the file path passed through the parser's arguments
+        :param columns: list of str, the columns read
+        :param chunksize: int rows per chunk, None loads the whole file as a single chunk
+        :param done: set of int chunks committed by a previous run
+        :param stages: list of (function parsing the chunk's dataframe outside of the transaction,
+            function writing what it returned)
+        :return: None
+        """
+        for chunk, df in enumerate(self._read(file, columns, chunksize)):
+            if chunk in done:
+                self.skipped[name] = self.skipped.get(name, 0) + 1
+                continue
+            try:
+                prepared = [self._timed(name, prepare, df) for prepare, _ in stages]
+                # the chunk's rows, changelog and checkpoint are committed together or not at all
+                with self.write_lock, transaction.atomic(), batched_changes():
+                    for (_, write), rows in zip(stages, prepared):
+                        self._timed(name, write, rows)
+                    IngestCheckpoint.objects.create(file=name, path=file, chunksize=chunksize, chunk=chunk)
+            except Exception as e:
+                raise CommandError("Failed to load chunk {} of {}, the chunks before it are loaded, "
+                                   "run again with --resume to continue: {}".format(chunk, name, e)) from e
+
+    def _load_family(self, family, options, done):
+        """
+        Load the relations of a family once the movies are loaded
+        :param family: str, key of _families
+        :param options: the command's options
+        :param done: set of int chunks committed by a previous run
+        :return: None
+        """
+        option, relations = self._families[family]
+        stages = [(lambda df, column=column, fields=fields: self._explode(df['id'], df[column], fields),
+                   lambda rows, mobject=mobject, fields=fields: self._gen_relation(rows, mobject, fields))
+                  for column, mobject, fields in relations]
+        columns = ['id'] + [column for column, _, _ in relations]
+        self._load(family, options[option], columns, options.get('chunksize'), done, stages)
+
+    def _load_family_thread(self, family, options, done):
+        """
+        _load_family on a thread of the pool
+        :return: None
+        """
+        try:
+            self._load_family(family, options, done)
+        finally:
+            # the thread opened its own database connection
+            connection.close()
 
     def handle(self, *args, **options):
         """
         Take files, convert to models. Code is specific to Movie Dataset
+        The movies are loaded first, then the relation families, concurrently with more than 1 worker
         :param options: options['file'] are the csv files to convert to models
         :return: None
         """
+        workers = options.get('workers') or 1
+        chunksize = options.get('chunksize')
+        resume = options.get('resume')
+        print_info = options.get('print')
+        # the list columns are parsed a chunk of rows at a time, on a pool of processes with more than 1 worker
+        pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        if pool is not None:
+            # fork the processes now, before the relation threads are started
+            pool.submit(int).result()
+        self.map_fn = pool.map if pool is not None else map
+        # sqlite has a single writer, chunks are still parsed concurrently but written one at a time
+        self.write_lock = threading.Lock() if connection.vendor == 'sqlite' else nullcontext()
+        self.use_copy = connection.vendor == 'postgresql' and not options.get('no_copy')
+        self.parse_stats = dict()
+        self.timings = dict()
+        self.skipped = dict()
+        start = time.time()
         try:
             # Make sure the files passed are the correct files by matching the column names
-            df_movies = self._check(3, options['movies'])
-            df_keywords = self._check(1, options['keywords'])
-            df_credits = self._check(2, options['credits'])
-            print_info = options.get('print')
-
-            print_info_str = ""
-            # Bulk create Movies
-            print_info_str += "{}\n\tStart Movies\n{}".format("#"*30, "#"*30)
-            start_bc = time.time()
-            self._gen_movies(df_movies[['id', 'original_title', 'overview', 'tagline', 'title']])
-            finish_movies_bc = time.time() - start_bc
-            print_info_str += "Finished Movies: {}".format(finish_movies_bc)
-
-            # Bulk create MovieGenres
-            print_info_str += "{}\n\tStart MovieGenres\n{}".format("#"*30, "#"*30)
-            start_bc = time.time()
-            self._gen_movie_m2m(df_movies[['id', 'genres']], MovieGenres)
-            finish_moviegenres_bc = time.time() - start_bc
-            print_info_str += "Finished MovieGenres: {}".format(finish_moviegenres_bc)
-
-            # Bulk create ProductionCompanies
-            print_info_str += "{}\n\tStart ProdComp\n{}".format("#"*30, "#"*30)
-            start_bc = time.time()
-            self._gen_movie_m2m(df_movies[['id', 'production_companies']], ProductionCompanies)
-            finish_prodcomp_bc = time.time() - start_bc
-            print_info_str += "Finished ProdComp: {}".format(finish_prodcomp_bc)
-
-            # Bulk create Keywords
-            print_info_str += "{}\n\tStart Keywords\n{}".format("#"*30, "#"*30)
-            start_bc = time.time()
-            self._gen_movie_m2m(df_keywords, Keywords)
-            finish_keywords_bc = time.time() - start_bc
-            print_info_str += "Finished Keywords: {}".format(finish_keywords_bc)
-
-            # Bulk create credits
-            print_info_str += "{}\n\tStart Credits\n{}".format("#"*30, "#"*30)
-            start_bc = time.time()
-            self._gen_credits(df_credits)
-            finish_credits_bc = time.time() - start_bc
-            print_info_str += "Finished Credits: {}".format(finish_credits_bc)
-
-            # Print info
-            if print_info:
-                print(print_info_str)
-
-        except Exception as e:
-            pass
+            self._check(3, options['movies'])
+            self._check(1, options['keywords'])
+            self._check(2, options['credits'])
+            done = {name: self._checkpoints(name, options[option], chunksize, resume)
+                    for name, option in [('movies', 'movies')] + [(x, y[0]) for x, y in self._families.items()]}
+            # relations are only linked to movies that exist, loaded before or by this command
+            self.movie_ids = np.fromiter(Movies.objects.values_list('id', flat=True).iterator(), dtype=np.int64)
+
+            # Bulk create Movies, every relation needs them
+            self._load('movies', options['movies'], self._movie_columns, chunksize, done['movies'],
+                       [(lambda df: df[self._movie_columns], self._gen_movies)])
+
+            # Bulk create MovieGenres, ProductionCompanies, Keywords, Casts and Crews
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=min(workers, len(self._families))) as threads:
+                    futures = [threads.submit(self._load_family_thread, family, options, done[family])
+                               for family in self._families]
+                    for future in futures:
+                        future.result()
+            else:
+                for family in self._families:
+                    self._load_family(family, options, done[family])
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        # Print info
+        print_info_str = ""
+        for stage, seconds in self.timings.items():
+            print_info_str += "{}\n\tStart {}\n{}\n".format("#"*30, stage, "#"*30)
+            print_info_str += "Finished {}: {}\n".format(stage, seconds)
+        print_info_str += "Finished load ({} workers, {}): {}\n".format(
+            workers, "COPY" if self.use_copy else "bulk_create", time.time() - start)
+        for name, skipped in self.skipped.items():
+            print_info_str += "Skipped {} chunks of {} loaded by a previous run\n".format(skipped, name)
+
+        # Parse throughput of the list columns
+        print_info_str += "{}\n\tParse ({} workers)\n{}\n".format("#"*30, workers, "#"*30)
+        for column, (size, seconds, fallbacks) in self.parse_stats.items():
+            print_info_str += "{}: {:.1f} MB in {:.2f}s, {:.1f} MB/s, {} rows parsed by literal_eval\n".format(
+                column, size / 1e6, seconds, size / 1e6 / max(seconds, 1e-9), fallbacks)
+
+        if print_info:
+            print(print_info_str)
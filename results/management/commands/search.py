@@ -1,33 +1,92 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from results.search_index import SearchIndexWrapper
-from results.models import Movies
+from results.query_cache import query_cache
+from results.scorers import SCORERS
+from results.scoring import alpha_vector
+import itertools
+import json
 import time
+import sys
 
 
 class Command(BaseCommand):
     help = "Command to start a search of the database using the Search Index"
 
+    def add_arguments(self, parser):
+        """
+        Add flags to the command
+        :param parser: parser
+        :return: None
+        """
+        parser.add_argument('--batch', type=str, required=False,
+                            help='file with one query per line, - for stdin, results are written as JSON lines')
+        parser.add_argument('--output', type=str, required=False, help='JSON lines file, stdout by default')
+        parser.add_argument('--limit', type=int, default=10, required=False,
+                            help='results per query in batch mode, 0 for every result')
+        parser.add_argument('--alpha', type=json.loads, required=False,
+                            help='JSON field weights, e.g. {"0": 0.5, "9": 0.3}, the index\'s weights by default')
+        parser.add_argument('--scorer', type=str, choices=sorted(SCORERS), required=False,
+                            help='ranking function, settings.SEARCH_SCORER by default')
+
+    def _batch(self, search_index, options):
+        """
+        Rank every query of a file with lookup_many, streaming {"query": ..., "results": [...]} lines
+        :param search_index: SearchIndexWrapper
+        :param options: batch, output, limit, alpha, scorer
+        :return: None
+        """
+        start_time = time.time()
+        source = sys.stdin if options['batch'] == '-' else open(options['batch'], encoding='utf-8')
+        output = open(options['output'], 'w', encoding='utf-8') if options['output'] else self.stdout
+        count = 0
+        try:
+            queries = (line.rstrip('\n') for line in source)
+            queries, ranked = itertools.tee(queries)
+            ranked = search_index.lookup_many(ranked, options['limit'] or None, alpha=options['alpha'],
+                                              scorer=options['scorer'])
+            for query, results in zip(queries, ranked):
+                output.write(json.dumps({'query': query, 'results': results}) + "\n")
+                count += 1
+        finally:
+            if source is not sys.stdin:
+                source.close()
+            if options['output']:
+                output.close()
+        self.stderr.write("{} queries: {:.2f} s".format(count, time.time() - start_time))
+
     def handle(self, *args, **options):
         """
         Allow user to type a query and return a ranked result intil --quit is initialted
+        With --batch, rank every query of the file instead
         :param args: None
-        :param options: None
+        :param options: batch, output, limit, alpha, scorer
         :return: None
         """
+        if options['alpha'] is not None:
+            try:
+                alpha_vector(options['alpha'])
+            except ValueError as e:
+                raise CommandError("--alpha: {}".format(e))
         search_index = SearchIndexWrapper()
+        if options['batch']:
+            return self._batch(search_index, options)
         while True:
             print("#" * 30)
             query = input("Query: ")
             start_time = time.time()
 
             if query == "--q":
+                stats = query_cache.stats()
+                print("cache hits: {} misses: {} hit rate: {:.2f}".format(stats['hits'], stats['misses'],
+                                                                         stats['hit_rate']))
+                print("lookup mean: {:.4f} s max: {:.4f} s".format(stats['mean_time'], stats['max_time']))
                 print("ending...")
                 break
             else:
-                movie_id = search_index.lookup(query, limit=5)
-                print(movie_id)
-                for movie in Movies.objects.filter(id__in=movie_id):
-                    print(movie.title)
+                results = search_index.search(query, limit=5, alpha=options['alpha'], scorer=options['scorer'])
+                print([movie['id'] for movie in results])
+                for movie in results:
+                    print(movie['title'])
                 print("results: {:.2f} s".format(time.time()-start_time))
                 print("#" * 30)
 
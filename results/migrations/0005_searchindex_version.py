@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('results', '0004_auto_20200920_2037'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchindex',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
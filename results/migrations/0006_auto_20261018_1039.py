@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('results', '0005_searchindex_version'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='searchindex',
+            name='doc_freq',
+        ),
+        migrations.RemoveField(
+            model_name='searchindex',
+            name='term_freq',
+        ),
+        migrations.RemoveField(
+            model_name='searchindex',
+            name='tfidf',
+        ),
+        migrations.AddField(
+            model_name='searchindex',
+            name='segment',
+            field=models.CharField(default='', max_length=200),
+        ),
+    ]
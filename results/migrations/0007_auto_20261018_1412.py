@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('results', '0006_auto_20261018_1039'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexChangelog',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('movie_id', models.IntegerField()),
+            ],
+            options={
+                'db_table': 'searchindex_changelog',
+            },
+        ),
+        migrations.AddField(
+            model_name='searchindex',
+            name='delta_segment',
+            field=models.CharField(default='', max_length=200),
+        ),
+    ]
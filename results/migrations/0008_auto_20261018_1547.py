@@ -0,0 +1,41 @@
+from django.db import migrations, models
+import json
+
+
+def segments_forward(apps, schema_editor):
+    SearchIndex = apps.get_model('results', 'SearchIndex')
+    for s_index in SearchIndex.objects.all():
+        s_index.segments = json.dumps([x for x in [s_index.segment, s_index.delta_segment] if x])
+        s_index.save(update_fields=['segments'])
+
+
+def segments_backward(apps, schema_editor):
+    SearchIndex = apps.get_model('results', 'SearchIndex')
+    for s_index in SearchIndex.objects.all():
+        segments = json.loads(s_index.segments)
+        s_index.segment = segments[0] if segments else ""
+        s_index.save(update_fields=['segment'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('results', '0007_auto_20261018_1412'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchindex',
+            name='segments',
+            field=models.TextField(default='[]'),
+        ),
+        migrations.RunPython(segments_forward, segments_backward),
+        migrations.RemoveField(
+            model_name='searchindex',
+            name='delta_segment',
+        ),
+        migrations.RemoveField(
+            model_name='searchindex',
+            name='segment',
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('results', '0008_auto_20261018_1547'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestCheckpoint',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('file', models.CharField(max_length=20)),
+                ('path', models.CharField(max_length=500)),
+                ('chunksize', models.IntegerField(null=True)),
+                ('chunk', models.IntegerField()),
+            ],
+            options={
+                'db_table': 'searchindex_ingest',
+            },
+        ),
+    ]
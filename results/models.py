@@ -1,5 +1,8 @@
 from django.db import models
+from .postings import index_dir
+from .scoring import alpha_vector
 import json
+import os
 
 
 # Models Based on a movie dataset
@@ -8,47 +11,84 @@ import json
 
 class SearchIndex(models.Model):
     id = models.AutoField(primary_key=True)
-    term_freq = models.TextField(default="{}")
-    doc_freq = models.TextField(default="{}")
-    tfidf = models.TextField(default="{}")
+    segments = models.TextField(default="[]")
     alpha = models.TextField(default="{}")
+    version = models.IntegerField(default=0)
 
     class Meta:
         db_table = "searchindex"
 
-    def get_term_freq(self):
-        return json.loads(self.term_freq)
-
-    def get_doc_freq(self):
-        return json.loads(self.doc_freq)
-
-    def get_tfidf(self):
-        return json.loads(self.tfidf)
-
     def get_alpha(self):
         return json.loads(self.alpha)
 
-    def set_term_freq(self, term_freq):
-        self.term_freq = term_freq
-        self.save()
+    def get_segments(self):
+        """
+        Segment files of the index, oldest first, the first one is the base calibration
+        :return: list of str
+        """
+        return json.loads(self.segments)
 
-    def set_doc_freq(self, doc_freq):
-        self.doc_freq = doc_freq
-        self.save()
+    def get_segment_paths(self):
+        return [os.path.join(index_dir(), segment) for segment in self.get_segments()]
 
-    def set_tfidf(self, tfidf):
-        self.tfidf = tfidf
-        self.save()
+    def get_segment_path(self):
+        segments = self.get_segments()
+        return os.path.join(index_dir(), segments[0] if segments else "")
+
+    def set_segments(self, segments):
+        self.segments = json.dumps(segments)
+        self.save(update_fields=['segments'])
 
     def set_alpha(self, alpha):
+        """
+        Change the field weights, lookups apply them at query time without recalibrating
+        :param alpha: str (json decodable)
+        :return: None
+        """
+        # raises ValueError before every lookup would
+        alpha_vector(json.loads(alpha))
         self.alpha = alpha
-        self.save()
+        self.save(update_fields=['alpha'])
+        # every process reloads its index with the new weights and stops reading the cached results
+        self.bump_version()
+
+    def bump_version(self):
+        """
+        Stamp a new calibration so every process reloads its cached index
+        :return: None
+        """
+        SearchIndex.objects.filter(id=self.id).update(version=models.F('version') + 1)
+        self.refresh_from_db(fields=['version'])
 
     def is_calibrated(self):
-        check1 = self.get_term_freq()
-        check2 = self.get_doc_freq()
-        check3 = self.get_tfidf()
-        return all([len(check1) > 0, len(check2) > 0, len(check3) > 0])
+        paths = self.get_segment_paths()
+        return len(paths) > 0 and all(os.path.exists(path) for path in paths)
+
+
+class IndexChangelog(models.Model):
+    """
+    Movies touched since the last calibration, read by the incremental index update
+    One row per change, a movie can be listed more than once
+    """
+    id = models.AutoField(primary_key=True)
+    movie_id = models.IntegerField()
+
+    class Meta:
+        db_table = "searchindex_changelog"
+
+
+class IngestCheckpoint(models.Model):
+    """
+    Chunks of the dataset files committed by load_file, skipped by load_file --resume
+    """
+    id = models.AutoField(primary_key=True)
+    file = models.CharField(max_length=20)
+    path = models.CharField(max_length=500)
+    chunksize = models.IntegerField(null=True)
+    chunk = models.IntegerField()
+
+    class Meta:
+        db_table = "searchindex_ingest"
 
 
 class Movies(models.Model):
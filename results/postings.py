@@ -0,0 +1,765 @@
+from django.conf import settings
+import numpy as np
+import struct
+import shutil
+import mmap
+import os
+
+
+# Binary posting list format for the tf-idf index
+# Scores are stored without the idf, which is applied at query time from the document frequencies,
+# so a delta segment can adjust the document frequencies of the base segment, see scoring.IndexView
+#
+#   header:   magic, format version, number of sections
+#   sections: table of (name, numpy dtype, byte offset, byte length), then the raw arrays
+#
+#   terms     uint8    every term utf-8 encoded, sorted, joined by b'\0'
+#   term_ptr  uint64   byte offset of each term inside terms (n_terms + 1)
+#   id_ptr    uint64   byte offset of each term's posting list inside doc_ids (n_terms + 1)
+#   score_ptr uint64   position of each term's first score inside scores (n_terms + 1)
+#   max_score float32  highest score in each term's posting list, the term's upper bound
+#   doc_ids   uint8    movie ids, sorted per term, delta + varint encoded in blocks of BLOCK_SIZE postings,
+#                      the first id of every block is stored as is so blocks decode independently
+#   scores    float32  sum over fields of tf * alpha of each posting, same order as doc_ids, the tf of the
+#                      field for the postings of a field term
+#   skip_ptr  uint64   position of each term's first block inside skip_ids / skip_offset (n_terms + 1)
+#   skip_ids  int64    last movie id of every block
+#   skip_offset uint64 byte offset of every block inside doc_ids
+#   doc_freq  int64    document frequency of each term, an adjustment of the base segment's in a delta segment
+#   n_docs    int64    total movies in the index when the segment was written
+#   masked_ids int64   sorted movies whose postings in the base segment are replaced by the delta segment's
+#   snippet_ids int64  sorted movies with a stored result snippet, see hydration.py, segments written
+#                      without snippets leave the three snippet sections empty
+#   snippet_ptr uint64 byte offset of each movie's snippet inside snippets (n_snippets + 1)
+#   snippets  uint8    JSON encoded snippets, utf-8
+#   length_ids int64   sorted movies with stored field lengths
+#   field_lengths uint32 token count of every field of those movies, a row of N fields per movie, segments
+#                      written before the field lengths have neither section
+#   alpha     float64  field weights the terms' postings were summed with, NaN if merged from segments summed
+#                      with different weights, empty in segments written without field terms
+#
+# Every term is followed in the lexicon by its field terms, term + '\x01' + field (see scoring.field_term),
+# whose postings hold the unweighted tf of the term in that field, so other field weights can be applied
+# at query time without recalibrating.
+
+
+MAGIC = b'SIDX'
+FORMAT_VERSION = 3
+BLOCK_SIZE = 128
+_HEADER = struct.Struct('<4sHI')
+_SECTION = struct.Struct('<16s8sQQ')
+# joins a term and the field of its field terms
+FIELD_SEPARATOR = b'\x01'
+
+
+def index_dir():
+    """
+    Directory holding the calibrated index files, settings.SEARCH_INDEX_DIR if set
+    :return: str
+    """
+    default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index')
+    return getattr(settings, 'SEARCH_INDEX_DIR', default)
+
+
+def _varint_sizes(values):
+    """
+    Number of bytes each value takes once varint encoded
+    :param values: numpy array of uint64
+    :return: numpy array of int64
+    """
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        n_bytes += values >= (np.uint64(1) << np.uint64(shift))
+    return n_bytes
+
+
+def encode_varint(values):
+    """
+    Encode unsigned ints 7 bits per byte, high bit set on every byte but the last
+    :param values: numpy array of ints >= 0
+    :return: numpy array of uint8
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    n_bytes = _varint_sizes(values)
+    position = np.arange(int(n_bytes.max()))
+    chunks = (values[:, None] >> (np.uint64(7) * position.astype(np.uint64))) & np.uint64(0x7f)
+    chunks |= np.where(position < (n_bytes[:, None] - 1), np.uint64(0x80), np.uint64(0))
+    return chunks[position < n_bytes[:, None]].astype(np.uint8)
+
+
+def decode_varint(buf):
+    """
+    Decode a buffer written by encode_varint
+    :param buf: numpy array of uint8
+    :return: numpy array of uint64
+    """
+    buf = np.asarray(buf, dtype=np.uint8)
+    if len(buf) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(buf < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    # position of every byte inside its own varint
+    position = np.arange(len(buf)) - np.repeat(starts, ends - starts + 1)
+    chunks = (buf & 0x7f).astype(np.uint64) << (np.uint64(7) * position.astype(np.uint64))
+    return np.add.reduceat(chunks, starts)
+
+
+def write_segment(path, postings):
+    """
+    Write the tf-idf postings to path, replacing the file atomically
+    :param path: str
+    :param postings: dict(key=term:value=dict(key=movie id:value=score))
+    :return: int, bytes written
+    """
+    terms = sorted(postings, key=lambda x: x.encode('utf-8'))
+    ptr = np.cumsum([0] + [len(postings[term]) for term in terms])
+    movies = [sorted((int(movie), float(score)) for movie, score in postings[term].items()) for term in terms]
+    doc_ids = np.array([movie for term in movies for movie, _ in term], dtype=np.int64)
+    scores = np.array([score for term in movies for _, score in term], dtype=np.float32)
+    return write_postings(path, terms, ptr, doc_ids, scores)
+
+
+def write_postings(path, terms, ptr, doc_ids, scores, total_movies=0):
+    """
+    Write postings held in compressed sparse rows by term, replacing the file atomically
+    :param path: str
+    :param terms: list of str sorted by their utf-8 encoding
+    :param ptr: numpy array, postings of terms[i] are doc_ids[ptr[i]:ptr[i + 1]]
+    :param doc_ids: numpy array of movie ids, sorted within each term
+    :param scores: numpy array of scores
+    :param total_movies: int
+    :return: int, bytes written
+    """
+    with SegmentWriter(path, total_movies) as writer:
+        writer.add(terms, ptr, doc_ids, scores)
+    return writer.size
+
+
+class SegmentWriter:
+    """
+    Write a segment one batch of terms at a time, batches must follow each other in lexicon order
+    Every section is appended to its own scratch file and the segment is assembled on close,
+    so memory is bounded by the largest batch rather than by the whole index
+    Used as a context manager, the segment is written on exit and the scratch files dropped on error
+    """
+
+    sections = [('terms', np.uint8), ('term_ptr', np.uint64), ('id_ptr', np.uint64), ('score_ptr', np.uint64),
+                ('max_score', np.float32), ('doc_ids', np.uint8), ('scores', np.float32),
+                ('skip_ptr', np.uint64), ('skip_ids', np.int64), ('skip_offset', np.uint64),
+                ('doc_freq', np.int64), ('n_docs', np.int64), ('masked_ids', np.int64),
+                ('snippet_ids', np.int64), ('snippet_ptr', np.uint64), ('snippets', np.uint8),
+                ('length_ids', np.int64), ('field_lengths', np.uint32), ('alpha', np.float64)]
+
+    def __init__(self, path, total_movies=0, masked_ids=(), alpha=None):
+        """
+        :param path: str
+        :param total_movies: int, movies in the index
+        :param masked_ids: movie ids whose base segment postings this delta segment replaces
+        :param alpha: numpy array indexed by field, the weights the terms' postings are summed with,
+            None if the segment has no field terms
+        """
+        self.path = path
+        self.size = None
+        self.total_movies = total_movies
+        self.masked_ids = np.unique(np.asarray(masked_ids, dtype=np.int64))
+        self.alpha = alpha
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._files = {name: open(self._scratch(name), 'wb') for name, _ in self.sections}
+        # totals of the batches written so far, the offsets of the next batch
+        self.n_term_bytes = 0
+        self.n_id_bytes = 0
+        self.n_postings = 0
+        self.n_blocks = 0
+        self.n_snippet_bytes = 0
+        self.last_snippet = None
+        self.last_length = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _scratch(self, name):
+        """
+        Scratch file of a section
+        :param name: str
+        :return: str
+        """
+        return "{}.{}.tmp".format(self.path, name)
+
+    def _append(self, name, array):
+        """
+        Append values to a section
+        :param name: str
+        :param array: numpy array
+        :return: None
+        """
+        self._files[name].write(np.ascontiguousarray(array, dtype=dict(self.sections)[name]).tobytes())
+
+    def add(self, terms, ptr, doc_ids, scores, doc_freq=None):
+        """
+        Append a batch of terms with their postings, every term sorts after the terms already added
+        :param terms: list of str sorted by their utf-8 encoding
+        :param ptr: numpy array, postings of terms[i] are doc_ids[ptr[i] - ptr[0]:ptr[i + 1] - ptr[0]]
+        :param doc_ids: numpy array of movie ids, sorted within each term
+        :param scores: numpy array of scores
+        :param doc_freq: numpy array of the terms' document frequencies, their number of postings by default
+        :return: None
+        """
+        encoded_terms = [term.encode('utf-8') for term in terms]
+        ptr = np.asarray(ptr, dtype=np.int64)
+        ptr = ptr - ptr[0]
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        scores = np.asarray(scores, dtype=np.float32)
+        counts = np.diff(ptr)
+
+        # split every posting list in blocks, the first id of a block is stored as is, the others as deltas
+        term_blocks = -(-counts // BLOCK_SIZE)
+        skip_ptr = np.concatenate(([0], np.cumsum(term_blocks)))
+        block_start = np.repeat(ptr[:-1], term_blocks) + BLOCK_SIZE * (
+            np.arange(skip_ptr[-1]) - np.repeat(skip_ptr[:-1], term_blocks))
+        block_end = np.minimum(block_start + BLOCK_SIZE, np.repeat(ptr[1:], term_blocks))
+        deltas = np.diff(doc_ids, prepend=0)
+        deltas[block_start] = doc_ids[block_start]
+        deltas = deltas.astype(np.uint64)
+        byte_ptr = np.concatenate(([0], np.cumsum(_varint_sizes(deltas))))
+
+        max_score = np.zeros(len(terms), dtype=np.float32)
+        if len(scores):
+            non_empty = counts > 0
+            max_score[non_empty] = np.maximum.reduceat(scores, ptr[:-1][non_empty])
+
+        # pointers are shifted by what the previous batches wrote, the closing pointers are added on close
+        self._append('terms', np.frombuffer(b''.join(term + b'\0' for term in encoded_terms), dtype=np.uint8))
+        self._append('term_ptr', self.n_term_bytes + np.cumsum([0] + [len(term) + 1 for term in encoded_terms])[:-1])
+        self._append('id_ptr', self.n_id_bytes + byte_ptr[ptr[:-1]])
+        self._append('score_ptr', self.n_postings + ptr[:-1])
+        self._append('max_score', max_score)
+        self._append('doc_ids', encode_varint(deltas))
+        self._append('scores', scores)
+        self._append('skip_ptr', self.n_blocks + skip_ptr[:-1])
+        self._append('skip_ids', doc_ids[block_end - 1])
+        self._append('skip_offset', self.n_id_bytes + byte_ptr[block_start])
+        self._append('doc_freq', counts if doc_freq is None else doc_freq)
+
+        self.n_term_bytes += sum(len(term) + 1 for term in encoded_terms)
+        self.n_id_bytes += int(byte_ptr[-1])
+        self.n_postings += int(ptr[-1])
+        self.n_blocks += int(skip_ptr[-1])
+
+    def add_segment(self, segment):
+        """
+        Append the terms of a segment, every term sorts after the terms already added
+        The sections are copied as they are, only the pointers are shifted, see calibration.merge_parallel
+        :param segment: Segment
+        :return: None
+        """
+        self._append('terms', segment.terms)
+        self._append('term_ptr', segment.term_ptr[:-1] + np.uint64(self.n_term_bytes))
+        self._append('id_ptr', segment.id_ptr[:-1] + np.uint64(self.n_id_bytes))
+        self._append('score_ptr', segment.score_ptr[:-1] + np.uint64(self.n_postings))
+        self._append('max_score', segment.max_scores)
+        self._append('doc_ids', segment.sections['doc_ids'])
+        self._append('scores', segment.sections['scores'])
+        self._append('skip_ptr', segment.skip_ptr[:-1] + np.uint64(self.n_blocks))
+        self._append('skip_ids', segment.skip_ids)
+        self._append('skip_offset', segment.skip_offset + np.uint64(self.n_id_bytes))
+        self._append('doc_freq', segment.doc_freqs)
+
+        self.n_term_bytes += int(segment.term_ptr[-1])
+        self.n_id_bytes += int(segment.id_ptr[-1])
+        self.n_postings += int(segment.score_ptr[-1])
+        self.n_blocks += int(segment.skip_ptr[-1])
+
+    def add_snippets(self, movie_ids, snippets):
+        """
+        Append a batch of result snippets, every movie id is higher than the ids already added
+        :param movie_ids: list of int, sorted
+        :param snippets: list of bytes, the encoded snippet of each movie
+        :return: None
+        """
+        if not len(movie_ids):
+            return
+        if self.last_snippet is not None and movie_ids[0] <= self.last_snippet:
+            raise ValueError("Snippets must be added in increasing movie id order.")
+        self.last_snippet = int(movie_ids[-1])
+        self._append('snippet_ids', movie_ids)
+        self._append('snippet_ptr', self.n_snippet_bytes + np.cumsum([0] + [len(x) for x in snippets])[:-1])
+        self._append('snippets', np.frombuffer(b''.join(snippets), dtype=np.uint8))
+        self.n_snippet_bytes += sum(len(x) for x in snippets)
+
+    def add_lengths(self, movie_ids, lengths):
+        """
+        Append a batch of field lengths, every movie id is higher than the ids already added
+        :param movie_ids: numpy array of movie ids, sorted
+        :param lengths: numpy array of token counts, a row per movie and a column per field
+        :return: None
+        """
+        if not len(movie_ids):
+            return
+        if self.last_length is not None and movie_ids[0] <= self.last_length:
+            raise ValueError("Field lengths must be added in increasing movie id order.")
+        self.last_length = int(movie_ids[-1])
+        self._append('length_ids', movie_ids)
+        self._append('field_lengths', np.ravel(lengths))
+
+    def close(self):
+        """
+        Assemble the segment from the scratch files, replacing the file atomically
+        :return: int, bytes written
+        """
+        self._append('term_ptr', [self.n_term_bytes])
+        self._append('id_ptr', [self.n_id_bytes])
+        self._append('score_ptr', [self.n_postings])
+        self._append('skip_ptr', [self.n_blocks])
+        self._append('snippet_ptr', [self.n_snippet_bytes])
+        self._append('n_docs', [self.total_movies])
+        self._append('masked_ids', self.masked_ids)
+        if self.alpha is not None:
+            self._append('alpha', self.alpha)
+        for f in self._files.values():
+            f.close()
+        try:
+            self.size = _write_sections(self.path, [(name, (dtype, self._scratch(name)))
+                                                    for name, dtype in self.sections])
+        finally:
+            self._remove_scratch()
+        return self.size
+
+    def abort(self):
+        """
+        Drop the scratch files without writing the segment
+        :return: None
+        """
+        for f in self._files.values():
+            f.close()
+        self._remove_scratch()
+
+    def _remove_scratch(self):
+        """
+        Remove the scratch files
+        :return: None
+        """
+        for name, _ in self.sections:
+            if os.path.isfile(self._scratch(name)):
+                os.remove(self._scratch(name))
+
+
+def _ranges(starts, ends):
+    """
+    Concatenated positions of several [start, end) ranges
+    :param starts: numpy array of int64
+    :param ends: numpy array of int64
+    :return: numpy array of int64
+    """
+    lengths = ends - starts
+    offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+    return offsets + np.arange(int(lengths.sum()))
+
+
+def _decode_blocks(buf, lengths):
+    """
+    Decode consecutive blocks of delta + varint encoded ids
+    :param buf: numpy array of uint8
+    :param lengths: numpy array, number of ids in each block
+    :return: numpy array of int64
+    """
+    deltas = decode_varint(buf).astype(np.int64)
+    if len(deltas) == 0:
+        return deltas
+    values = np.cumsum(deltas)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    # the first id of each block is absolute, remove what the previous blocks added up to
+    return values - np.repeat(values[starts] - deltas[starts], lengths)
+
+
+def _write_sections(path, sections):
+    """
+    Lay out the header, the section table and the 8 byte aligned arrays
+    :param path: str
+    :param sections: list of (name, numpy array) or (name, (numpy dtype, path of a file holding the raw array))
+    :return: int, bytes written
+    """
+    offset = _HEADER.size + _SECTION.size * len(sections)
+    table, body = [], []
+    for name, data in sections:
+        if isinstance(data, np.ndarray):
+            dtype, size = data.dtype, data.nbytes
+        else:
+            dtype, size = np.dtype(data[0]), os.path.getsize(data[1])
+        padding = -offset % 8
+        offset += padding
+        table.append(_SECTION.pack(name.encode('ascii'), dtype.str.encode('ascii'), offset, size))
+        body.append((padding, data))
+        offset += size
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(sections)))
+        f.writelines(table)
+        for padding, data in body:
+            f.write(b'\0' * padding)
+            if isinstance(data, np.ndarray):
+                f.write(np.ascontiguousarray(data).tobytes())
+            else:
+                with open(data[1], 'rb') as src:
+                    shutil.copyfileobj(src, f, 1 << 20)
+    os.replace(tmp_path, path)
+    return offset
+
+
+class Segment:
+    """
+    Read only view of a file written by write_segment
+    Terms are found by binary search over the sorted lexicon and posting lists are decoded
+    on demand, so opening a memory-mapped segment only reads the header and the section table
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+        magic, version, count = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise Exception('Not a search index segment (format {}).'.format(version))
+        self.sections = dict()
+        for i in range(count):
+            name, dtype, offset, nbytes = _SECTION.unpack_from(buf, _HEADER.size + _SECTION.size * i)
+            dtype = np.dtype(dtype.rstrip(b'\0').decode('ascii'))
+            self.sections[name.rstrip(b'\0').decode('ascii')] = np.frombuffer(
+                buf, dtype=dtype, count=nbytes // dtype.itemsize, offset=offset)
+        self.terms = self.sections['terms']
+        self.term_ptr = self.sections['term_ptr']
+        self.id_ptr = self.sections['id_ptr']
+        self.score_ptr = self.sections['score_ptr']
+        self.max_scores = self.sections['max_score']
+        self.skip_ptr = self.sections['skip_ptr']
+        self.skip_ids = self.sections['skip_ids']
+        self.skip_offset = self.sections['skip_offset']
+        self.doc_freqs = self.sections['doc_freq']
+        self.total_movies = int(self.sections['n_docs'][0])
+        self.masked_ids = self.sections['masked_ids']
+        # segments written before the snippets were stored have none
+        self.snippet_ids = self.sections.get('snippet_ids', np.zeros(0, dtype=np.int64))
+        self.snippet_ptr = self.sections.get('snippet_ptr', np.zeros(1, dtype=np.uint64))
+        # nor field lengths
+        self.length_ids, self.field_lengths = None, None
+        if 'field_lengths' in self.sections:
+            self.length_ids = self.sections['length_ids']
+            self.field_lengths = self.sections['field_lengths'].reshape(len(self.length_ids), -1) \
+                if len(self.length_ids) else np.zeros((0, 0), dtype=np.uint32)
+        # and segments written before the field terms have no alpha
+        alpha = self.sections.get('alpha')
+        self.alpha = alpha if alpha is not None and len(alpha) else None
+        # highest movie id in the segment, the last block of a term ends with its highest id
+        self.max_doc = int(self.skip_ids.max()) if len(self.skip_ids) else 0
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read the whole segment file into memory
+        :param path: str
+        :return: Segment
+        """
+        with open(path, 'rb') as f:
+            return cls(f.read())
+
+    @classmethod
+    def open(cls, path):
+        """
+        Memory-map the segment file read only
+        Every process mapping the same file shares one copy in the page cache,
+        pages are only read from disk when a lookup touches them
+        :param path: str
+        :return: Segment
+        """
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return len(self.term_ptr) - 1
+
+    def __contains__(self, term):
+        return self.find(term) is not None
+
+    def term(self, i):
+        """
+        The i-th term of the sorted lexicon
+        :param i: int
+        :return: bytes, utf-8 encoded term
+        """
+        # term_ptr[i + 1] - 1 drops the b'\0' separator
+        return self.terms[int(self.term_ptr[i]):int(self.term_ptr[i + 1]) - 1].tobytes()
+
+    def _bisect(self, key):
+        """
+        Binary search the lexicon
+        :param key: bytes
+        :return: int position of the first term not lower than key
+        """
+        low, high = 0, len(self)
+        while low < high:
+            mid = (low + high) // 2
+            if self.term(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def find(self, term):
+        """
+        Binary search the lexicon
+        :param term: str
+        :return: int position of the term, None if the term is not indexed
+        """
+        key = term.encode('utf-8')
+        low = self._bisect(key)
+        if low < len(self) and self.term(low) == key:
+            return low
+        return None
+
+    def prefix_range(self, prefix):
+        """
+        Terms starting with a prefix, they are contiguous in the sorted lexicon
+        :param prefix: str
+        :return: (int first, int last) positions of the terms[first:last]
+        """
+        key = prefix.encode('utf-8')
+        # no utf-8 encoded character has a 0xff byte, every term starting with the prefix sorts before this one
+        return self._bisect(key), self._bisect(key + b'\xff')
+
+    def fields(self, i):
+        """
+        Field terms of the i-th term, they follow it in the lexicon
+        :param i: int
+        :return: list of (int field, int position of the field term)
+        """
+        prefix = self.term(i) + FIELD_SEPARATOR
+        fields = []
+        for j in range(i + 1, len(self)):
+            term = self.term(j)
+            if not term.startswith(prefix):
+                break
+            fields.append((int(term[len(prefix):]), j))
+        return fields
+
+    def get(self, term):
+        """
+        Posting list of a term
+        :param term: str
+        :return: (numpy array of movie ids, numpy array of float32 scores), None if the term is not indexed
+        """
+        i = self.find(term)
+        if i is None:
+            return None
+        return self.postings(i)
+
+    def postings(self, i):
+        """
+        Posting list of the i-th term
+        :param i: int
+        :return: (numpy array of movie ids, numpy array of float32 scores)
+        """
+        first, last = int(self.score_ptr[i]), int(self.score_ptr[i + 1])
+        lengths = np.full(int(self.skip_ptr[i + 1] - self.skip_ptr[i]), BLOCK_SIZE, dtype=np.int64)
+        if len(lengths):
+            lengths[-1] = last - first - BLOCK_SIZE * (len(lengths) - 1)
+        doc_ids = self.sections['doc_ids'][int(self.id_ptr[i]):int(self.id_ptr[i + 1])]
+        return _decode_blocks(doc_ids, lengths), self.sections['scores'][first:last]
+
+    def max_score(self, i):
+        """
+        Upper bound of the score any movie gets from the i-th term
+        :param i: int
+        :return: float
+        """
+        return float(self.max_scores[i])
+
+    def doc_freq(self, i):
+        """
+        Document frequency of the i-th term
+        :param i: int
+        :return: int
+        """
+        return int(self.doc_freqs[i])
+
+    def lexicon(self):
+        """
+        Every term of the segment
+        :return: list of bytes, utf-8 encoded terms in lexicon order
+        """
+        return self.terms.tobytes().split(b'\0')[:-1]
+
+    def decode_range(self, first, last):
+        """
+        Decode the posting lists of the terms in [first, last) at once
+        :param first: int
+        :param last: int
+        :return: (numpy array of term positions, numpy array of movie ids, numpy array of float32 scores)
+        """
+        term_lengths = np.diff(self.score_ptr[first:last + 1]).astype(np.int64)
+        term_blocks = np.diff(self.skip_ptr[first:last + 1]).astype(np.int64)
+        # every block is full but the last one of each term
+        lengths = np.full(int(term_blocks.sum()), BLOCK_SIZE, dtype=np.int64)
+        non_empty = term_blocks > 0
+        lengths[np.cumsum(term_blocks)[non_empty] - 1] = (
+            term_lengths[non_empty] - BLOCK_SIZE * (term_blocks[non_empty] - 1))
+        ids = _decode_blocks(self.sections['doc_ids'][int(self.id_ptr[first]):int(self.id_ptr[last])], lengths)
+        scores = self.sections['scores'][int(self.score_ptr[first]):int(self.score_ptr[last])]
+        return np.repeat(np.arange(first, last), term_lengths), ids, scores
+
+    def snippets(self, movie_ids):
+        """
+        Stored result snippets of some movies
+        :param movie_ids: numpy array of movie ids
+        :return: (numpy bool array, True where the movie has a snippet, list of bytes snippets of those movies)
+        """
+        if len(self.snippet_ids) == 0:
+            return np.zeros(len(movie_ids), dtype=bool), []
+        position = np.minimum(np.searchsorted(self.snippet_ids, movie_ids), len(self.snippet_ids) - 1)
+        hit = self.snippet_ids[position] == movie_ids
+        snippets = self.sections['snippets']
+        return hit, [snippets[int(self.snippet_ptr[i]):int(self.snippet_ptr[i + 1])].tobytes()
+                     for i in position[hit].tolist()]
+
+    def count_postings(self, movies, step=1 << 16):
+        """
+        Count, for every term, its postings of the given movies
+        Posting lists are decoded step terms at a time
+        :param movies: numpy bool array indexed by movie id, True for the movies to count
+        :param step: int
+        :return: numpy array of int64 indexed by term position
+        """
+        counts = np.zeros(len(self), dtype=np.int64)
+        for first in range(0, len(self), step):
+            last = min(first + step, len(self))
+            terms, ids, _ = self.decode_range(first, last)
+            hit = movies[np.minimum(ids, len(movies) - 1)] & (ids < len(movies))
+            counts[first:last] = np.bincount(terms[hit] - first, minlength=last - first)
+        return counts
+
+    def score_candidates(self, i, movies):
+        """
+        Scores of the i-th term for a sorted array of candidate movies
+        Only the blocks that may hold a candidate are decoded, the rest of the posting list is skipped
+        :param i: int
+        :param movies: numpy array of movie ids, sorted
+        :return: (numpy bool array, True where the candidate is in the posting list,
+                  numpy array of float32 scores of those candidates)
+        """
+        first_block, last_block = int(self.skip_ptr[i]), int(self.skip_ptr[i + 1])
+        first, last = int(self.score_ptr[i]), int(self.score_ptr[i + 1])
+        # the block that may hold a movie is the first block ending at or after it
+        blocks = np.unique(np.searchsorted(self.skip_ids[first_block:last_block], movies))
+        blocks = blocks[blocks < last_block - first_block]
+        if len(blocks) == 0:
+            return np.zeros(len(movies), dtype=bool), np.zeros(0, dtype=np.float32)
+
+        if len(blocks) * 2 > last_block - first_block:
+            # most blocks are needed, decoding the whole posting list is cheaper
+            ids, scores = self.postings(i)
+        else:
+            block_first = first + blocks * BLOCK_SIZE
+            lengths = np.minimum(block_first + BLOCK_SIZE, last) - block_first
+            byte_start = self.skip_offset[first_block + blocks].astype(np.int64)
+            byte_end = np.append(self.skip_offset[first_block + 1:last_block], self.id_ptr[i + 1])[blocks]
+            ids = _decode_blocks(self.sections['doc_ids'][_ranges(byte_start, byte_end.astype(np.int64))], lengths)
+            scores = self.sections['scores'][_ranges(block_first, block_first + lengths)]
+
+        position = np.minimum(np.searchsorted(ids, movies), len(ids) - 1)
+        hit = ids[position] == movies
+        return hit, scores[position[hit]]
+
+
+def merge_segments(segments, writer, base, step=1 << 16):
+    """
+    Merge consecutive segments into one, see scoring.IndexView for how segments stack up
+    Postings of a movie masked by a newer segment of the merge are dropped, the document frequencies
+    are summed, and the masked ids are kept for the older segments unless the merge starts at the base
+    :param segments: list of Segment, oldest first
+    :param writer: SegmentWriter, built with the newest segment's total movies and, unless base,
+        the union of the segments' masked ids, its alpha is set to the weights of the merged postings
+    :param base: bool, True if the first segment is the base segment
+    :param step: int, terms of the merged lexicon written at a time
+    :return: None
+    """
+    # the summed postings of segments weighted differently no longer match any weights, only the field terms do
+    alphas = [segment.alpha for segment in segments]
+    writer.alpha = None
+    if all(alpha is not None for alpha in alphas):
+        same = all(np.array_equal(alpha, alphas[0]) for alpha in alphas)
+        writer.alpha = alphas[0] if same else np.full(len(alphas[0]), np.nan)
+
+    lexicons = [segment.lexicon() for segment in segments]
+    terms = sorted(set().union(*lexicons))
+    position = {term: i for i, term in enumerate(terms)}
+    to_merged = [np.array([position[term] for term in lexicon], dtype=np.int64) for lexicon in lexicons]
+    del lexicons, position
+    doc_freq = np.zeros(len(terms), dtype=np.int64)
+    for segment, merged in zip(segments, to_merged):
+        doc_freq[merged] += segment.doc_freqs
+
+    # movies masked for each segment by the newer segments of the merge
+    max_doc = max([segment.max_doc for segment in segments] + [0])
+    masked, newer = [], np.zeros(max_doc + 1, dtype=bool)
+    for segment in reversed(segments):
+        masked.append(newer.copy())
+        newer[segment.masked_ids[segment.masked_ids <= max_doc]] = True
+    masked.reverse()
+
+    for first in range(0, len(terms), step):
+        last = min(first + step, len(terms))
+        term_positions, movies, scores = [], [], []
+        for segment, merged, segment_masked in zip(segments, to_merged, masked):
+            # the segment's terms that fall in the batch are contiguous
+            start, end = np.searchsorted(merged, [first, last])
+            segment_terms, ids, segment_scores = segment.decode_range(int(start), int(end))
+            current = ~segment_masked[ids]
+            term_positions.append(merged[segment_terms[current]])
+            movies.append(ids[current])
+            scores.append(segment_scores[current])
+        term_positions, movies, scores = np.concatenate(term_positions), np.concatenate(movies), np.concatenate(scores)
+        order = np.lexsort((movies, term_positions))
+        ptr = np.searchsorted(term_positions[order], np.arange(first, last + 1))
+        # terms left without postings only matter while they still adjust the base's document frequency
+        keep = np.diff(ptr) > 0
+        if not base:
+            keep |= doc_freq[first:last] != 0
+        keep = np.flatnonzero(keep)
+        if len(keep) == 0:
+            continue
+        writer.add([terms[first + i].decode('utf-8') for i in keep], np.append(ptr[keep], ptr[keep[-1] + 1]),
+                   movies[order], scores[order], doc_freq=doc_freq[first:last][keep])
+
+    # the snippets of a movie masked by a newer segment of the merge are stale, the others are kept as they are
+    snippet_ids, snippets, newer = [], [], np.zeros(0, dtype=np.int64)
+    for segment in reversed(segments):
+        current = ~np.isin(segment.snippet_ids, newer)
+        _, segment_snippets = segment.snippets(segment.snippet_ids[current])
+        snippet_ids.append(segment.snippet_ids[current])
+        snippets.extend(segment_snippets)
+        newer = np.union1d(newer, segment.masked_ids)
+    snippet_ids = np.concatenate(snippet_ids)
+    order = np.argsort(snippet_ids, kind='stable')
+    writer.add_snippets(snippet_ids[order], [snippets[i] for i in order.tolist()])
+
+    # so are the field lengths
+    if any(segment.field_lengths is None for segment in segments):
+        return
+    length_ids, lengths, newer = [], [], np.zeros(0, dtype=np.int64)
+    for segment in reversed(segments):
+        current = ~np.isin(segment.length_ids, newer)
+        if current.any():
+            length_ids.append(segment.length_ids[current])
+            lengths.append(segment.field_lengths[current])
+        newer = np.union1d(newer, segment.masked_ids)
+    if length_ids:
+        length_ids = np.concatenate(length_ids)
+        order = np.argsort(length_ids, kind='stable')
+        writer.add_lengths(length_ids[order], np.concatenate(lengths)[order])
+
@@ -0,0 +1,166 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+import hashlib
+import json
+import threading
+
+
+# Cache of the ranked results of the most frequent queries
+#
+# A few hundred queries make most of the traffic, their results are kept in one of Django's caches,
+# keyed by the index version, the query's tokens, the limit, the scorer and the alpha weights of the query if any:
+#
+#   backend:        settings.SEARCH_CACHE names an alias of settings.CACHES (locmem, redis, memcached...),
+#                   by default a private locmem cache of SEARCH_CACHE_SIZE entries, evicting the least
+#                   recently used ones. Either way the results are kept SEARCH_CACHE_TIMEOUT seconds,
+#                   not the TIMEOUT of the alias
+#   invalidation:   calibrate, update, compactions and set_alpha stamp a new SearchIndex.version, entries of older
+#                   versions are never read again and age out of the cache
+#   pages:          the full ranking of a query, from which the pages after the first are sliced, is kept
+#                   SEARCH_PAGES_TIMEOUT seconds only
+#
+# Hits, misses and lookup latencies are counted per process, see QueryCache.stats.
+
+DEFAULT_SIZE = 1000
+DEFAULT_TIMEOUT = 300
+DEFAULT_PAGES_TIMEOUT = 60
+_MISSING = object()
+
+
+class QueryCache:
+    """
+    Ranked results of the queries, shared through Django's cache framework, with hit and latency stats
+    """
+
+    def __init__(self):
+        self._cache = None
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def cache(self):
+        """
+        The cache backend, settings.SEARCH_CACHE if set, a private locmem cache otherwise
+        :return: django.core.cache.backends.base.BaseCache, None if settings.SEARCH_CACHE is False
+        """
+        alias = getattr(settings, 'SEARCH_CACHE', None)
+        if alias is False:
+            return None
+        if alias is not None:
+            return caches[alias]
+        if self._cache is None:
+            self._cache = LocMemCache('results-query-cache', {
+                'TIMEOUT': self.timeout,
+                # cull the oldest third once full, locmem keeps its entries in least recently used order
+                'OPTIONS': {'MAX_ENTRIES': getattr(settings, 'SEARCH_CACHE_SIZE', DEFAULT_SIZE), 'CULL_FREQUENCY': 3},
+            })
+        return self._cache
+
+    @property
+    def timeout(self):
+        """
+        Seconds the results of a query are kept, settings.SEARCH_CACHE_TIMEOUT if set
+        :return: int
+        """
+        return getattr(settings, 'SEARCH_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+    @property
+    def pages_timeout(self):
+        """
+        Seconds the full ranking of a query is kept, settings.SEARCH_PAGES_TIMEOUT if set
+        :return: int
+        """
+        return getattr(settings, 'SEARCH_PAGES_TIMEOUT', DEFAULT_PAGES_TIMEOUT)
+
+    @staticmethod
+    def key(search_index_id, version, tokens, limit, alpha=None, scorer=None):
+        """
+        Cache key of a query, hashed so any backend accepts it
+        :param search_index_id: int
+        :param version: int, SearchIndex.version the results were ranked with
+        :param tokens: list of str, the tokenized query
+        :param limit: int, None for every result
+        :param alpha: dict(key=str field:value=weight) of the query, None for the index's weights
+        :param scorer: str, name of the scorer, see scorers.py
+        :return: str
+        """
+        query = json.dumps([search_index_id, version, tokens, limit, alpha, scorer], sort_keys=True)
+        return "results:query:" + hashlib.sha1(query.encode('utf-8')).hexdigest()
+
+    def get_or_rank(self, search_index_id, version, tokens, limit, rank_fn, alpha=None, scorer=None):
+        """
+        Return the cached results of a query, ranking and caching them on a miss
+        :param search_index_id: int
+        :param version: int, SearchIndex.version of the index rank_fn reads
+        :param tokens: list of str, the tokenized query
+        :param limit: int, None for every result
+        :param rank_fn: function returning the movie ids
+        :param alpha: dict(key=str field:value=weight) rank_fn weights the fields with, None for the index's weights
+        :param scorer: str, name of the scorer rank_fn ranks with
+        :return: the movie ids returned by rank_fn
+        """
+        cache = self.cache
+        if cache is None:
+            return rank_fn()
+        key = self.key(search_index_id, version, tokens, limit, alpha, scorer)
+        results = cache.get(key, _MISSING)
+        if results is _MISSING:
+            results = rank_fn()
+            # full rankings are only kept while the following pages are browsed
+            cache.set(key, results, self.pages_timeout if limit is None else self.timeout)
+            self._count('misses')
+        else:
+            self._count('hits')
+        return results
+
+    def record_latency(self, seconds):
+        """
+        Add the duration of a lookup to the stats
+        :param seconds: float
+        :return: None
+        """
+        with self._lock:
+            self._stats['lookups'] += 1
+            self._stats['total_time'] += seconds
+            self._stats['max_time'] = max(self._stats['max_time'], seconds)
+
+    def _count(self, outcome):
+        """
+        :param outcome: str, 'hits' or 'misses'
+        :return: None
+        """
+        with self._lock:
+            self._stats[outcome] += 1
+
+    def stats(self):
+        """
+        Hit rate and lookup latency of this process since the last reset
+        :return: dict
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        queries = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / queries if queries else 0.0
+        stats['mean_time'] = stats['total_time'] / stats['lookups'] if stats['lookups'] else 0.0
+        return stats
+
+    def reset_stats(self):
+        """
+        Zero the hit, miss and latency counters
+        :return: None
+        """
+        with self._lock:
+            self._stats = {'hits': 0, 'misses': 0, 'lookups': 0, 'total_time': 0.0, 'max_time': 0.0}
+
+    def clear(self):
+        """
+        Drop the private cache and the stats, entries of a shared cache are left to age out
+        :return: None
+        """
+        if self._cache is not None:
+            self._cache.clear()
+        self.reset_stats()
+
+
+query_cache = QueryCache()
@@ -0,0 +1,213 @@
+from django.conf import settings
+from collections import defaultdict
+from .scoring import N_FIELDS
+import numpy as np
+
+
+# Pluggable scorers, selected per query by name
+#
+# A scorer ranks the movies over a scoring.IndexView. It has the methods of the IndexView that lookup,
+# top_k, score_postings and score_batch call, so any scorer runs through the same evaluation:
+#
+#   find(term, alpha):                  handle of a term, None if no movie has it
+#   postings(handle):                   (movie ids, scores) of the term
+#   max_score(handle):                  upper bound of the term's scores, for MaxScore
+#   score_candidates(handle, movies):   scores of the term for some movies only
+#
+#   tfidf:  the IndexView itself, sum over fields of TF * IDF * alpha, TF normalized by the field's token count
+#   bm25f:  BM25F, the field TF are normalized by the field's length against its average and saturated
+#
+# A scorer is built once per IndexView, see get_scorer, so what it precomputes is reloaded with the index.
+# Other scorers are added to SCORERS, as a function building the scorer of an IndexView.
+
+DEFAULT_SCORER = 'tfidf'
+DEFAULT_K1 = 1.2
+DEFAULT_B = 0.75
+
+
+def default_scorer():
+    """
+    The scorer of the queries that do not name one, settings.SEARCH_SCORER if set
+    :return: str
+    """
+    return getattr(settings, 'SEARCH_SCORER', DEFAULT_SCORER)
+
+
+class BM25F:
+    """
+    BM25F over the field terms of the index
+    tf~(movie, term) = sum over fields of w(field) * count(movie, field, term) / B(movie, field)
+    B(movie, field)  = 1 - b(field) + b(field) * length(movie, field) / average length(field)
+    BM25F(movie, term) = IDF(term) * tf~ / (k1 + tf~)
+    IDF(term)        = log(1 + (total movies - DF(term) + 0.5) / (DF(term) + 0.5))
+    The field terms hold count / length, so length / B is precomputed for every movie and field when
+    the scorer is built: a posting costs a multiplication more than with the TF-IDF field terms.
+    The field weights w are the alpha weights scaled so that the highest one is 1.
+    """
+
+    def __init__(self, index, k1=DEFAULT_K1, b=DEFAULT_B):
+        """
+        :param index: scoring.IndexView, every segment must have field terms and field lengths
+        :param k1: float, saturation of the term frequency
+        :param b: float, or dict(key=str field:value=float), length normalization of the fields
+        """
+        if any(segment.alpha is None or segment.field_lengths is None for segment in index.segments):
+            raise ValueError("BM25F needs the field lengths of every segment, recalibrate the index.")
+        self.index = index
+        self.k1 = k1
+        self.max_doc = index.max_doc
+        b = b if isinstance(b, dict) else {str(field): b for field in range(N_FIELDS)}
+
+        lengths = self._field_lengths()
+        averages = lengths.sum(axis=0, dtype=np.float64) / max(index.total_movies, 1)
+        # length / B of every field, contiguous by field for the lookups of a field term's movies
+        self.norms = np.zeros((N_FIELDS, self.max_doc + 1), dtype=np.float32)
+        for field in np.flatnonzero(averages).tolist():
+            field_b = b.get(str(field), DEFAULT_B)
+            length = lengths[:, field]
+            # with b = 1 an empty field divides 0 by 0, it has no term to normalize
+            np.divide(length, 1 - field_b + field_b * length / averages[field], out=self.norms[field],
+                      where=length > 0)
+        self.max_norms = self.norms.max(axis=1).astype(np.float64)
+
+    def _field_lengths(self):
+        """
+        Field lengths of the current movies, the newest segment holding a movie has its current lengths
+        :return: numpy array of float32, a row per movie id and a column per field
+        """
+        lengths = np.zeros((self.max_doc + 1, N_FIELDS), dtype=np.float32)
+        for segment in self.index.segments:
+            # movies re-indexed or deleted since the older segments were written
+            lengths[segment.masked_ids[segment.masked_ids <= self.max_doc]] = 0
+            # movies without any posting have nothing to normalize
+            kept = segment.length_ids <= self.max_doc
+            lengths[segment.length_ids[kept], :segment.field_lengths.shape[1]] = segment.field_lengths[kept]
+        return lengths
+
+    def find(self, term, alpha=None):
+        """
+        Find the field terms of a term in the segments
+        :param term: str
+        :param alpha: numpy array indexed by field, the index's weights by default
+        :return: (list of (segment index, position of the field term, field, weight), idf),
+            None if no movie has the term
+        """
+        alpha = self.index.alpha if alpha is None else alpha
+        alpha = self.index.segments[0].alpha if alpha is None else alpha
+        weights = alpha / alpha.max() if alpha.max() > 0 else alpha
+        entries, df = [], 0
+        for k, segment in enumerate(self.index.segments):
+            i = segment.find(term)
+            if i is None:
+                continue
+            df += segment.doc_freq(i)
+            entries.extend((k, j, field, float(weights[field])) for field, j in segment.fields(i) if weights[field] > 0)
+        if df <= 0:
+            return None
+        return entries, float(np.log(1 + (self.index.total_movies - df + 0.5) / (df + 0.5)))
+
+    def get(self, term, alpha=None):
+        """
+        Posting list of a term
+        :param term: str
+        :param alpha: numpy array indexed by field, the index's weights by default
+        :return: (numpy array of movie ids, numpy array of float64 scores), None if the term is not indexed
+        """
+        handle = self.find(term, alpha)
+        if handle is None:
+            return None
+        return self.postings(handle)
+
+    def _saturate(self, freqs, idf):
+        """
+        :param freqs: numpy array of float64 tf~
+        :param idf: float
+        :return: numpy array of float64 scores
+        """
+        return idf * freqs / (self.k1 + freqs)
+
+    def postings(self, handle):
+        """
+        Scored postings of a term
+        :param handle: tuple returned by find
+        :return: (numpy array of sorted movie ids, numpy array of float64 scores)
+        """
+        entries, idf = handle
+        ids, freqs = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.float64)]
+        for k, i, field, weight in entries:
+            segment_ids, tf = self.index.segments[k].postings(i)
+            masked = self.index.masked[k]
+            if masked is not None:
+                current = ~masked[segment_ids]
+                segment_ids, tf = segment_ids[current], tf[current]
+            ids.append(segment_ids)
+            freqs.append(tf.astype(np.float64) * self.norms[field][segment_ids] * weight)
+        # a movie has a posting in every field term of the term it appears in, one posting per movie
+        ids, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        freqs = np.bincount(inverse, weights=np.concatenate(freqs), minlength=len(ids))
+        return ids, self._saturate(freqs, idf)
+
+    def max_score(self, handle):
+        """
+        Upper bound of the score any movie gets from a term, the saturation only grows with tf~
+        :param handle: tuple returned by find
+        :return: float
+        """
+        entries, idf = handle
+        bounds = defaultdict(float)
+        for k, i, field, weight in entries:
+            bounds[k] += self.index.segments[k].max_score(i) * self.max_norms[field] * weight
+        return float(self._saturate(max(bounds.values(), default=0.0), idf))
+
+    def score_candidates(self, handle, movies):
+        """
+        Scores of a term for a sorted array of candidate movies, see postings.Segment.score_candidates
+        :param handle: tuple returned by find
+        :param movies: numpy array of movie ids, sorted
+        :return: (numpy bool array, True where the candidate is in the posting list,
+                  numpy array of float64 scores of those candidates)
+        """
+        entries, idf = handle
+        hit = np.zeros(len(movies), dtype=bool)
+        freqs = np.zeros(len(movies), dtype=np.float64)
+        for k, i, field, weight in entries:
+            segment_hit, tf = self.index.segments[k].score_candidates(i, movies)
+            found = np.flatnonzero(segment_hit)
+            masked = self.index.masked[k]
+            if masked is not None:
+                current = ~masked[movies[found]]
+                found, tf = found[current], tf[current]
+            hit[found] = True
+            freqs[found] += tf.astype(np.float64) * self.norms[field][movies[found]] * weight
+        return hit, self._saturate(freqs[hit], idf)
+
+
+def _bm25f(index):
+    """
+    :param index: scoring.IndexView
+    :return: BM25F with settings.SEARCH_BM25_K1 and settings.SEARCH_BM25_B if set
+    """
+    return BM25F(index, getattr(settings, 'SEARCH_BM25_K1', DEFAULT_K1), getattr(settings, 'SEARCH_BM25_B', DEFAULT_B))
+
+
+SCORERS = {
+    'tfidf': lambda index: index,
+    'bm25f': _bm25f,
+}
+
+
+def get_scorer(index, name=None):
+    """
+    The scorer of a name over an index, built on first use and kept with the index
+    :param index: scoring.IndexView
+    :param name: str, a key of SCORERS, default_scorer() if None
+    :return: scorer, see the module's comment
+    """
+    name = name or default_scorer()
+    if name not in SCORERS:
+        raise ValueError("Unknown scorer {}, expected one of {}.".format(name, ", ".join(sorted(SCORERS))))
+    scorer = index.scorers.get(name)
+    if scorer is None:
+        # built once per index, two threads building it at the same time keep either copy
+        scorer = index.scorers.setdefault(name, SCORERS[name](index))
+    return scorer
@@ -0,0 +1,532 @@
+from collections import Counter, defaultdict
+from array import array
+import numpy as np
+
+
+# Vectorized tf-idf scoring
+#
+# The term frequencies are held as a sparse (movie, field) x term matrix in coordinate form,
+# one entry per (movie, field, term). Every step after counting is a numpy array operation:
+#
+#   DF(term)          = number of distinct movies in the term's column
+#   IDF(term)         = log(total movies / DF(term))
+#   TFIDF(term,movie) = sum over fields of TF(movie, field, term) * IDF(term) * alpha(field)
+#
+# and the result is laid out in compressed sparse rows by term, which is the segment layout.
+# Segments store the sum over fields of TF * alpha and the DF of every term, IDF(term) is applied
+# at query time by IndexView so that a delta segment can adjust the DF of the base segment.
+# Every term is followed by its field terms holding TF(movie, field, term) unweighted, IndexView sums
+# them with other alpha weights at query time instead of the stored sums.
+
+N_FIELDS = 10
+FIELD_SEPARATOR = '\x01'
+
+
+class TermFrequencies:
+    """
+    Sparse (movie, field) x term matrix of term frequencies in coordinate form
+    TF(movie, field, term) = count of term in field / total terms in field
+    """
+
+    def __init__(self):
+        self.vocabulary = dict()
+        self.movies = array('q')
+        self.fields = array('b')
+        self.terms = array('q')
+        self.tf = array('d')
+        # token count of every (movie, field), the field lengths BM25F normalizes by
+        self.length_movies = array('q')
+        self.length_fields = array('b')
+        self.lengths = array('q')
+
+    def __len__(self):
+        return len(self.tf)
+
+    def add(self, movie, field, term_list):
+        """
+        Count the terms of one movie field, terms of length 0 or 1 are not indexed
+        :param movie: int movie id
+        :param field: int alpha key
+        :param term_list: list of str
+        :return: None
+        """
+        counts = Counter(x.lower() for x in term_list if len(x) > 1)
+        total = float(len(term_list))
+        for term, count in counts.items():
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                term_id = self.vocabulary[term] = len(self.vocabulary)
+            self.terms.append(term_id)
+            self.tf.append(count / total)
+        self.movies.extend([movie] * len(counts))
+        self.fields.extend([field] * len(counts))
+        if term_list:
+            self.length_movies.append(movie)
+            self.length_fields.append(field)
+            self.lengths.append(len(term_list))
+
+    def arrays(self):
+        """
+        Views over the counted entries, call once every movie has been added
+        :return: numpy arrays (movies, fields, terms, tf)
+        """
+        return (np.frombuffer(self.movies, dtype=np.int64), np.frombuffer(self.fields, dtype=np.int8),
+                np.frombuffer(self.terms, dtype=np.int64), np.frombuffer(self.tf, dtype=np.float64))
+
+    def field_lengths(self):
+        """
+        Token count of every field of the counted movies
+        :return: (numpy array of sorted movie ids, numpy array of uint32 lengths, a row per movie, a column per field)
+        """
+        ids, rows = np.unique(np.frombuffer(self.length_movies, dtype=np.int64), return_inverse=True)
+        lengths = np.zeros((len(ids), N_FIELDS), dtype=np.uint32)
+        lengths[rows, np.frombuffer(self.length_fields, dtype=np.int8)] = np.frombuffer(self.lengths, dtype=np.int64)
+        return ids, lengths
+
+
+def alpha_vector(alpha_dict):
+    """
+    Turn the alpha settings into a vector indexed by field
+    The MaxScore bounds of top_k only hold for weights of at least 0
+    :param alpha_dict: dict(key=str field:value=weight)
+    :return: numpy array of float64, fields without a weight are 0
+    """
+    if not isinstance(alpha_dict, dict):
+        raise ValueError("Expected field weights as {{field: weight}}, got {!r}.".format(alpha_dict))
+    alpha = np.zeros(N_FIELDS, dtype=np.float64)
+    for key, value in alpha_dict.items():
+        try:
+            field, weight = int(key), float(value)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid weight {!r} of field {!r}.".format(value, key))
+        if not 0 <= field < N_FIELDS:
+            raise ValueError("Unknown field {}, expected 0 to {}.".format(key, N_FIELDS - 1))
+        # also rejects NaN
+        if not weight >= 0:
+            raise ValueError("Negative weight {} of field {}.".format(value, key))
+        alpha[field] = weight
+    return alpha
+
+
+def inverse_doc_freq(df, total_movies):
+    """
+    IDF(term) = log(total movies / DF(term))
+    :param df: numpy array of document frequencies
+    :param total_movies: int
+    :return: numpy array of float64, same index as df
+    """
+    return np.log(total_movies / df.astype(np.float64))
+
+
+def lexicon(vocabulary):
+    """
+    Sort terms the way the segment stores them, by their utf-8 encoding
+    :param vocabulary: dict(key=term:value=term id)
+    :return: (list of str sorted terms, numpy array of int64 mapping term id to its position in the sorted terms)
+    """
+    terms = sorted(vocabulary, key=lambda x: x.encode('utf-8'))
+    position = np.empty(len(terms), dtype=np.int64)
+    position[[vocabulary[term] for term in terms]] = np.arange(len(terms))
+    return terms, position
+
+
+def field_term(term, field):
+    """
+    Lexicon entry of the postings of a term in one field, sorts right after the term
+    :param term: str
+    :param field: int alpha key
+    :return: str
+    """
+    return "{}{}{}".format(term, FIELD_SEPARATOR, field)
+
+
+def weighted_postings(terms, movies, fields, tf, alpha):
+    """
+    Weight every term frequency by its field alpha, then sum the fields of each (term, movie)
+    :param terms: numpy array of term positions in the sorted lexicon, one per entry
+    :param movies: numpy array of movie ids, one per entry
+    :param fields: numpy array of fields, one per entry
+    :param tf: numpy array of term frequencies, one per entry
+    :param alpha: numpy array indexed by field
+    :return: (numpy array of term positions, numpy array of movie ids, numpy array of float64 weights)
+        one entry per (term, movie), sorted by term position then movie id
+    """
+    if len(tf) == 0:
+        return terms, movies, tf
+    weighted = tf * alpha[fields]
+    order = np.lexsort((movies, terms))
+    terms, movies, weighted = terms[order], movies[order], weighted[order]
+    # one posting per (term, movie), summing the fields the term appears in
+    starts = np.flatnonzero(np.concatenate(([True], (np.diff(terms) != 0) | (np.diff(movies) != 0))))
+    return terms[starts], movies[starts], np.add.reduceat(weighted, starts)
+
+
+def field_postings(terms, term_positions, movies, fields, tf, alpha):
+    """
+    Weighted postings of every term followed by the unweighted postings of each field it appears in,
+    laid out in compressed sparse rows by lexicon entry
+    :param terms: list of str sorted by their utf-8 encoding
+    :param term_positions: numpy array of positions in terms, one per entry
+    :param movies: numpy array of movie ids, one per entry
+    :param fields: numpy array of fields, one per entry
+    :param tf: numpy array of term frequencies, one per entry
+    :param alpha: numpy array indexed by field
+    :return: (entries, ptr, doc_ids, weights)
+        entries: list of str, every term followed by its field terms, see field_term
+        ptr: numpy array, postings of entries[i] are doc_ids[ptr[i]:ptr[i + 1]]
+        doc_ids: numpy array of movie ids, sorted within each entry
+        weights: numpy array of float32, sums over fields of tf * alpha, tf for the field terms
+    """
+    summed_positions, summed_movies, summed = weighted_postings(term_positions, movies, fields, tf, alpha)
+    # entry keys in lexicon order, the term first then its fields
+    stride = N_FIELDS + 1
+    keys = np.concatenate((summed_positions * stride, term_positions * stride + 1 + fields))
+    doc_ids = np.concatenate((summed_movies, movies))
+    weights = np.concatenate((summed, tf))
+    order = np.lexsort((doc_ids, keys))
+    keys, doc_ids, weights = keys[order], doc_ids[order], weights[order]
+    present, starts = np.unique(keys, return_index=True)
+    entries = [terms[key // stride] if key % stride == 0 else field_term(terms[key // stride], key % stride - 1)
+               for key in present.tolist()]
+    return entries, np.append(starts, len(keys)), doc_ids, weights.astype(np.float32)
+
+
+def term_postings(term_freq, alpha):
+    """
+    Weight every (term, movie) held in memory and lay the postings out in compressed sparse rows by term,
+    every term followed by its field terms
+    :param term_freq: TermFrequencies
+    :param alpha: numpy array indexed by field
+    :return: (terms, ptr, doc_ids, weights) see field_postings
+    """
+    terms, position = lexicon(term_freq.vocabulary)
+    movies, fields, term_ids, tf = term_freq.arrays()
+    return field_postings(terms, position[term_ids], movies, fields, tf, alpha)
+
+
+class IndexView:
+    """
+    Scored view over the segments of the index, used by lookup and top_k
+    The first segment is the base calibration, every following delta segment re-indexes the movies
+    it masks: their postings in the older segments are skipped
+    DF(term) = sum over segments of the term's DF, an adjustment in delta segments
+    TFIDF(movie, term) = weight of the posting * IDF(term)
+    With alpha weights other than the ones a segment summed its postings with, the weight of a posting
+    is the sum over the term's field terms of TF * alpha instead
+    """
+
+    def __init__(self, segments, alpha=None):
+        """
+        :param segments: list of postings.Segment, oldest first
+        :param alpha: numpy array indexed by field, the default weights of the lookups,
+            None for the weights every segment was written with
+        """
+        self.segments = segments
+        self.alpha = alpha
+        self.total_movies = segments[-1].total_movies
+        self.max_doc = max(segment.max_doc for segment in segments)
+        # movies masked for each segment by the newer segments
+        self.masked = []
+        newer = np.zeros(self.max_doc + 1, dtype=bool)
+        for segment in reversed(segments):
+            self.masked.append(newer.copy() if newer.any() else None)
+            newer[segment.masked_ids[segment.masked_ids <= self.max_doc]] = True
+        self.masked.reverse()
+        # scorers built over this view, see scorers.get_scorer
+        self.scorers = dict()
+
+    def find(self, term, alpha=None):
+        """
+        Find a term in the segments
+        Segments that summed their postings with the alpha weights, or that have no field terms,
+        read the term's postings, the others read its field terms
+        :param term: str
+        :param alpha: numpy array indexed by field, self.alpha by default
+        :return: (list of (segment index, position in the segment, alpha weight or None for the summed postings)
+            of the posting lists to add up, idf), None if no movie has the term
+        """
+        alpha = self.alpha if alpha is None else alpha
+        entries, df = [], 0
+        for k, segment in enumerate(self.segments):
+            i = segment.find(term)
+            if i is None:
+                continue
+            df += segment.doc_freq(i)
+            if alpha is None or segment.alpha is None or np.array_equal(segment.alpha, alpha):
+                entries.append((k, i, None))
+            else:
+                entries.extend((k, j, float(alpha[field])) for field, j in segment.fields(i))
+        if df <= 0:
+            return None
+        return entries, float(inverse_doc_freq(np.int64(df), self.total_movies))
+
+    def complete(self, prefix, limit=10):
+        """
+        Terms starting with a prefix, the ones most movies have first
+        Only the terms with the highest DF in each segment are candidates, their DF are then summed
+        :param prefix: str
+        :param limit: int
+        :return: list of (str term, int DF)
+        """
+        separator = FIELD_SEPARATOR.encode('utf-8')
+        candidates = set()
+        for segment in self.segments:
+            first, last = segment.prefix_range(prefix)
+            doc_freqs = segment.doc_freqs[first:last]
+            top = np.arange(len(doc_freqs))
+            if len(doc_freqs) > 2 * limit:
+                top = np.argpartition(-doc_freqs, 2 * limit)[:2 * limit]
+            # a field term stands for its term, whose DF is at least the field term's
+            candidates.update(segment.term(first + i).split(separator)[0] for i in top[doc_freqs[top] > 0].tolist())
+        completions = []
+        for term in candidates:
+            positions = [segment.find(term.decode('utf-8')) for segment in self.segments]
+            df = sum(segment.doc_freq(i) for segment, i in zip(self.segments, positions) if i is not None)
+            if df > 0:
+                completions.append((term.decode('utf-8'), df))
+        completions.sort(key=lambda x: (-x[1], x[0]))
+        return completions[:limit]
+
+    def snippets(self, movie_ids):
+        """
+        Stored result snippets of some movies, the newest segment holding a movie has its current snippet
+        :param movie_ids: list of int
+        :return: dict(key=movie id:value=bytes snippet), movies without a snippet are left out
+        """
+        found = dict()
+        remaining = np.asarray(movie_ids, dtype=np.int64)
+        for segment in reversed(self.segments):
+            if len(remaining) == 0:
+                break
+            hit, snippets = segment.snippets(remaining)
+            found.update(zip(remaining[hit].tolist(), snippets))
+            # older segments only hold stale snippets of the movies this one re-indexed
+            remaining = remaining[~hit & ~np.isin(remaining, segment.masked_ids)]
+        return found
+
+    def get(self, term, alpha=None):
+        """
+        Posting list of a term
+        :param term: str
+        :param alpha: numpy array indexed by field, self.alpha by default
+        :return: (numpy array of movie ids, numpy array of float64 scores), None if the term is not indexed
+        """
+        handle = self.find(term, alpha)
+        if handle is None:
+            return None
+        ids, scores = self.postings(handle)
+        order = np.argsort(ids, kind='stable')
+        return ids[order], scores[order]
+
+    def postings(self, handle):
+        """
+        Scored postings of a term, segment after segment
+        :param handle: tuple returned by find
+        :return: (numpy array of movie ids, numpy array of float64 scores)
+        """
+        entries, idf = handle
+        ids, weights = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.float64)]
+        for k, i, weight in entries:
+            segment_ids, segment_weights = self.segments[k].postings(i)
+            if self.masked[k] is not None:
+                current = ~self.masked[k][segment_ids]
+                segment_ids, segment_weights = segment_ids[current], segment_weights[current]
+            ids.append(segment_ids)
+            segment_weights = segment_weights.astype(np.float64)
+            weights.append(segment_weights if weight is None else segment_weights * weight)
+        ids, weights = np.concatenate(ids), np.concatenate(weights)
+        if any(weight is not None for _, _, weight in entries):
+            # a movie has a posting in every field term of the term it appears in, one posting per movie
+            ids, inverse = np.unique(ids, return_inverse=True)
+            weights = np.bincount(inverse, weights=weights, minlength=len(ids))
+        return ids, weights * idf
+
+    def max_score(self, handle):
+        """
+        Upper bound of the score any movie gets from a term
+        :param handle: tuple returned by find
+        :return: float
+        """
+        entries, idf = handle
+        bounds = defaultdict(float)
+        for k, i, weight in entries:
+            bounds[k] += self.segments[k].max_score(i) * (1.0 if weight is None else weight)
+        return max(bounds.values(), default=0.0) * idf
+
+    def score_candidates(self, handle, movies):
+        """
+        Scores of a term for a sorted array of candidate movies, see postings.Segment.score_candidates
+        :param handle: tuple returned by find
+        :param movies: numpy array of movie ids, sorted
+        :return: (numpy bool array, True where the candidate is in the posting list,
+                  numpy array of float64 scores of those candidates)
+        """
+        entries, idf = handle
+        hit = np.zeros(len(movies), dtype=bool)
+        weights = np.zeros(len(movies), dtype=np.float64)
+        for k, i, weight in entries:
+            segment_hit, segment_weights = self.segments[k].score_candidates(i, movies)
+            found = np.flatnonzero(segment_hit)
+            if self.masked[k] is not None:
+                current = ~self.masked[k][movies[found]]
+                found, segment_weights = found[current], segment_weights[current]
+            hit[found] = True
+            weights[found] += segment_weights if weight is None else segment_weights.astype(np.float64) * weight
+        return hit, weights[hit] * idf
+
+
+def score_postings(postings):
+    """
+    Sum the scores of every movie over the posting lists of the query terms
+    :param postings: list of (numpy array of movie ids, numpy array of scores)
+    :return: (numpy array of movie ids, numpy array of float64 summed scores)
+    """
+    doc_ids = np.concatenate([ids for ids, _ in postings])
+    scores = np.concatenate([score for _, score in postings]).astype(np.float64)
+    # movie ids are small, dense accumulators avoid sorting the postings
+    movies = np.flatnonzero(np.bincount(doc_ids))
+    return movies, np.bincount(doc_ids, weights=scores)[movies]
+
+
+def rank(movies, scores, limit=None):
+    """
+    Order movies by descending score, ties keep ascending movie id
+    With a limit only the movies scoring at least the limit-th best score are sorted
+    :param movies: numpy array of movie ids, sorted
+    :param scores: numpy array of scores
+    :param limit: int
+    :return: list of movie ids
+    """
+    if limit is not None and len(scores) > limit:
+        threshold = np.partition(scores, len(scores) - limit)[len(scores) - limit]
+        selected = scores >= threshold
+        movies, scores = movies[selected], scores[selected]
+    order = np.argsort(-scores, kind='stable')[:limit]
+    return movies[order].tolist()
+
+
+def top_k(segment, terms, limit):
+    """
+    Term-at-a-time MaxScore evaluation of a query
+    Terms are visited from the highest upper bound down. Once the upper bounds of the terms left
+    can no longer lift a movie that has not been seen into the top k, the remaining posting lists
+    are only probed for the collected movies that can still reach the top k, skipping every block
+    of the posting list that holds none of them.
+    :param segment: IndexView, or a postings.Segment to rank by the stored scores
+    :param terms: list of terms found in the segment, one per query term
+    :param limit: int, k
+    :return: list of movie ids, same order as rank() over every posting
+    """
+    bounds = [segment.max_score(i) for i in terms]
+    remaining = float(sum(bounds))
+    # movie ids are small, accumulate in dense arrays indexed by movie id
+    scores = np.zeros(segment.max_doc + 1, dtype=np.float64)
+    seen = np.zeros(segment.max_doc + 1, dtype=bool)
+    movies = None
+    for j in sorted(range(len(terms)), key=lambda x: -bounds[x]):
+        if movies is None:
+            candidates = np.flatnonzero(seen)
+            if len(candidates) >= limit:
+                # scores only grow, so the k-th best score so far is a lower bound of the final k-th score
+                threshold = np.partition(scores[candidates], len(candidates) - limit)[len(candidates) - limit]
+                if remaining < threshold:
+                    # no movie outside the candidates can reach the top k anymore
+                    movies = candidates
+        if movies is None:
+            ids, term_scores = segment.postings(terms[j])
+            scores[ids] += term_scores
+            seen[ids] = True
+        else:
+            # drop the candidates that cannot reach the top k even with every term left
+            movies = movies[scores[movies] + remaining >= threshold]
+            hit, term_scores = segment.score_candidates(terms[j], movies)
+            scores[movies[hit]] += term_scores
+        remaining -= bounds[j]
+
+    movies = np.flatnonzero(seen) if movies is None else movies
+    return rank(movies, scores[movies], limit)
+
+
+class SharedPostings:
+    """
+    Posting lists of the distinct terms of a batch of queries, read once from a scorer and shared by every query
+    It has the methods of the scorer that score_postings and top_k call, a handle is the term's position in the batch
+    """
+
+    def __init__(self, index, alpha=None):
+        """
+        :param index: IndexView, or another scorer, see scorers.py
+        :param alpha: numpy array indexed by field, the index's default weights if None
+        """
+        self.index = index
+        self.alpha = alpha
+        self.max_doc = index.max_doc
+        self.handles = dict()
+        self.lists = []
+        self.bounds = []
+
+    def find(self, term):
+        """
+        :param term: str
+        :return: int handle, None if no movie has the term
+        """
+        if term not in self.handles:
+            handle = self.index.find(term, self.alpha)
+            self.handles[term] = None if handle is None else len(self.lists)
+            if handle is not None:
+                ids, scores = self.index.postings(handle)
+                # the segments follow each other in the posting list, sorted for score_candidates
+                order = np.argsort(ids, kind='stable')
+                self.lists.append((ids[order], scores[order]))
+                self.bounds.append(self.index.max_score(handle))
+        return self.handles[term]
+
+    def postings(self, handle):
+        """
+        :param handle: int returned by find
+        :return: (numpy array of sorted movie ids, numpy array of float64 scores)
+        """
+        return self.lists[handle]
+
+    def max_score(self, handle):
+        """
+        The scorer's bound, so that top_k visits the terms in the order lookup does
+        :param handle: int returned by find
+        :return: float
+        """
+        return self.bounds[handle]
+
+    def score_candidates(self, handle, movies):
+        """
+        :param handle: int returned by find
+        :param movies: numpy array of movie ids, sorted
+        :return: (numpy bool array, True where the candidate is in the posting list,
+                  numpy array of float64 scores of those candidates)
+        """
+        ids, scores = self.lists[handle]
+        positions = np.minimum(np.searchsorted(ids, movies), max(len(ids) - 1, 0))
+        hit = ids[positions] == movies
+        return hit, scores[positions[hit]]
+
+
+def score_batch(index, queries, limit=None, alpha=None):
+    """
+    Rank many tokenized queries at once, every posting list of the batch is read and decoded once
+    Then each query is ranked over the shared posting lists like lookup ranks it: with a limit by top_k,
+    otherwise by score_postings and rank
+    :param index: IndexView, or another scorer, see scorers.py
+    :param queries: list of list of str, the tokens of every query
+    :param limit: int, None for every result
+    :param alpha: numpy array indexed by field, the index's default weights if None
+    :return: generator of list of movie ids, one per query in order
+    """
+    shared = SharedPostings(index, alpha)
+    for tokens in queries:
+        terms = [shared.find(token) for token in tokens]
+        terms = [x for x in terms if x is not None]
+        if not terms:
+            yield []
+        elif limit:
+            yield top_k(shared, terms, limit)
+        else:
+            yield rank(*score_postings([shared.postings(x) for x in terms]))
@@ -1,8 +1,22 @@
-from .models import SearchIndex, Movies
+from django.db.models import Max
+from .models import SearchIndex, Movies, IndexChangelog
+from .calibration import spill_runs, spill_parallel, merge_runs, merge_parallel, merge_lengths, delta_postings
+from .postings import SegmentWriter, index_dir
+from .query_cache import query_cache
+from .hydration import hydrate, write_snippets
+from .corpus import CHUNK_SIZE
+from .scoring import alpha_vector, score_postings, rank, top_k, score_batch
+from .scorers import get_scorer, default_scorer
+from .segments import SegmentManager, new_segment_name
+import numpy as np
+import itertools
+import tempfile
+import shutil
 import json
 import time
-from decimal import Decimal as _d, Context, ROUND_05UP
-from math import log
+import threading
+import os
+import re
 
 
 class WordProcessor:
@@ -10,18 +24,21 @@ class WordProcessor:
     Processing Text, removing speial characters and generating k-phrases
     """
 
+    stop_words = frozenset([
+        'a', 'able', 'about', 'across', 'after', 'all', 'almost', 'also', 'am', 'among', 'an', 'and', 'any', 'are',
+        'as', 'at', 'be', 'because', 'been', 'but', 'by', 'can', 'cannot', 'could', 'dear', 'did', 'do', 'does',
+        'either', 'else', 'ever', 'every', 'for', 'from', 'get', 'got', 'had', 'has', 'have', 'he', 'her', 'hers',
+        'him', 'his', 'how', 'however', 'i', 'if', 'in', 'into', 'is', 'it', 'its', 'just', 'least', 'let', 'like',
+        'likely', 'may', 'me', 'might', 'most', 'must', 'my', 'neither', 'no', 'nor', 'not', 'of', 'off', 'often',
+        'on', 'only', 'or', 'other', 'our', 'own', 'rather', 'said', 'say', 'says', 'she', 'should', 'since', 'so',
+        'some', 'than', 'that', 'the', 'their', 'them', 'then', 'there', 'these', 'they', 'this', 'tis', 'to', 'too',
+        'twas', 'us', 'wants', 'was', 'we', 'were', 'what', 'when', 'where', 'which', 'while', 'who', 'whom', 'why',
+        'will', 'with', 'would', 'yet', 'you', 'your'])
+    # every character that is neither alphanumeric nor whitespace, removed from inside the words
+    special_chars = re.compile(r'[^\w\s]|_')
+
     def __init__(self, k):
         self.k = k  # k is the maximum length for a phrase
-        self.stop_words = ['a', 'able', 'about', 'across', 'after', 'all', 'almost', 'also', 'am', 'among', 'an', 'and',
-                           'any', 'are', 'as', 'at', 'be', 'because', 'been', 'but', 'by', 'can', 'cannot', 'could',
-                           'dear', 'did', 'do', 'does', 'either', 'else', 'ever', 'every', 'for', 'from', 'get', 'got',
-                           'had', 'has', 'have', 'he', 'her', 'hers', 'him', 'his', 'how', 'however', 'i', 'if', 'in',
-                           'into', 'is', 'it', 'its', 'just', 'least', 'let', 'like', 'likely', 'may', 'me', 'might',
-                           'most', 'must', 'my', 'neither', 'no', 'nor', 'not', 'of', 'off', 'often', 'on', 'only',
-                           'or', 'other', 'our', 'own', 'rather', 'said', 'say', 'says', 'she', 'should', 'since', 'so',
-                           'some', 'than', 'that', 'the', 'their', 'them', 'then', 'there', 'these', 'they', 'this',
-                           'tis', 'to', 'too', 'twas', 'us', 'wants', 'was', 'we', 'were', 'what', 'when', 'where',
-                           'which', 'while', 'who', 'whom', 'why', 'will', 'with', 'would', 'yet', 'you', 'your']
 
     def tokenize(self, text):
         """
@@ -31,17 +48,12 @@ class WordProcessor:
         :param text: str
         :return: list of str
         """
-        # Gonna do a ugly brute force method for the sake of getting this done
-        k_phrases = []
-        text_remove_stop = ["".join(char for char in word if char.isalnum()).lower()
-                            for word in text.split(" ")
-                            if word not in self.stop_words]
-        for k in range(self.k):
-            index = 0
-            while index + k + 1 <= len(text_remove_stop):
-                k_phrases.append(" ".join(text_remove_stop[index:index + k + 1]))
-                index += 1
-
+        # normalize the whole text in one pass, then drop the stop words once they are lowercase
+        words = [word for word in self.special_chars.sub("", text.lower()).split() if word not in self.stop_words]
+        k_phrases = list(words)
+        # slide a window of k words over the text for every phrase length above 1
+        for k in range(2, self.k + 1):
+            k_phrases.extend(" ".join(phrase) for phrase in zip(*(words[i:] for i in range(k))))
         return k_phrases
 
     def tokenize_character(self, list_text):
@@ -54,10 +66,81 @@ class WordProcessor:
         """
         k_phrases = []
         for name in list_text:
-            k_phrases += self.tokenize(name)
+            k_phrases.extend(self.tokenize(name))
         return k_phrases
 
 
+class LoadedIndex:
+    """
+    Process-wide holder of the memory-mapped tf-idf segments
+    The segments are mapped once and reused by every SearchIndexWrapper in the process,
+    they are only remapped when calibrate, update or a compaction stamps a new SearchIndex.version
+    """
+
+    def __init__(self):
+        # (version, segment), swapped as one so readers never pair a version with another version's segment
+        self._current = (None, None)
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        """
+        :return: int, SearchIndex.version of the loaded segments
+        """
+        return self._current[0]
+
+    @property
+    def segment(self):
+        """
+        :return: IndexView, None if nothing is loaded
+        """
+        return self._current[1]
+
+    def get_versioned(self, search_index_id=1):
+        """
+        Return the tf-idf index and its version, reloading it if a newer calibration exists
+        Costs a single primary key lookup when the cached copy is current
+        :param search_index_id: int
+        :return: (int version, IndexView), the IndexView is None if the index was never calibrated
+        """
+        version = SearchIndex.objects.filter(id=search_index_id).values_list('version', flat=True).first()
+        current = self._current
+        if version != current[0]:
+            with self._lock:
+                # another thread may have reloaded while we waited
+                current = self._current
+                if version != current[0]:
+                    s_index = SearchIndex.objects.get(id=search_index_id)
+                    segment = None
+                    if s_index.is_calibrated():
+                        segment = SegmentManager(search_index_id).open(s_index.get_segments(),
+                                                                       alpha_vector(s_index.get_alpha()))
+                    current = self._current = (s_index.version, segment)
+        return current
+
+    def get(self, search_index_id=1):
+        """
+        Return the tf-idf index, reloading it if a newer calibration exists
+        :param search_index_id: int
+        :return: IndexView, None if the index was never calibrated
+        """
+        return self.get_versioned(search_index_id)[1]
+
+    def clear(self):
+        """
+        Drop the cached index and the results ranked with it, the next get() reloads it from the database
+        :return: None
+        """
+        with self._lock:
+            self._current = (None, None)
+        query_cache.clear()
+
+
+loaded_index = LoadedIndex()
+# queries tokenized and scored together by lookup_many
+BATCH_QUERIES = 1000
+
+
 class SearchIndexWrapper:
     """
     Search Index Wrapper:
@@ -67,9 +150,11 @@ class SearchIndexWrapper:
     """
     def __init__(self):
         self.search_index = self._create_or_get()
-        self.search_index.set_alpha(self._default_alpha())
         self.process = WordProcessor(k=1)
-        self.total_movies = Movies.objects.count()
+        # intermediate calibration results, only populated while calibrating
+        self.scratch = None
+        self.runs = []
+        self.total_movies = 0
 
     @staticmethod
     def _create_or_get():
@@ -77,11 +162,10 @@ class SearchIndexWrapper:
         Makes sure there is only one instance of SearchIndex
         :return: SearchIndex
         """
-        s_index = SearchIndex.objects.filter(id=1)
-        if s_index.first() is None:
-            return SearchIndex.objects.create(id=1)
-        else:
-            return s_index.first()
+        s_index = SearchIndex.objects.filter(id=1).first()
+        if s_index is None:
+            return SearchIndex.objects.create(id=1, alpha=SearchIndexWrapper._default_alpha())
+        return s_index
 
     @staticmethod
     def _default_alpha():
@@ -103,179 +187,306 @@ class SearchIndexWrapper:
         }
         return json.dumps(alpha)
 
-    def _tf(self, term_list):
-        """
-        turn the list into a dict where key = term and value = tf score
-        :param term_list: list of str
-        :return: dict(key=term:value=tf score)
-        """
-        # Can use collection.counter, but I want to implement counter
-        tf_scores = dict()
-        dec_con = Context(prec=6, rounding=ROUND_05UP)
-        for x in term_list:
-            if len(x) == 0 or len(x) == 1:
-                continue
-            term = x.lower()
-            tf_scores[term] = tf_scores[term] + 1 if tf_scores.get(term) else 1
-
-        for x, y in tf_scores.items():
-            term = x.lower()
-            tf_scores[term] = "{}".format(dec_con.create_decimal(_d(y) / _d(len(term_list))))
-
-        return tf_scores
-
-    def gen_term_freq(self):
-        """
-        For every movie, generate a dict of every term's frequency arranged by their corresponding alpha
-        TF(movie, term) = count of terms / total terms in movie
-        Final dict = {      movie_1:
-                                {   alpha_1:  ie Movie title more important than keyword
-                                        {   term_1: TermFrequency(),
-                                            term_2: ...
-                                        },
-                                    alpha_2: ..
-                                },
-                            movie_2: ...
-                        }
-        :return None
+    def _movie_terms(self, movie):
         """
-        term_freq_dict = dict()
-        movies = Movies.objects.all()
-        for movie in movies:
-            cast_char, cast_name = movie.get_cast()
-            movie_alpha = {
-                '0': self._tf(self.process.tokenize(movie.title)),  # Movie.title
-                '1': self._tf(self.process.tokenize(movie.original_title)),  # Movie.original_title
-                '2': self._tf(self.process.tokenize(movie.overview)),  # Movie.overview
-                '3': self._tf(self.process.tokenize(movie.tagline)),  # Movie.tagline
-                '4': self._tf(movie.get_genres()),  # Genre.name
-                '6': self._tf(self.process.tokenize_character(cast_char)),  # Cast.character
-                '7': self._tf(cast_name),  # Cast.name
-                '8': self._tf(movie.get_crew()),  # Crew.name
-                '9': self._tf(movie.get_keyword()),  # Keyword.name
-            }
-            term_freq_dict[movie.id] = movie_alpha
-        self.search_index.set_term_freq(json.dumps(term_freq_dict))
-
-    def gen_doc_freq(self):
-        """
-        For each term, count how many movies contains this term
-        DF(movie, term) = Total movies / (# of movies with term + 1)\
-        IDF(movie, term) = log(Df(movie,term))
-        doc_freq_dict = {   term_1: DF(),
-                            term_2: ...
-                        }
+        Tokenize every indexed field of a movie, keyed by the field's alpha
+        :param movie: corpus.MovieDocument
+        :return: dict(key=alpha:value=list of str)
+        """
+        return movie.terms(self.process)
+
+    def gen_term_freq(self, workers=1):
+        """
+        For every movie, count every term's frequency arranged by their corresponding alpha
+        TF(movie, alpha, term) = count of term / total terms in the movie's alpha field
+        Movies are read in chunks and every chunk is spilled to the scratch directory
+        as a run sorted by term, see calibration.py
+        :param workers: int, more than 1 spills shards of movies on a pool of processes
         :return None
         """
+        prefix = os.path.join(self.scratch, 'run')
+        if workers > 1:
+            self.runs, self.total_movies = spill_parallel(self.process, prefix, workers)
+        else:
+            self.runs, self.total_movies = spill_runs(self.process, prefix)
 
-        # Loading term freq since it contains a corpus with k-phrases
-        term_freq = self.search_index.get_term_freq()
-        df_dict = dict()
-        dec_con = Context(prec=6, rounding=ROUND_05UP)
-        for movie in term_freq:
-            # Collapse the dict so that for each movie, we have a set of unique k-phrases
-            movie_alpha = set(y for x in term_freq[movie].values() for y in x.keys())
-            # For each k-phrase, add it into df_dict as a key
-            # and as a value keep count how many times it appears
-            for term in movie_alpha:
-                df_dict[term] = df_dict[term] + 1 if df_dict.get(term) else 1
-
-        # df_dict should be populated with every unique k-phrase and the number movies that contain it
-        # Calculate the IDF() = log(total movies / documents with term + 1)
-        for term in df_dict:
-            dec_df_score = dec_con.create_decimal(log(_d(self.total_movies) / _d(df_dict[term])))
-            df_dict[term] = str(dec_df_score)
-
-        self.search_index.set_doc_freq(json.dumps(df_dict))
-
-    def gen_tfidf(self):
-        """
-        For every term, create a dict of movies and their tf-idf score
-        TFIDF(movie, term) = TF(movie, term) * log(DF(movie,term))
-        tfidf_dict = {  term_1:
-                            {   movie_1: TFIDF(),
-                                movie_2: ...
-                            },
-                        term_2: ...
-                    }
+    def gen_tfidf(self, workers=1):
+        """
+        Merge the runs a batch of terms at a time. For each term, count how many movies contains it
+        IDF(term) = log(total movies / # of movies with term)
+        TFIDF(movie, term) = sum over alpha of TF(movie, alpha, term) * IDF(term) * alpha
+        The postings are appended to a new binary segment as they are scored
+        :param workers: int, more than 1 merges ranges of terms on a pool of processes
         :return None
         """
-        doc_freq = self.search_index.get_doc_freq()
-        term_freq = self.search_index.get_term_freq()
-        alpha_dict = self.search_index.get_alpha()
-        dec_con = Context(prec=6, rounding=ROUND_05UP)
-
-        # Create a tfidf_dict to hold each term's tf-idf index of movies it appears in
-        tfidf_dict = dict()
-        for term in doc_freq:
-            tfidf_dict[term] = dict()
-
-        # Generate the tf-idf score for each movie and place them in the tfidf_dict
-        for movie in term_freq:
-            for alpha in term_freq[movie]:
-                for term in term_freq[movie][alpha]:
-                    # we are getting every term's individual score that corresponds to a movie
-                    term_tf = _d(term_freq[movie][alpha][term])
-                    term_idf = _d(doc_freq[term])
-                    term_alpha = _d(alpha_dict[alpha])
-                    # generate the term's score for the movie it appears in
-                    term_tf_idf = term_tf * term_idf * term_alpha
-                    # add this score to a tfidf dict that we can use to rank
-                    sum_term_tfidf = _d(tfidf_dict[term][movie]) + term_tf_idf if \
-                        tfidf_dict[term].get(movie) else \
-                        term_tf_idf
-                    tfidf_dict[term][movie] = str(dec_con.create_decimal(sum_term_tfidf))
-
-        self.search_index.set_tfidf(json.dumps(tfidf_dict))
-
-    def calibrate(self, print_info=False):
-        """
-        Generate the term_freq, doc_freq, and tfidf. Store results as string in DB
+        alpha = alpha_vector(self.search_index.get_alpha())
+        segment = new_segment_name('tfidf')
+        with SegmentWriter(os.path.join(index_dir(), segment), self.total_movies, alpha=alpha) as writer:
+            if workers > 1:
+                merge_parallel(self.runs, alpha, writer, workers, self.scratch)
+            else:
+                merge_runs(self.runs, alpha, writer)
+            merge_lengths(self.runs, writer)
+            write_snippets(writer)
+        # a full calibration covers every change made so far, it replaces the base and every delta
+        SegmentManager(self.search_index.id).reset(segment)
+        self.search_index.refresh_from_db()
+
+    def calibrate(self, print_info=False, workers=1):
+        """
+        Generate the term_freq, doc_freq, and tfidf. Store the tfidf postings as a segment file
+        Intermediate results are spilled to a scratch directory next to the index, so memory stays bounded
+        Stamps a new index version so cached copies in other processes are reloaded
+        :param print_info: boolean
+        :param workers: int, more than 1 shards the term frequencies and the merge across a pool of processes
         :return: boolean
         """
         print_info_str = ""
+        # weights set with set_alpha are kept, the postings are summed with them
+        if not self.search_index.get_alpha():
+            self.search_index.set_alpha(self._default_alpha())
+        # changes recorded from now on are not guaranteed to be read, they stay for the next update
+        last_change = IndexChangelog.objects.aggregate(last=Max('id'))['last']
+        os.makedirs(index_dir(), exist_ok=True)
+        self.scratch = tempfile.mkdtemp(prefix='calibrate_', dir=index_dir())
+        try:
+            # Gen term freq
+            start_time = time.time()
+            print_info_str += "{}\n\tTerm Frequency ({} workers)\n{}".format("#" * 30, workers, "#" * 30)
+            self.gen_term_freq(workers)
+            print_info_str += "Finished Term Frequency: {}".format(time.time() - start_time)
 
-        # Gen term freq
-        start_time = time.time()
-        print_info_str += "{}\n\tTerm Frequency\n{}".format("#" * 30, "#" * 30)
-        self.gen_term_freq()
-        print_info_str += "Finished Term Frequency: {}".format(time.time() - start_time)
-
-        # Gen doc freq
-        start_time = time.time()
-        print_info_str += "{}\n\tDoc Frequency\n{}".format("#" * 30, "#" * 30)
-        self.gen_doc_freq()
-        print_info_str += "Finished Doc Frequency: {}".format(time.time() - start_time)
+            # Gen doc freq and TFIDF
+            start_time = time.time()
+            print_info_str += "{}\n\tDoc Frequency & TF-IDF\n{}".format("#" * 30, "#" * 30)
+            self.gen_tfidf(workers)
+            print_info_str += "Finished Doc Frequency & TF-IDF: {}".format(time.time() - start_time)
+        finally:
+            # the intermediate results are not needed once the segment is written
+            shutil.rmtree(self.scratch, ignore_errors=True)
+            self.scratch = None
+            self.runs = []
 
-        # Gen TFIDF
-        start_time = time.time()
-        print_info_str += "{}\n\tTF-IDF\n{}".format("#" * 30, "#" * 30)
-        self.gen_tfidf()
-        print_info_str += "Finished TF-IDF: {}".format(time.time() - start_time)
+        if last_change is not None:
+            IndexChangelog.objects.filter(id__lte=last_change).delete()
 
         # Print info
         if print_info:
             print(print_info_str)
 
-    def lookup(self, query, limit=None):
+    def update(self, print_info=False):
+        """
+        Incremental update, re-index the movies in the changelog instead of the whole corpus
+        A new delta segment holds the current postings of the touched movies and the DF adjustments
+        of their terms, it is stacked on the other segments, see segments.py
+        Calibrates instead if the index was never calibrated
+        :param print_info: boolean
+        :return: None
+        """
+        if not self.search_index.is_calibrated():
+            return self.calibrate(print_info)
+        last_change = IndexChangelog.objects.aggregate(last=Max('id'))['last']
+        if last_change is None:
+            return
+
+        start_time = time.time()
+        touched = IndexChangelog.objects.filter(id__lte=last_change).values_list('movie_id', flat=True)
+        touched = np.unique(np.fromiter(touched.iterator(), dtype=np.int64))
+        manager = SegmentManager(self.search_index.id)
+        segments = manager.get_segments()
+        alpha = alpha_vector(self.search_index.get_alpha())
+        terms, ptr, doc_ids, weights, doc_freq, field_lengths = delta_postings(self.process, alpha,
+                                                                              manager.open(segments), touched)
+        delta = new_segment_name('delta')
+        with SegmentWriter(os.path.join(index_dir(), delta), Movies.objects.count(), touched, alpha) as writer:
+            writer.add(terms, ptr, doc_ids, weights, doc_freq=doc_freq)
+            writer.add_lengths(*field_lengths)
+            for first in range(0, len(touched), CHUNK_SIZE):
+                write_snippets(writer, Movies.objects.filter(id__in=touched[first:first + CHUNK_SIZE].tolist()))
+        if manager.append(delta, segments[0]):
+            IndexChangelog.objects.filter(id__lte=last_change).delete()
+        self.search_index.refresh_from_db()
+
+        if print_info:
+            print("{}\n\tIncremental Update\n{}".format("#" * 30, "#" * 30))
+            print("Movies re-indexed: {}".format(len(touched)))
+            print("Delta terms: {}".format(len(terms)))
+            print("Finished Incremental Update: {}".format(time.time() - start_time))
+
+    def lookup(self, query, limit=None, alpha=None, scorer=None):
         """
         Given a query, return ranked results
+        The results of frequent queries are cached until the index changes, see query_cache.py
+        :param limit: an int that limits the result amount
+        :param query: a str
+        :param alpha: dict(key=str field:value=weight), weights of this query only, the SearchIndex's by default
+        :param scorer: str, name of the scorer of this query, see scorers.py, settings.SEARCH_SCORER by default
+        :return: sorted list of Movie ids
+        """
+        return self.lookup_with_index(query, limit, alpha, scorer)[1]
+
+    def lookup_with_index(self, query, limit=None, alpha=None, scorer=None):
+        """
+        lookup, with the IndexView that ranked the results, to read their snippets from the same segments
+        :param query: a str
+        :param limit: an int that limits the result amount
+        :param alpha: dict(key=str field:value=weight), weights of this query only, the SearchIndex's by default
+        :param scorer: str, name of the scorer of this query, see scorers.py, settings.SEARCH_SCORER by default
+        :return: (IndexView, None if no index is loaded, sorted list of Movie ids)
+        """
+        start_time = time.perf_counter()
+        index, results = self._ranked(query, limit, alpha, scorer)
+        query_cache.record_latency(time.perf_counter() - start_time)
+        return index, results.tolist()
+
+    def lookup_many(self, queries, limit=None, batch_size=BATCH_QUERIES, alpha=None, scorer=None):
+        """
+        Given many queries, return the ranked results of each, for offline jobs
+        The queries are tokenized and scored batch_size at a time, every posting list is read and decoded once
+        per batch, see scoring.score_batch. The query cache is bypassed
+        :param queries: iterable of str
         :param limit: an int that limits the result amount
+        :param batch_size: int, queries scored together
+        :param alpha: dict(key=str field:value=weight), weights of these queries only, the SearchIndex's by default
+        :param scorer: str, name of the scorer of these queries, see scorers.py, settings.SEARCH_SCORER by default
+        :return: generator of sorted lists of Movie ids, one per query in order
+        """
+        index = loaded_index.get(self.search_index.id)
+        index = None if index is None else get_scorer(index, scorer)
+        weights = None if alpha is None else alpha_vector(alpha)
+        queries = iter(queries)
+        while True:
+            batch = [self.process.tokenize(query) for query in itertools.islice(queries, batch_size)]
+            if not batch:
+                return
+            if index is None:
+                yield from ([] for _ in batch)
+            else:
+                yield from score_batch(index, batch, limit or None, weights)
+
+    def lookup_page(self, query, page=1, per_page=10, alpha=None, scorer=None):
+        """
+        Given a query, return a page of ranked results
+        The first page only ranks its movies, the following pages are sliced from the full ranking of the query,
+        scored once and cached for a short while, see query_cache.py
         :param query: a str
+        :param page: int, from 1
+        :param per_page: int
+        :param alpha: dict(key=str field:value=weight), weights of this query only, the SearchIndex's by default
+        :param scorer: str, name of the scorer of this query, see scorers.py, settings.SEARCH_SCORER by default
+        :return: (list of Movie ids, bool True if there is a next page)
+        """
+        return self.lookup_page_with_index(query, page, per_page, alpha, scorer)[1:]
+
+    def lookup_page_with_index(self, query, page=1, per_page=10, alpha=None, scorer=None):
+        """
+        lookup_page, with the IndexView that ranked the page, to read its snippets from the same segments
+        :param query: a str
+        :param page: int, from 1
+        :param per_page: int
+        :param alpha: dict(key=str field:value=weight), weights of this query only, the SearchIndex's by default
+        :param scorer: str, name of the scorer of this query, see scorers.py, settings.SEARCH_SCORER by default
+        :return: (IndexView, None if no index is loaded, list of Movie ids, bool True if there is a next page)
+        """
+        start_time = time.perf_counter()
+        offset = (page - 1) * per_page
+        if offset:
+            index, results = self._ranked(query, alpha=alpha, scorer=scorer)
+            results = results[offset:offset + per_page + 1].tolist()
+        else:
+            # one more result tells whether there is a next page
+            index, results = self._ranked(query, per_page + 1, alpha, scorer)
+            results = results.tolist()
+        query_cache.record_latency(time.perf_counter() - start_time)
+        return index, results[:per_page], len(results) > per_page
+
+    def _ranked(self, query, limit=None, alpha=None, scorer=None):
+        """
+        Ranked results of a query, from the query cache
+        :param query: a str
+        :param limit: an int that limits the result amount
+        :param alpha: dict(key=str field:value=weight), None for the SearchIndex's weights
+        :param scorer: str, name of the scorer, None for settings.SEARCH_SCORER
+        :return: (IndexView the results were ranked with, None if no index is loaded, numpy array of Movie ids)
+        """
+        # get the tf-idf segment, loaded once per process
+        version, index = loaded_index.get_versioned(self.search_index.id)
+        if index is None:
+            return None, np.zeros(0, dtype=np.int64)
+        tokens = self.process.tokenize(query)
+        weights = None if alpha is None else alpha_vector(alpha)
+        scorer = scorer or default_scorer()
+        ranker = get_scorer(index, scorer)
+        return index, query_cache.get_or_rank(self.search_index.id, version, tokens, limit or None,
+                                              lambda: np.array(self._rank(ranker, tokens, limit, weights),
+                                                               dtype=np.int64),
+                                              alpha, scorer)
+
+    def search(self, query, limit=None, alpha=None, scorer=None):
+        """
+        Given a query, return the ranked results a search page shows
+        Read from the snippets stored in the index, without a query when every result has one
+        :param query: a str
+        :param limit: an int that limits the result amount
+        :param alpha: dict(key=str field:value=weight), weights of this query only, the SearchIndex's by default
+        :param scorer: str, name of the scorer of this query, see scorers.py, settings.SEARCH_SCORER by default
+        :return: list of dict(id, title, snippet), in rank order
+        """
+        index, results = self.lookup_with_index(query, limit, alpha, scorer)
+        return hydrate(results, index)
+
+    def search_page(self, query, page=1, per_page=10, alpha=None, scorer=None):
+        """
+        Given a query, return a page of the ranked results a search page shows
+        :param query: a str
+        :param page: int, from 1
+        :param per_page: int
+        :param alpha: dict(key=str field:value=weight), weights of this query only, the SearchIndex's by default
+        :param scorer: str, name of the scorer of this query, see scorers.py, settings.SEARCH_SCORER by default
+        :return: (list of dict(id, title, snippet) in rank order, bool True if there is a next page)
+        """
+        index, results, has_next = self.lookup_page_with_index(query, page, per_page, alpha, scorer)
+        return hydrate(results, index), has_next
+
+    def suggest(self, query, limit=5):
+        """
+        Search as you type, complete the last word of the query with the indexed terms most movies have
+        and return the top results of the best completion
+        :param query: a str, as typed so far
+        :param limit: an int that limits the completions and the results
+        :return: dict(key=completions:value=list of str queries, key=results:value=list of dict(id, title, snippet))
+        """
+        index = loaded_index.get(self.search_index.id)
+        words = self.process.special_chars.sub("", query.lower()).split()
+        if index is None or not words:
+            return {'completions': [], 'results': []}
+        head = words[:-1]
+        completions = []
+        if not query[-1].isspace():
+            # the last word is still being typed
+            completions = [" ".join(head + [term]) for term, _ in index.complete(words[-1], limit)]
+        best = completions[0] if completions else " ".join(words)
+        return {'completions': completions, 'results': self.search(best, limit)}
+
+    @staticmethod
+    def _rank(index, tokens, limit=None, alpha=None):
+        """
+        Score the movies of the tokenized query
+        :param index: scoring.IndexView, or another scorer, see scorers.py
+        :param tokens: list of str
+        :param limit: an int that limits the result amount
+        :param alpha: numpy array indexed by field, None for the index's weights
         :return: sorted list of Movie ids
         """
-        # get the tf-idf index
-        index = self.search_index.get_tfidf()
-        # create the ranked results
-        ranked_results = dict()
-        # tokenize the query
-        for term in self.process.tokenize(query):
-            movie_term_results = index.get(term)
-            if movie_term_results:
-                for movie, score in movie_term_results.items():
-                    # for every movie that appears for the query, collect the tf-idf score
-                    ranked_results[int(movie)] = _d(ranked_results[int(movie)]) + _d(score) if \
-                        ranked_results.get(int(movie)) else \
-                        _d(score)
+        # find every indexed term
+        terms = [index.find(term, alpha) for term in tokens]
+        terms = [x for x in terms if x is not None]
+        if not terms:
+            return []
+        if limit:
+            # only the top results are needed, skip the postings that cannot reach them
+            return top_k(index, terms, limit)
+        # for every movie that appears for the query, sum the tf-idf scores
+        movies, scores = score_postings([index.postings(x) for x in terms])
         # return a list of movie ids sorted by tf-idf score
-        return sorted(ranked_results, key=lambda x: ranked_results.get(x), reverse=True)[:limit]
+        return rank(movies, scores)
@@ -0,0 +1,230 @@
+from django.db import connection, transaction
+from .models import SearchIndex
+from .postings import Segment, SegmentWriter, index_dir, merge_segments
+from .scoring import IndexView
+import numpy as np
+import threading
+import uuid
+import os
+
+
+# Segment manager, LSM-style
+#
+# The index is a stack of immutable segment files listed in SearchIndex.segments, oldest first:
+# the base calibration, then one delta segment per incremental update. Every lookup visits every
+# segment, so a size-tiered merge policy keeps their number low: consecutive segments of the same
+# size tier are merged into one once there are SEGMENTS_PER_TIER of them. Merged segments are swapped
+# in atomically, readers only see the new list once the merged file is complete.
+
+# segments smaller than TIER_FLOOR bytes are in the first tier, each tier holds segments up to
+# TIER_FACTOR times larger than the previous one
+TIER_FLOOR = 1 << 16
+TIER_FACTOR = 4
+SEGMENTS_PER_TIER = 4
+# above this many segments the cheapest run of SEGMENTS_PER_TIER segments is merged whatever their tiers
+MAX_SEGMENTS = 12
+
+
+def new_segment_name(kind):
+    """
+    Unique file name for a segment, segments are never overwritten
+    :param kind: str, 'tfidf' for a calibration, 'delta' for an update, 'merged' for a compaction
+    :return: str
+    """
+    return "{}_{}.sidx".format(kind, uuid.uuid4().hex)
+
+
+def size_tier(size):
+    """
+    Size tier of a segment
+    :param size: int, bytes
+    :return: int
+    """
+    tier = 0
+    while size >= TIER_FLOOR * TIER_FACTOR ** tier:
+        tier += 1
+    return tier
+
+
+def plan_merge(sizes):
+    """
+    Size-tiered merge policy, merges only ever combine consecutive segments
+    :param sizes: list of segment sizes in bytes, oldest first
+    :return: (start, end) the segments[start:end] to merge, None if nothing needs merging
+    """
+    tiers = [size_tier(size) for size in sizes]
+    # the newest segments are the smallest, look for a full tier from the newest down
+    end = len(sizes)
+    while end > 0:
+        start = end - 1
+        while start > 0 and tiers[start - 1] == tiers[end - 1]:
+            start -= 1
+        if end - start >= SEGMENTS_PER_TIER:
+            return start, end
+        end = start
+    if len(sizes) > MAX_SEGMENTS:
+        # tiers out of order never fill up, merge the smallest window instead
+        windows = [sum(sizes[i:i + SEGMENTS_PER_TIER]) for i in range(len(sizes) - SEGMENTS_PER_TIER + 1)]
+        start = windows.index(min(windows))
+        return start, start + SEGMENTS_PER_TIER
+    return None
+
+
+class SegmentManager:
+    """
+    Tracks the immutable segments of a SearchIndex and swaps them atomically
+    Every swap stamps a new SearchIndex.version so processes remap the segments
+    """
+
+    def __init__(self, search_index_id=1):
+        self.search_index_id = search_index_id
+
+    def get_segments(self):
+        """
+        :return: list of str segment files, oldest first
+        """
+        return SearchIndex.objects.get(id=self.search_index_id).get_segments()
+
+    def open(self, segments=None, alpha=None):
+        """
+        Memory-map the segments
+        :param segments: list of str, the current segments by default
+        :param alpha: numpy array indexed by field, the default weights of the lookups, see scoring.IndexView
+        :return: IndexView, None if there are no segments
+        """
+        segments = self.get_segments() if segments is None else segments
+        if not segments:
+            return None
+        return IndexView([Segment.open(os.path.join(index_dir(), segment)) for segment in segments], alpha)
+
+    def _swap(self, old, new):
+        """
+        Replace a run of consecutive segments, unless the list changed in a way that invalidates the swap
+        :param old: list of str, the segments to replace, empty to replace every segment
+        :param new: list of str, their replacement
+        :return: bool, True if the segments were swapped
+        """
+        with transaction.atomic():
+            s_index = SearchIndex.objects.select_for_update().get(id=self.search_index_id)
+            segments = s_index.get_segments()
+            if old:
+                start = segments.index(old[0]) if old[0] in segments else -1
+                if start < 0 or segments[start:start + len(old)] != old:
+                    return False
+                segments[start:start + len(old)] = new
+            else:
+                old, segments = segments, new
+            s_index.set_segments(segments)
+            s_index.bump_version()
+        self._remove([x for x in old if x not in segments])
+        return True
+
+    @staticmethod
+    def _remove(segments):
+        """
+        Remove segment files no longer listed
+        :param segments: list of str
+        :return: None
+        """
+        for segment in segments:
+            path = os.path.join(index_dir(), segment)
+            # processes still mapping the old segment keep reading it until they remap
+            if os.path.isfile(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    # windows refuses to remove a file that is still mapped
+                    pass
+
+    def reset(self, segment):
+        """
+        Replace every segment with a new base calibration
+        :param segment: str
+        :return: None
+        """
+        self._swap([], [segment])
+
+    def append(self, segment, base):
+        """
+        Add a delta segment on top of the others
+        :param segment: str
+        :param base: str, base segment the delta was computed against
+        :return: bool, False if a calibration replaced the base meanwhile, the delta is then dropped
+        """
+        with transaction.atomic():
+            s_index = SearchIndex.objects.select_for_update().get(id=self.search_index_id)
+            segments = s_index.get_segments()
+            if not segments or segments[0] != base:
+                self._remove([segment])
+                return False
+            s_index.set_segments(segments + [segment])
+            s_index.bump_version()
+        return True
+
+    def merge(self, segments, base):
+        """
+        Merge consecutive segments into a new segment file
+        :param segments: list of str, oldest first
+        :param base: bool, True if the first segment is the base segment
+        :return: str, the merged segment
+        """
+        opened = [Segment.open(os.path.join(index_dir(), segment)) for segment in segments]
+        masked_ids = [] if base else np.concatenate([segment.masked_ids for segment in opened])
+        merged = new_segment_name('tfidf' if base else 'merged')
+        with SegmentWriter(os.path.join(index_dir(), merged), opened[-1].total_movies, masked_ids) as writer:
+            merge_segments(opened, writer, base)
+        return merged
+
+    def compact(self, full=False):
+        """
+        Run the merge policy until no merge is needed
+        :param full: bool, merge every segment into a single base segment
+        :return: int, number of merges
+        """
+        merges = 0
+        while True:
+            segments = self.get_segments()
+            paths = [os.path.join(index_dir(), segment) for segment in segments]
+            if full:
+                plan = (0, len(segments)) if len(segments) > 1 else None
+            else:
+                plan = plan_merge([os.path.getsize(path) for path in paths])
+            if plan is None:
+                return merges
+            start, end = plan
+            merged = self.merge(segments[start:end], start == 0)
+            if not self._swap(segments[start:end], [merged]):
+                # a calibration replaced the segments meanwhile
+                self._remove([merged])
+                return merges
+            merges += 1
+            full = False
+
+
+class Compactor(threading.Thread):
+    """
+    Background thread compacting the index every interval seconds
+    """
+
+    def __init__(self, manager, interval):
+        super().__init__(daemon=True)
+        self.manager = manager
+        self.interval = interval
+        self.merges = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                self.merges += self.manager.compact()
+                self._stop_event.wait(self.interval)
+        finally:
+            # the thread opened its own database connection
+            connection.close()
+
+    def stop(self):
+        """
+        Stop after the current compaction
+        :return: None
+        """
+        self._stop_event.set()
@@ -1,8 +1,49 @@
-from django.core.management import call_command
-from django.test import TestCase, TransactionTestCase
-from results.models import Movies, MovieGenres, ProductionCompanies, Keywords, SearchIndex, Casts, Crews
-from results.search_index import SearchIndexWrapper
+from django.core.management import call_command, CommandError
+from django.core.cache import caches
+from django.test import TestCase, TransactionTestCase, AsyncRequestFactory, override_settings
+from results.models import Movies, MovieGenres, ProductionCompanies, Keywords, SearchIndex, Casts, Crews, \
+    IndexChangelog, IngestCheckpoint
+from results.search_index import SearchIndexWrapper, WordProcessor, loaded_index
+from results.query_cache import query_cache
+from results.hydration import hydrate, ahydrate, SNIPPET_LENGTH
+from results import views
+from results.corpus import iter_chunks, iter_movies
+from results.postings import Segment, SegmentWriter, encode_varint, decode_varint, write_segment, write_postings
+from results.scoring import TermFrequencies, score_postings, rank, top_k, term_postings, alpha_vector, score_batch, \
+    SharedPostings
+from results.calibration import spill_runs, spill_shards, merge_runs, shard_ranges
+from results.changelog import record_changes
+from results.segments import SegmentManager, plan_merge, TIER_FLOOR
+from results.scorers import get_scorer
+from results.management.commands.load_file import Command
+from results.management.commands.benchmark_tokenizer import BaselineWordProcessor, Command as BenchmarkTokenizer
+from results.ingest import parse_literals, parse_column
 from os import path
+from decimal import Decimal as _d, Context, ROUND_05UP
+from math import log
+import pandas as pd
+import ast
+import numpy as np
+import tempfile
+import shutil
+import json
+import io
+import time
+
+
+def use_test_index_dir(test_case):
+    """
+    Write the segments of a test to its own scratch directory instead of the app directory,
+    SEARCH_INDEX_DIR points there until the test ends and the directory is then removed
+    :param test_case: TestCase, call from setUp
+    :return: str, the directory
+    """
+    index_dir = tempfile.mkdtemp(prefix='searchindex_test_')
+    test_case.addCleanup(shutil.rmtree, index_dir, ignore_errors=True)
+    index_settings = override_settings(SEARCH_INDEX_DIR=index_dir)
+    index_settings.enable()
+    test_case.addCleanup(index_settings.disable)
+    return index_dir
 
 
 ##############################
@@ -224,6 +265,183 @@ class CommandsTestCase(TransactionTestCase):
         self.assertIsNot(m_crew.count(), 0)
 
 
+##############################
+#   Test Bulk Loader
+##############################
+class LoadFileTestCase(TestCase):
+    """
+    Test the bulk inserts of manage.py load_file on a small dataset written to a temporary directory
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        movies = {column: [""] * 3 for column in Command._accepted_columns[3]}
+        movies.update(id=[862, 'not-an-id', 8844], title=["Toy Story", "Broken", "Jumanji"],
+                      original_title=["Toy Story", "Broken", "Jumanji"], overview=["Toys", "", "A game"],
+                      tagline=["", "", "Roll the dice"],
+                      genres=["[{'id': 16, 'name': 'Animation'}, {'id': 35, 'name': 'Comedy'}]", "[]",
+                              "[{'id': 35, 'name': 'Comedy'}, {'id': 35, 'name': 'Comedy'}]"],
+                      production_companies=["[{'name': 'Pixar', 'id': 3}]", "[]", ""])
+        keywords = {'id': [862, 8844, 9999], 'keywords': ["[{'id': 931, 'name': 'jealousy'}]",
+                                                          "[{'id': 931, 'name': 'jealousy'}]",
+                                                          "[{'id': 1, 'name': 'unknown movie'}]"]}
+        credits = {'cast': ["[{'cast_id': 14, 'character': 'Woody', 'id': 31, 'name': 'Tom Hanks'}]",
+                            "[{'cast_id': 1, 'character': 'Alan', 'id': 2157, 'name': 'Robin Williams'}]"],
+                   'crew': ["[{'department': 'Directing', 'id': 7879, 'job': 'Director', 'name': 'John Lasseter'},"
+                            " {'department': 'Writing', 'id': 7879, 'job': 'Screenplay', 'name': 'John Lasseter'}]",
+                            "[]"],
+                   'id': [862, 8844]}
+        files = dict()
+        for name, data in [('movies', movies), ('keywords', keywords), ('credits', credits)]:
+            files[name] = path.join(self.dir, name + '.csv')
+            pd.DataFrame(data).to_csv(files[name], index=False)
+        self.credits = credits
+        self.args = ["--{}={}".format(name, file) for name, file in files.items()]
+        call_command('load_file', *self.args)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_load_file_relations(self):
+        """
+        Entities are deduplicated and linked to every movie that lists them
+        :return: None
+        """
+        self.assertEquals(sorted(Movies.objects.values_list('id', flat=True)), [862, 8844])
+        self.assertEquals(sorted(Movies.objects.get(id=862).moviegenres_set.values_list('id', flat=True)), [16, 35])
+        self.assertEquals(list(Movies.objects.get(id=8844).moviegenres_set.values_list('id', flat=True)), [35])
+        self.assertEquals(MovieGenres.objects.count(), 2)
+        self.assertEquals(list(ProductionCompanies.objects.values_list('name', flat=True)), ['Pixar'])
+        # keywords of movies that were not loaded are skipped
+        self.assertEquals(list(Keywords.objects.values_list('id', flat=True)), [931])
+        self.assertEquals(Keywords.objects.get(id=931).movies.count(), 2)
+        self.assertEquals(Movies.objects.get(id=8844).casts_set.first().name, "Robin Williams")
+        # the first occurrence of a crew member wins
+        self.assertEquals(Crews.objects.get(id=7879).job, "Director")
+        self.assertEquals(Movies.objects.get(id=862).crews_set.count(), 1)
+
+    def _tables(self):
+        """
+        Every loaded row, to compare loads
+        :return: list of lists of tuples
+        """
+        tables = [Movies.objects.values_list('id', 'title', 'overview', 'tagline')]
+        for model in [MovieGenres, ProductionCompanies, Keywords, Casts, Crews]:
+            tables.append(model.objects.values_list(*[field.attname for field in model._meta.concrete_fields]))
+            tables.append(model.movies.through.objects.values_list('movies_id', model._meta.model_name + '_id'))
+        return [sorted(table) for table in tables]
+
+    def test_load_file_chunksize(self):
+        """
+        Streaming the files a few rows at a time loads the same rows
+        :return: None
+        """
+        loaded = self._tables()
+        for model in [Movies, MovieGenres, ProductionCompanies, Keywords, Casts, Crews]:
+            model.objects.all().delete()
+        call_command('load_file', '--chunksize=1', *self.args)
+        self.assertEquals(self._tables(), loaded)
+
+    def test_load_file_resume(self):
+        """
+        A failed chunk is rolled back, --resume loads it without reloading the chunks committed before it
+        :return: None
+        """
+        loaded = self._tables()
+        for model in [Movies, MovieGenres, ProductionCompanies, Keywords, Casts, Crews]:
+            model.objects.all().delete()
+        credits = path.join(self.dir, 'credits.csv')
+        broken = dict(self.credits, cast=[self.credits['cast'][0], "[{'id': 2157, 'name': 'Robin"])
+        pd.DataFrame(broken).to_csv(credits, index=False)
+        with self.assertRaises(CommandError):
+            call_command('load_file', '--chunksize=1', *self.args)
+        self.assertEquals(sorted(IngestCheckpoint.objects.filter(file='credits').values_list('chunk', flat=True)), [0])
+        self.assertEquals(Movies.objects.get(id=862).casts_set.count(), 1)
+        self.assertEquals(Movies.objects.get(id=8844).casts_set.count(), 0)
+
+        pd.DataFrame(self.credits).to_csv(credits, index=False)
+        Movies.objects.filter(id=862).update(title="Loaded before the failure")
+        call_command('load_file', '--chunksize=1', '--resume', *self.args)
+        self.assertEquals(Movies.objects.get(id=862).title, "Loaded before the failure")
+        Movies.objects.filter(id=862).update(title="Toy Story")
+        self.assertEquals(self._tables(), loaded)
+        # resuming with other chunks would skip the wrong rows
+        with self.assertRaises(CommandError):
+            call_command('load_file', '--chunksize=2', '--resume', *self.args)
+
+    def test_load_file_changelog(self):
+        """
+        Bulk inserts send no signals, the loaded movies are recorded for the incremental index update
+        :return: None
+        """
+        self.assertEquals(sorted(set(IndexChangelog.objects.values_list('movie_id', flat=True))), [862, 8844])
+
+
+class ParallelLoadFileTestCase(TransactionTestCase):
+    """
+    Test manage.py load_file --workers, the relation families are loaded on threads with their own connections
+    """
+
+    setUp = LoadFileTestCase.setUp
+    tearDown = LoadFileTestCase.tearDown
+    _tables = LoadFileTestCase._tables
+
+    def test_load_file_workers(self):
+        """
+        Loading the relations concurrently loads the same rows
+        :return: None
+        """
+        loaded = self._tables()
+        for model in [Movies, MovieGenres, ProductionCompanies, Keywords, Casts, Crews]:
+            model.objects.all().delete()
+        call_command('load_file', '--workers=2', '--chunksize=1', *self.args)
+        self.assertEquals(self._tables(), loaded)
+        self.assertEquals(IngestCheckpoint.objects.filter(file='credits').count(), 2)
+
+
+##############################
+#   Test List Column Parser
+##############################
+class IngestTestCase(TestCase):
+    """
+    Test ingest.py
+    """
+
+    rows = [
+        "[{'id': 16, 'name': 'Animation'}, {'id': 35, 'name': 'Comedy'}]",
+        "",
+        "[]",
+        "[{'cast_id': 14, 'character': \"Woody's Roundup\", 'id': 31, 'name': 'Tom Hanks', 'profile_path': None}]",
+        "[{'id': 1, 'name': 'None of \"Them\": None', 'adult': False, 'video': True, 'popularity': -1.5e3}]",
+        "[{'id': 2, 'name': 'It\\'s \"x\"\\xa0\\n', 'job': \"'n'\"}, {'id': 3, 'name': '', 'job': '\\\\'}]",
+    ]
+
+    def test_ingest_parse_literals(self):
+        """
+        Rows parse to the same values as ast.literal_eval without going through it
+        :return: None
+        """
+        parsed, fallbacks = parse_literals(self.rows)
+        self.assertEquals(parsed, [ast.literal_eval(row) if row else [] for row in self.rows])
+        self.assertEquals(fallbacks, 0)
+        # python literals that have no JSON equivalent fall back to literal_eval, row by row
+        parsed, fallbacks = parse_literals([self.rows[0], "[{'id': 4, 'tags': (1, 2)}]", "[{1: 'x'}]"])
+        self.assertEquals(parsed, [ast.literal_eval(self.rows[0]), [{'id': 4, 'tags': (1, 2)}], [{1: 'x'}]])
+        self.assertEquals(fallbacks, 2)
+
+    def test_ingest_parse_column(self):
+        """
+        Chunks are parsed into one list of values per field
+        :return: None
+        """
+        lengths, columns, fallbacks = parse_column(self.rows, ['id', 'name'], chunk_size=2)
+        self.assertEquals(lengths.tolist(), [2, 0, 0, 1, 1, 2])
+        self.assertEquals(columns['id'], [16, 35, 31, 1, 2, 3])
+        self.assertEquals(columns['name'], ['Animation', 'Comedy', 'Tom Hanks', 'None of "Them": None',
+                                            'It\'s "x"\xa0\n', ''])
+        self.assertEquals(fallbacks, 0)
+
+
 ##############################
 #   Test Search Index Wrapper
 ##############################
@@ -233,6 +451,7 @@ class SearchIndexTestCase(TransactionTestCase):
     """
 
     def setUp(self):
+        self.index_dir = use_test_index_dir(self)
         args = [
             '--movies=C:\\Users\\fujus\\Documents\\searchindex_project\\dataset\\movies_metadata_test.csv',
             '--keywords=C:\\Users\\fujus\\Documents\\searchindex_project\\dataset\\keywords_test.csv',
@@ -258,9 +477,8 @@ class SearchIndexTestCase(TransactionTestCase):
         :return: None
         """
         search_index_obj = self.index.search_index
-        self.assertIsNot(len(search_index_obj.get_term_freq()), 0)
-        self.assertIsNot(len(search_index_obj.get_doc_freq()), 0)
-        self.assertIsNot(len(search_index_obj.get_tfidf()), 0)
+        self.assertTrue(search_index_obj.is_calibrated())
+        self.assertIsNot(len(Segment.load(search_index_obj.get_segment_path())), 0)
 
     def test_search_index_ranked_results(self):
         """
@@ -276,3 +494,1114 @@ class SearchIndexTestCase(TransactionTestCase):
         # Search Actor Name
         results_actor = self.index.lookup("Tom Hanks")
         self.assertEquals(results_actor, ['862'])
+
+
+##############################
+#   Test Corpus Loader
+##############################
+class CorpusTestCase(TestCase):
+    """
+    Test the bulk corpus loader in corpus.py
+    """
+
+    def setUp(self):
+        for i in range(1, 6):
+            movie = Movies.objects.create(id=i * 10, original_title="Movie {}".format(i), overview="",
+                                          tagline="", title="The movie {}".format(i))
+            movie.moviegenres_set.add(MovieGenres.objects.create(name="genre {}".format(i)))
+            movie.casts_set.add(Casts.objects.create(character="Character {}".format(i), name="Actor {}".format(i)))
+            movie.crews_set.add(Crews.objects.create(department="directing", name="crew {}".format(i), job="director"))
+            if i % 2:
+                movie.keywords_set.add(Keywords.objects.create(name="keyword {}".format(i)))
+        Movies.objects.get(id=10).casts_set.add(Casts.objects.get(name="Actor 2"))
+
+    def test_corpus_matches_models(self):
+        """
+        Every movie gets the same relations as the model helpers return
+        :return: None
+        """
+        documents = list(iter_movies(chunk_size=2))
+        self.assertEquals([x.id for x in documents], [10, 20, 30, 40, 50])
+        for document in documents:
+            movie = Movies.objects.get(id=document.id)
+            cast_char, cast_name = movie.get_cast()
+            self.assertEquals(document.title, movie.title)
+            self.assertEquals(sorted(document.genres), sorted(movie.get_genres()))
+            self.assertEquals(sorted(document.cast_characters), sorted(cast_char))
+            self.assertEquals(sorted(document.cast_names), sorted(cast_name))
+            self.assertEquals(sorted(document.crew), sorted(movie.get_crew()))
+            self.assertEquals(sorted(document.keywords), sorted(movie.get_keyword()))
+
+    def test_corpus_queries(self):
+        """
+        A chunk costs one query per relation, however many movies it holds
+        :return: None
+        """
+        with self.assertNumQueries(5):
+            chunks = list(iter_chunks(chunk_size=100))
+        self.assertEquals(len(chunks), 1)
+        self.assertEquals(len(chunks[0]), 5)
+
+
+##############################
+#   Test Word Processor
+##############################
+class WordProcessorTestCase(TestCase):
+    """
+    Test the tokenizer in search_index.py
+    """
+
+    def test_word_processor_tokenize(self):
+        """
+        Special characters are removed and stop words are dropped whatever their case
+        :return: None
+        """
+        process = WordProcessor(k=1)
+        self.assertEquals(process.tokenize("The Man  who  Loved Spider-Man's toys!"),
+                          ['man', 'loved', 'spidermans', 'toys'])
+        self.assertEquals(process.tokenize(""), [])
+
+    def test_word_processor_k_phrases(self):
+        """
+        Phrases of every length up to k follow the single words, in text order
+        :return: None
+        """
+        process = WordProcessor(k=3)
+        self.assertEquals(process.tokenize("Buzz Lightyear to the rescue"),
+                          ['buzz', 'lightyear', 'rescue', 'buzz lightyear', 'lightyear rescue',
+                           'buzz lightyear rescue'])
+
+    def test_word_processor_baseline(self):
+        """
+        The benchmark's baseline tokenizer only differs by the stop words it kept and its empty words
+        :return: None
+        """
+        overviews = ["The Man  who  Loved Spider-Man's toys!", "Buzz Lightyear to the rescue", ""]
+        self.assertEquals(BaselineWordProcessor(k=1).tokenize(overviews[0]),
+                          ['the', 'man', '', '', 'loved', 'spidermans', 'toys'])
+        self.assertEquals(BenchmarkTokenizer._mismatches(overviews), [])
+        self.assertEquals(BenchmarkTokenizer._mismatches(["Buzz\nLightyear"]), ["Buzz\nLightyear"])
+
+
+##############################
+#   Test Loaded Index Cache
+##############################
+class LoadedIndexTestCase(TestCase):
+    """
+    Test the process-wide index cache in search_index.py
+    """
+
+    def setUp(self):
+        self.index_dir = use_test_index_dir(self)
+        mov1 = Movies.objects.create(id=1, original_title="Space Cowboy", overview="A cowboy lost in space.",
+                                     tagline="", title="Space Cowboy")
+        Movies.objects.create(id=2, original_title="River House", overview="A family moves into a house.",
+                              tagline="", title="River House")
+        mov1.keywords_set.add(Keywords.objects.create(name='space'))
+        loaded_index.clear()
+        SearchIndexWrapper().calibrate()
+
+    def test_loaded_index_wrapper_no_writes(self):
+        """
+        Building a wrapper per request only reads the SearchIndex row
+        :return: None
+        """
+        with self.assertNumQueries(1):
+            SearchIndexWrapper()
+
+    def test_loaded_index_reused(self):
+        """
+        The tf-idf segment is loaded once and only the version is checked afterwards
+        :return: None
+        """
+        index = SearchIndexWrapper()
+        self.assertEquals(index.lookup("cowboy"), [1])
+        cached = loaded_index.segment
+        with self.assertNumQueries(1):
+            self.assertEquals(index.lookup("space"), [1])
+        self.assertIs(loaded_index.segment, cached)
+
+    def test_loaded_index_reload_on_calibrate(self):
+        """
+        A new calibration invalidates the cached index
+        :return: None
+        """
+        index = SearchIndexWrapper()
+        self.assertEquals(index.lookup("robot"), [])
+        Movies.objects.create(id=3, original_title="Robot", overview="", tagline="", title="Robot")
+        index.calibrate()
+        self.assertEquals(index.lookup("robot"), [3])
+
+
+##############################
+#   Test Query Cache
+##############################
+class QueryCacheTestCase(TestCase):
+    """
+    Test the cache of ranked results in query_cache.py
+    """
+
+    def setUp(self):
+        self.index_dir = use_test_index_dir(self)
+        Movies.objects.create(id=1, original_title="Space Cowboy", overview="A cowboy lost in space.",
+                              tagline="", title="Space Cowboy")
+        Movies.objects.create(id=2, original_title="River House", overview="A cowboy moves into a house.",
+                              tagline="", title="River House")
+        loaded_index.clear()
+        SearchIndexWrapper().calibrate()
+
+    def test_query_cache_hits(self):
+        """
+        Queries with the same tokens and limit are ranked once
+        :return: None
+        """
+        index = SearchIndexWrapper()
+        self.assertEquals(index.lookup("cowboy", limit=10), [1, 2])
+        self.assertEquals(index.lookup("The COWBOY!", limit=10), [1, 2])
+        self.assertEquals(index.lookup("cowboy"), [1, 2])
+        stats = query_cache.stats()
+        self.assertEquals((stats['hits'], stats['misses'], stats['lookups']), (1, 2, 3))
+        self.assertEquals(stats['hit_rate'], 1 / 3)
+
+    def test_query_cache_invalidated_on_calibrate(self):
+        """
+        A new index version is never served the results of the previous one
+        :return: None
+        """
+        index = SearchIndexWrapper()
+        self.assertEquals(index.lookup("robot"), [])
+        Movies.objects.create(id=3, original_title="Robot", overview="", tagline="", title="Robot")
+        index.calibrate()
+        self.assertEquals(index.lookup("robot"), [3])
+        self.assertEquals(query_cache.stats()['hits'], 0)
+
+    @override_settings(CACHES={'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                          'LOCATION': 'results-tests-shared', 'TIMEOUT': 3600}},
+                       SEARCH_CACHE='shared', SEARCH_CACHE_TIMEOUT=5, SEARCH_PAGES_TIMEOUT=2)
+    def test_query_cache_timeout(self):
+        """
+        A shared alias keeps the results SEARCH_CACHE_TIMEOUT seconds, not the alias's TIMEOUT
+        :return: None
+        """
+        index = SearchIndexWrapper()
+        index.lookup("cowboy", limit=10)
+        index.lookup("cowboy")
+        cache = caches['shared']
+        version = index.search_index.version
+        tokens = index.process.tokenize("cowboy")
+        for limit, timeout in [(10, 5), (None, 2)]:
+            key = cache.make_key(query_cache.key(index.search_index.id, version, tokens, limit, None, 'tfidf'))
+            self.assertAlmostEqual(cache._expire_info[key] - time.time(), timeout, delta=1)
+
+    @override_settings(SEARCH_CACHE=False)
+    def test_query_cache_disabled(self):
+        """
+        SEARCH_CACHE = False ranks every query
+        :return: None
+        """
+        index = SearchIndexWrapper()
+        index.lookup("cowboy")
+        self.assertEquals(index.lookup("cowboy"), [1, 2])
+        self.assertEquals(query_cache.stats()['hits'], 0)
+
+
+##############################
+#   Test Hydration
+##############################
+class HydrationTestCase(TestCase):
+    """
+    Test the results read from the snippets in hydration.py
+    """
+
+    def setUp(self):
+        self.index_dir = use_test_index_dir(self)
+        Movies.objects.create(id=1, original_title="Space Cowboy", overview="A cowboy lost in space. " * 20,
+                              tagline="", title="Space Cowboy")
+        Movies.objects.create(id=2, original_title="River House", overview="A cowboy moves into a house.",
+                              tagline="", title="River House")
+        loaded_index.clear()
+
+    def test_hydration_rank_order(self):
+        """
+        Results keep the rank order and only the beginning of the overview
+        :return: None
+        """
+        SearchIndexWrapper().calibrate()
+        results = SearchIndexWrapper().search("cowboy")
+        self.assertEquals([x['id'] for x in results], [1, 2])
+        self.assertEquals(results[0]['title'], "Space Cowboy")
+        self.assertEquals(len(results[0]['snippet']), SNIPPET_LENGTH)
+        self.assertEquals([x['id'] for x in hydrate([2, 3, 1])], [2, 1])
+
+    def test_hydration_no_queries(self):
+        """
+        A page of results is read from the index without a query
+        :return: None
+        """
+        SearchIndexWrapper().calibrate()
+        index = loaded_index.get()
+        with self.assertNumQueries(0):
+            results = hydrate([2, 1], index)
+        self.assertEquals(results, hydrate([2, 1]))
+
+    @override_settings(SEARCH_INDEX_SNIPPETS=False)
+    def test_hydration_without_snippets(self):
+        """
+        Segments without snippets are hydrated from the database
+        :return: None
+        """
+        SearchIndexWrapper().calibrate()
+        index = loaded_index.get()
+        with self.assertNumQueries(1):
+            self.assertEquals([x['title'] for x in hydrate([2, 1], index)], ["River House", "Space Cowboy"])
+
+    def test_hydration_update(self):
+        """
+        Delta segments and compactions keep the snippets current
+        :return: None
+        """
+        index = SearchIndexWrapper()
+        index.calibrate()
+        Movies.objects.filter(id=2).update(title="Lake House")
+        record_changes([2])
+        Movies.objects.create(id=3, original_title="Cowboy Bebop", overview="", tagline="", title="Cowboy Bebop")
+        Movies.objects.get(id=1).delete()
+        index.update()
+        self.assertEquals(hydrate([1, 2, 3], loaded_index.get()),
+                          [{'id': 2, 'title': "Lake House", 'snippet': "A cowboy moves into a house."},
+                           {'id': 3, 'title': "Cowboy Bebop", 'snippet': ""}])
+        SegmentManager().compact(full=True)
+        self.assertEquals([x['title'] for x in hydrate([1, 2, 3], loaded_index.get())], ["Lake House", "Cowboy Bebop"])
+
+    def test_hydration_ranking_index(self):
+        """
+        The results are hydrated from the segments that ranked them, even once newer segments are loaded
+        :return: None
+        """
+        wrapper = SearchIndexWrapper()
+        wrapper.calibrate()
+        index, results = wrapper.lookup_with_index("cowboy")
+        self.assertIs(index, loaded_index.get())
+        page_index, page, has_next = wrapper.lookup_page_with_index("cowboy", 1, 1)
+        self.assertIs(page_index, index)
+        self.assertEquals((page, has_next), ([1], True))
+
+        Movies.objects.filter(id=2).update(title="Lake House")
+        record_changes([2])
+        wrapper.update()
+        self.assertIsNot(loaded_index.get(), index)
+        self.assertEquals([x['title'] for x in hydrate(results, index)], ["Space Cowboy", "River House"])
+        self.assertEquals([x['title'] for x in wrapper.search("cowboy")], ["Space Cowboy", "Lake House"])
+
+
+##############################
+#   Test Pagination
+##############################
+class PaginationTestCase(TestCase):
+    """
+    Test the pages of lookup_page and search_page
+    """
+
+    def setUp(self):
+        self.index_dir = use_test_index_dir(self)
+        for i in range(1, 26):
+            # the shorter the overview, the higher the cowboy's term frequency
+            Movies.objects.create(id=i, original_title="Movie {}".format(i), tagline="", title="Movie {}".format(i),
+                                  overview="cowboy " + "horse " * (i % 7))
+        loaded_index.clear()
+        self.index = SearchIndexWrapper()
+        self.index.calibrate()
+
+    def test_pagination_pages(self):
+        """
+        The pages follow each other in rank order
+        :return: None
+        """
+        ranked = self.index.lookup("cowboy")
+        pages = [self.index.lookup_page("cowboy", page, per_page=10) for page in [1, 2, 3, 4]]
+        self.assertEquals([len(ids) for ids, _ in pages], [10, 10, 5, 0])
+        self.assertEquals([has_next for _, has_next in pages], [True, True, False, False])
+        self.assertEquals(sum([ids for ids, _ in pages], []), ranked)
+
+    def test_pagination_cached_ranking(self):
+        """
+        The following pages are sliced from the full ranking, scored once
+        :return: None
+        """
+        self.index.lookup_page("cowboy", 2)
+        self.index.lookup_page("cowboy", 3)
+        stats = query_cache.stats()
+        self.assertEquals((stats['hits'], stats['misses']), (1, 1))
+        results, has_next = self.index.search_page("cowboy", 2)
+        self.assertEquals([x['id'] for x in results], self.index.lookup("cowboy")[10:20])
+        self.assertTrue(has_next)
+
+
+##############################
+#   Test Suggestions
+##############################
+class SuggestTestCase(TestCase):
+    """
+    Test the completions of SearchIndexWrapper.suggest
+    """
+
+    def setUp(self):
+        self.index_dir = use_test_index_dir(self)
+        Movies.objects.create(id=1, original_title="Star Wars", overview="A star is born.", tagline="", title="Star Wars")
+        Movies.objects.create(id=2, original_title="Star Trek", overview="Stars in the night.", tagline="",
+                              title="Star Trek")
+        Movies.objects.create(id=3, original_title="Starship", overview="", tagline="", title="Starship")
+        loaded_index.clear()
+        self.index = SearchIndexWrapper()
+        self.index.calibrate()
+
+    def test_suggest_prefix_range(self):
+        """
+        The terms of a prefix are contiguous in the lexicon, each followed by its field terms
+        :return: None
+        """
+        segment = loaded_index.get().segments[0]
+        first, last = segment.prefix_range("sta")
+        terms = [segment.term(i) for i in range(first, last)]
+        self.assertEquals([term for term in terms if b'\x01' not in term], [b'star', b'stars', b'starship'])
+        self.assertEquals(terms[1:4], [b'star\x010', b'star\x011', b'star\x012'])
+        self.assertEquals(segment.prefix_range("zzz"), (len(segment), len(segment)))
+
+    def test_suggest_completions(self):
+        """
+        Completions are ordered by DF, the results are the best completion's
+        :return: None
+        """
+        suggestions = self.index.suggest("Sta")
+        self.assertEquals(suggestions['completions'], ["star", "stars", "starship"])
+        self.assertEquals([x['id'] for x in suggestions['results']], self.index.lookup("star", limit=5))
+        self.assertEquals(self.index.suggest("star w")['completions'], ["star wars"])
+        self.assertEquals(self.index.suggest("star ")['completions'], [])
+        self.assertEquals(self.index.suggest("  "), {'completions': [], 'results': []})
+
+    def test_suggest_update(self):
+        """
+        Delta segments adjust the DF of the completions
+        :return: None
+        """
+        Movies.objects.get(id=3).delete()
+        Movies.objects.create(id=4, original_title="Stars", overview="", tagline="", title="Stars")
+        self.index.update()
+        self.assertEquals(self.index.suggest("sta")['completions'], ["star", "stars"])
+
+
+##############################
+#   Test Async Search View
+##############################
+class AsyncSearchTestCase(TransactionTestCase):
+    """
+    Test views.search, the searches are scored on the executor's threads with their own connections
+    """
+
+    def setUp(self):
+        self.index_dir = use_test_index_dir(self)
+        Movies.objects.create(id=1, original_title="Space Cowboy", overview="A cowboy lost in space.",
+                              tagline="", title="Space Cowboy")
+        Movies.objects.create(id=2, original_title="River House", overview="A cowboy moves into a house.",
+                              tagline="", title="River House")
+        loaded_index.clear()
+        SearchIndexWrapper().calibrate()
+
+    async def test_async_search(self):
+        """
+        The async view shows the same results as the sync one
+        :return: None
+        """
+        request = AsyncRequestFactory().get('/search/', {'query': 'cowboy'})
+        response = await views.search(request)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.content.count(b'list-group-item">'), 2)
+        self.assertLess(response.content.index(b'Space Cowboy'), response.content.index(b'River House'))
+
+    @override_settings(SEARCH_TIMEOUT=0)
+    async def test_async_search_timeout(self):
+        """
+        A search slower than SEARCH_TIMEOUT is answered with a 503
+        :return: None
+        """
+        response = await views.search(AsyncRequestFactory().get('/search/', {'query': 'cowboy'}))
+        self.assertEquals(response.status_code, 503)
+
+    async def test_async_hydrate(self):
+        """
+        Movies without a stored snippet are read with the async ORM
+        :return: None
+        """
+        results = await ahydrate([2, 1])
+        self.assertEquals([x['title'] for x in results], ["River House", "Space Cowboy"])
+
+    def test_benchmark_without_movies(self):
+        """
+        benchmark_search has no query to send without movies
+        :return: None
+        """
+        Movies.objects.all().delete()
+        with self.assertRaises(CommandError):
+            call_command('benchmark_search', '--requests=1', '--concurrency', '1')
+
+
+##############################
+#   Test Batch Lookup
+##############################
+class BatchLookupTestCase(TestCase):
+    """
+    Test lookup_many, scoring.score_batch and search --batch
+    """
+
+    queries = ["cowboy", "space cowboy", "cowboy cowboy house", "robot", "", "the house of the river", "lost"]
+
+    def setUp(self):
+        self.index_dir = use_test_index_dir(self)
+        Movies.objects.create(id=1, original_title="Space Cowboy", overview="A cowboy lost in space.",
+                              tagline="", title="Space Cowboy")
+        Movies.objects.create(id=2, original_title="River House", overview="A cowboy moves into a house.",
+                              tagline="Lost at home", title="River House")
+        Movies.objects.create(id=7, original_title="House", overview="A house on the river.", tagline="", title="House")
+        loaded_index.clear()
+        self.index = SearchIndexWrapper()
+        self.index.calibrate()
+
+    def test_batch_lookup(self):
+        """
+        Every query gets the results of lookup, in order
+        :return: None
+        """
+        for limit in [None, 1, 2]:
+            expected = [self.index.lookup(query, limit) for query in self.queries]
+            self.assertEquals(list(self.index.lookup_many(self.queries, limit)), expected)
+            self.assertEquals(list(self.index.lookup_many(self.queries, limit, batch_size=2)), expected)
+
+    def test_batch_lookup_shared(self):
+        """
+        Scoring the queries one by one, or through the shared posting lists, gives the same results
+        :return: None
+        """
+        tokens = [self.index.process.tokenize(query) for query in self.queries]
+        index = loaded_index.get()
+        for limit in [None, 1, 2]:
+            self.assertEquals(list(score_batch(index, tokens, limit)),
+                              [x for query in tokens for x in score_batch(index, [query], limit)])
+        shared = SharedPostings(index)
+        movies = np.array([1, 2, 5, 7, 9])
+        for term in self.index.process.tokenize("cowboy house lost"):
+            hit, scores = shared.score_candidates(shared.find(term), movies)
+            expected_hit, expected = index.score_candidates(index.find(term), movies)
+            np.testing.assert_array_equal(hit, expected_hit)
+            np.testing.assert_array_equal(scores, expected)
+
+    def test_batch_search_command(self):
+        """
+        search --batch writes one JSON line per query
+        :return: None
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            queries, output = path.join(directory, 'queries.txt'), path.join(directory, 'results.jsonl')
+            with open(queries, 'w') as f:
+                f.write("\n".join(self.queries) + "\n")
+            call_command('search', batch=queries, output=output, limit=0, stderr=io.StringIO())
+            with open(output) as f:
+                lines = [json.loads(line) for line in f]
+        finally:
+            shutil.rmtree(directory)
+        self.assertEquals([line['query'] for line in lines], self.queries)
+        self.assertEquals([line['results'] for line in lines], [self.index.lookup(query) for query in self.queries])
+
+
+##############################
+#   Test Posting Lists
+##############################
+class PostingsTestCase(TestCase):
+    """
+    Test the binary segment format in postings.py
+    """
+
+    def setUp(self):
+        self.index_dir = use_test_index_dir(self)
+
+    def test_postings_varint(self):
+        """
+        Varint encoding round trips small and large ids
+        :return: None
+        """
+        values = np.array([0, 1, 127, 128, 300, 16384, 2 ** 35], dtype=np.uint64)
+        encoded = encode_varint(values)
+        self.assertEquals(len(encoded), 1 + 1 + 1 + 2 + 2 + 3 + 6)
+        self.assertEquals(decode_varint(encoded).tolist(), values.tolist())
+
+    def test_postings_segment(self):
+        """
+        A written segment returns every posting list sorted by movie id
+        :return: None
+        """
+        postings = {
+            'toy': {862: 0.5, 12: 0.25},
+            'story': {862: 0.125},
+            'réalité': {400000: 1.0},
+        }
+        segment_path = path.join(self.index_dir, 'postings_test.sidx')
+        write_segment(segment_path, postings)
+        segment = Segment.load(segment_path)
+        self.assertEquals(len(segment), 3)
+        ids, scores = segment.get('toy')
+        self.assertEquals(ids.tolist(), [12, 862])
+        self.assertEquals(scores.tolist(), [0.25, 0.5])
+        self.assertEquals(segment.get('réalité')[0].tolist(), [400000])
+        self.assertIsNone(segment.get('missing'))
+
+    def test_postings_segment_mmap(self):
+        """
+        A memory-mapped segment finds every term by binary search
+        :return: None
+        """
+        postings = {"term {}".format(i): {i: float(i)} for i in range(100)}
+        segment_path = path.join(self.index_dir, 'postings_mmap_test.sidx')
+        write_segment(segment_path, postings)
+        segment = Segment.open(segment_path)
+        self.assertEquals(len(segment), 100)
+        for i in range(100):
+            ids, scores = segment.get("term {}".format(i))
+            self.assertEquals(ids.tolist(), [i])
+            self.assertEquals(scores.tolist(), [float(i)])
+        self.assertNotIn("term", segment)
+        self.assertNotIn("term 999", segment)
+
+    def test_postings_skip_blocks(self):
+        """
+        Probing a long posting list for a few movies only matches the movies it holds
+        :return: None
+        """
+        ids = np.arange(0, 3000, 3)
+        segment_path = path.join(self.index_dir, 'postings_skip_test.sidx')
+        write_postings(segment_path, ['long', 'short'], [0, len(ids), len(ids) + 1],
+                       np.append(ids, 5), np.append(ids / 10.0, 1.0))
+        segment = Segment.open(segment_path)
+        self.assertEquals(segment.max_score(0), np.float32(299.7))
+        self.assertEquals(segment.postings(0)[0].tolist(), ids.tolist())
+        hit, scores = segment.score_candidates(0, np.array([4, 9, 1500, 2997, 5000]))
+        self.assertEquals(hit.tolist(), [False, True, True, True, False])
+        np.testing.assert_allclose(scores, [0.9, 150.0, 299.7], rtol=1e-6)
+
+
+##############################
+#   Test Scoring
+##############################
+def decimal_tfidf(index):
+    """
+    Reference tf-idf built with the original Decimal arithmetic, rounding every step to 6 digits
+    :param index: SearchIndexWrapper
+    :return: dict(key=term:value=dict(key=movie id:value=Decimal))
+    """
+    dec_con = Context(prec=6, rounding=ROUND_05UP)
+    alpha_dict = index.search_index.get_alpha()
+    term_freq = dict()
+    for movie in iter_movies():
+        term_freq[movie.id] = dict()
+        for alpha, term_list in index._movie_terms(movie).items():
+            counts = dict()
+            for term in (x.lower() for x in term_list if len(x) > 1):
+                counts[term] = counts.get(term, 0) + 1
+            term_freq[movie.id][alpha] = {term: dec_con.create_decimal(_d(count) / _d(len(term_list)))
+                                          for term, count in counts.items()}
+    df_dict = dict()
+    for movie in term_freq:
+        for term in set(y for x in term_freq[movie].values() for y in x):
+            df_dict[term] = df_dict.get(term, 0) + 1
+    total_movies = Movies.objects.count()
+    idf = {term: dec_con.create_decimal(log(_d(total_movies) / _d(df))) for term, df in df_dict.items()}
+    tfidf = {term: dict() for term in idf}
+    for movie in term_freq:
+        for alpha in term_freq[movie]:
+            for term, tf in term_freq[movie][alpha].items():
+                score = tf * idf[term] * _d(alpha_dict.get(alpha, 0)) + tfidf[term].get(movie, _d(0))
+                tfidf[term][movie] = dec_con.create_decimal(score)
+    return tfidf
+
+
+class ScoringTestCase(TestCase):
+    """
+    Test the vectorized scoring in scoring.py against the original Decimal arithmetic
+    """
+
+    def setUp(self):
+        self.index_dir = use_test_index_dir(self)
+        titles = ["Toy Story", "Toy Soldiers", "Space Story", "The Dark Night", "Night of the Living Toys",
+                  "Story of a Cowboy", "Cowboy Space Night", "Dark Space"]
+        for i, title in enumerate(titles, start=1):
+            movie = Movies.objects.create(id=i * 7, original_title=title, title=title,
+                                          overview="{} is a story about toys in space.".format(title),
+                                          tagline="Night falls" if i % 2 else "")
+            movie.keywords_set.add(Keywords.objects.create(name=title.split(" ")[-1].lower()))
+        Casts.objects.create(character="Woody", name="Tom Hanks").movies.add(7)
+        loaded_index.clear()
+        self.index = SearchIndexWrapper()
+        self.index.calibrate()
+
+    def test_scoring_matches_decimal(self):
+        """
+        Scores match the Decimal path to within rounding and rankings are the same
+        :return: None
+        """
+        reference = decimal_tfidf(self.index)
+        segment = loaded_index.get()
+        for term, movies in reference.items():
+            ids, scores = segment.get(term)
+            self.assertEquals(ids.tolist(), sorted(movies))
+            np.testing.assert_allclose(scores, [float(movies[x]) for x in sorted(movies)], rtol=1e-4)
+
+        for query in ["toy story", "night", "dark space cowboy", "woody", "toys story space"]:
+            ranked = dict()
+            for term in self.index.process.tokenize(query):
+                for movie, score in reference.get(term, {}).items():
+                    ranked[movie] = ranked.get(movie, _d(0)) + score
+            expected = sorted(ranked, key=lambda x: (-ranked[x], x))
+            self.assertEquals(self.index.lookup(query), expected)
+
+    def test_scoring_runs(self):
+        """
+        Spilling sorted runs and merging them in batches gives the same postings as a single pass in memory
+        :return: None
+        """
+        alpha = alpha_vector(self.index.search_index.get_alpha())
+        term_freq = TermFrequencies()
+        for movie in iter_movies():
+            for field, term_list in self.index._movie_terms(movie).items():
+                term_freq.add(movie.id, int(field), term_list)
+        terms, ptr, doc_ids, weights = term_postings(term_freq, alpha)
+        shards, total_movies = shard_ranges(3)
+        self.assertEquals(len(shards), 3)
+
+        with tempfile.TemporaryDirectory() as scratch:
+            for runs, movies in [spill_runs(self.index.process, path.join(scratch, 'chunk'), chunk_size=3),
+                                 spill_shards(self.index.process, shards, path.join(scratch, 'shard'))]:
+                self.assertEquals(movies, total_movies)
+                segment_path = path.join(scratch, 'merged.sidx')
+                with SegmentWriter(segment_path, movies) as writer:
+                    merge_runs(runs, alpha, writer, batch_size=4)
+                segment = Segment.load(segment_path)
+                self.assertEquals([segment.term(i).decode("utf-8") for i in range(len(segment))], terms)
+                for i in range(len(terms)):
+                    ids, term_weights = segment.postings(i)
+                    self.assertEquals(ids.tolist(), doc_ids[ptr[i]:ptr[i + 1]].tolist())
+                    np.testing.assert_array_equal(term_weights, weights[ptr[i]:ptr[i + 1]])
+                    self.assertEquals(segment.doc_freq(i), ptr[i + 1] - ptr[i])
+
+    def test_scoring_parallel_calibration(self):
+        """
+        Calibrating on a pool of processes writes the same segment as calibrating in this process
+        :return: None
+        """
+        queries = ["toy story", "night", "dark space cowboy", "woody", "toys story space"]
+        self.index.calibrate(workers=1)
+        with open(self.index.search_index.get_segment_path(), 'rb') as f:
+            serial = f.read()
+        ranked = [self.index.lookup(query) for query in queries]
+
+        self.index.calibrate(workers=2)
+        with open(self.index.search_index.get_segment_path(), 'rb') as f:
+            self.assertEquals(f.read(), serial)
+        self.assertEquals([self.index.lookup(query) for query in queries], ranked)
+
+    def test_scoring_calibrate_command(self):
+        """
+        The calibrate command reports its errors
+        :return: None
+        """
+        with self.assertRaises(CommandError):
+            call_command('calibrate', '--workers=0')
+        blocked = path.join(self.index_dir, 'blocked')
+        open(blocked, 'w').close()
+        with override_settings(SEARCH_INDEX_DIR=blocked):
+            with self.assertRaises(CommandError):
+                call_command('calibrate')
+
+    def test_scoring_top_k(self):
+        """
+        MaxScore top k returns the same movies as scoring every posting
+        :return: None
+        """
+        rng = np.random.RandomState(7)
+        terms = ['common', 'frequent', 'rare', 'usual']
+        postings = [np.sort(rng.choice(20000, size, replace=False)) for size in [9000, 6000, 40, 3000]]
+        scores = [rng.pareto(3, len(x)) * weight for x, weight in zip(postings, [0.01, 0.02, 1.0, 0.01])]
+        segment_path = path.join(self.index_dir, 'scoring_top_k_test.sidx')
+        write_postings(segment_path, terms, np.cumsum([0] + [len(x) for x in postings]),
+                       np.concatenate(postings), np.concatenate(scores))
+        segment = Segment.open(segment_path)
+        for query in [[0], [0, 1], [2, 0, 1, 3], [3, 3, 1], [2]]:
+            movies, movie_scores = score_postings([segment.postings(i) for i in query])
+            for limit in [1, 5, 10, 100]:
+                self.assertEquals(top_k(segment, query, limit), rank(movies, movie_scores)[:limit])
+
+
+##############################
+#   Test Field Alpha
+##############################
+class FieldAlphaTestCase(TestCase):
+    """
+    Test the alpha weights applied at query time from the field terms
+    """
+
+    def setUp(self):
+        self.index_dir = use_test_index_dir(self)
+        titles = ["Toy Story", "Space Toys", "Night Story", "Dark Space", "Cowboy Night"]
+        overviews = ["A space cowboy.", "A story of toys.", "Toys at night.", "A toy story in space.", "Dark night."]
+        for i, (title, overview) in enumerate(zip(titles, overviews), start=1):
+            movie = Movies.objects.create(id=i, original_title=title, title=title, overview=overview, tagline="")
+            movie.keywords_set.add(Keywords.objects.create(name=title.split(" ")[0].lower()))
+        loaded_index.clear()
+        self.index = SearchIndexWrapper()
+        self.index.calibrate()
+        self.queries = ["toy story", "space", "night", "dark space cowboy", "toys"]
+
+    def assertMatchesDecimal(self):
+        """
+        Scores match the Decimal path with the SearchIndex's current alpha
+        :return: None
+        """
+        reference = decimal_tfidf(self.index)
+        index = loaded_index.get()
+        for term, movies in reference.items():
+            ids, scores = index.get(term)
+            self.assertEquals(ids.tolist(), sorted(movies))
+            np.testing.assert_allclose(scores, [float(movies[x]) for x in sorted(movies)], rtol=1e-4)
+
+    def test_field_alpha_set_alpha(self):
+        """
+        New weights apply to the next lookups without recalibrating
+        :return: None
+        """
+        default = [self.index.lookup(query) for query in self.queries]
+        self.index.search_index.set_alpha(json.dumps({'0': 0.0, '1': 0.0, '2': 1.0, '9': 0.1}))
+        self.assertMatchesDecimal()
+        self.assertEquals(self.index.lookup("toy story"), [4, 2, 1, 3])
+        self.assertNotEqual([self.index.lookup(query) for query in self.queries], default)
+
+        # calibrating keeps the weights and sums the postings with them
+        self.index.calibrate()
+        self.assertEquals(self.index.search_index.get_alpha(), {'0': 0.0, '1': 0.0, '2': 1.0, '9': 0.1})
+        self.assertMatchesDecimal()
+
+    def test_field_alpha_per_query(self):
+        """
+        Weights of a single query rank like the same weights set on the index, the other queries are unchanged
+        :return: None
+        """
+        alpha = {'0': 0.0, '1': 0.0, '2': 1.0, '9': 0.1}
+        default = [self.index.lookup(query) for query in self.queries]
+        weighted = [self.index.lookup(query, alpha=alpha) for query in self.queries]
+        self.assertEquals([self.index.lookup(query) for query in self.queries], default)
+        self.assertEquals([self.index.lookup(query, 2, alpha=alpha) for query in self.queries],
+                          [x[:2] for x in weighted])
+        self.assertEquals(list(self.index.lookup_many(self.queries, alpha=alpha)), weighted)
+        # the index's own weights read the summed postings
+        self.assertEquals([self.index.lookup(query, alpha=self.index.search_index.get_alpha())
+                           for query in self.queries], default)
+
+        self.index.search_index.set_alpha(json.dumps(alpha))
+        self.assertEquals([self.index.lookup(query) for query in self.queries], weighted)
+
+    def test_field_alpha_validation(self):
+        """
+        Unknown fields and negative weights are rejected, by the lookups and by search --alpha
+        :return: None
+        """
+        for alpha in [{'10': 1.0}, {'-1': 1.0}, {'title': 1.0}, {'0': -0.5}, {'0': float('nan')}, [0.5]]:
+            with self.assertRaises(ValueError):
+                alpha_vector(alpha)
+            with self.assertRaises(ValueError):
+                self.index.lookup("toy story", alpha=alpha)
+        with self.assertRaises(ValueError):
+            self.index.search_index.set_alpha(json.dumps({'0': -1.0}))
+        self.assertEquals(self.index.search_index.get_alpha(), SearchIndex.objects.get(id=1).get_alpha())
+        for alpha in ['{"10": 1.0}', '{"0": -0.5}']:
+            with self.assertRaises(CommandError):
+                call_command('search', '--batch=-', '--alpha', alpha)
+        np.testing.assert_array_equal(alpha_vector({'9': 0, '0': '0.5'}), [0.5] + [0.0] * 9)
+
+    def test_field_alpha_segments(self):
+        """
+        Deltas summed with other weights than the base, and their merge, still score with the current weights
+        :return: None
+        """
+        self.index.search_index.set_alpha(json.dumps({'0': 1.0, '2': 0.5}))
+        Movies.objects.filter(id=2).update(title="Toy Night")
+        record_changes([2])
+        self.index.update()
+        index = loaded_index.get()
+        np.testing.assert_array_equal(index.segments[1].alpha, alpha_vector({'0': 1.0, '2': 0.5}))
+        self.assertFalse(np.array_equal(index.segments[0].alpha, index.segments[1].alpha))
+        self.assertMatchesDecimal()
+
+        SegmentManager().compact(full=True)
+        index = loaded_index.get()
+        self.assertEquals(len(index.segments), 1)
+        self.assertTrue(np.isnan(index.segments[0].alpha).all())
+        self.assertMatchesDecimal()
+
+
+##############################
+#   Test BM25F
+##############################
+def bm25f_reference(index, k1=1.2, b=0.75):
+    """
+    Reference BM25F scores counted from the tokens of every movie
+    :param index: SearchIndexWrapper
+    :param k1: float
+    :param b: float
+    :return: dict(key=term:value=dict(key=movie id:value=float))
+    """
+    alpha = index.search_index.get_alpha()
+    weights = {field: weight / max(alpha.values()) for field, weight in alpha.items()}
+    counts, lengths, totals = dict(), dict(), dict()
+    for movie in iter_movies():
+        for field, term_list in index._movie_terms(movie).items():
+            if not term_list:
+                continue
+            lengths[movie.id, field] = len(term_list)
+            totals[field] = totals.get(field, 0) + len(term_list)
+            for term in (x.lower() for x in term_list if len(x) > 1):
+                fields = counts.setdefault(term, dict()).setdefault(movie.id, dict())
+                fields[field] = fields.get(field, 0) + 1
+    total_movies = Movies.objects.count()
+    scores = dict()
+    for term, movies in counts.items():
+        idf = log(1 + (total_movies - len(movies) + 0.5) / (len(movies) + 0.5))
+        scores[term] = dict()
+        for movie, fields in movies.items():
+            freq = sum(weights.get(field, 0) * count / (1 - b + b * lengths[movie, field] / (totals[field] / total_movies))
+                       for field, count in fields.items())
+            if freq > 0:
+                scores[term][movie] = idf * freq / (k1 + freq)
+    return scores
+
+
+class BM25FTestCase(TestCase):
+    """
+    Test the BM25F scorer against scores counted from the tokens
+    """
+
+    def setUp(self):
+        self.index_dir = use_test_index_dir(self)
+        titles = ["Toy Story", "Toy Story Toy Story", "Space Story", "The Dark Night", "Night of the Living Toys",
+                  "Story of a Cowboy", "Cowboy Space Night", "Dark Space"]
+        for i, title in enumerate(titles, start=1):
+            movie = Movies.objects.create(id=i * 3, original_title=title, title=title,
+                                          overview="{} is a long story about toys and a night in space.".format(title)
+                                          if i % 3 else "Toys.", tagline="")
+            movie.keywords_set.add(Keywords.objects.create(name=title.split(" ")[-1].lower()))
+        loaded_index.clear()
+        self.index = SearchIndexWrapper()
+        self.index.calibrate()
+        self.queries = ["toy story", "night", "dark space cowboy", "toys", "story space"]
+
+    def assertMatchesReference(self, k1=1.2, b=0.75):
+        """
+        Scores and rankings of the bm25f scorer match the reference
+        :param k1: float
+        :param b: float
+        :return: None
+        """
+        reference = bm25f_reference(self.index, k1, b)
+        scorer = get_scorer(loaded_index.get(), 'bm25f')
+        for term, movies in reference.items():
+            ids, scores = scorer.get(term)
+            self.assertEquals(ids.tolist(), sorted(movies))
+            np.testing.assert_allclose(scores, [movies[x] for x in sorted(movies)], rtol=1e-5)
+        for query in self.queries:
+            ranked = dict()
+            for term in self.index.process.tokenize(query):
+                for movie, score in reference.get(term, {}).items():
+                    ranked[movie] = ranked.get(movie, 0) + score
+            expected = sorted(ranked, key=lambda x: (-ranked[x], x))
+            self.assertEquals(self.index.lookup(query, scorer='bm25f'), expected)
+            self.assertEquals(self.index.lookup(query, 3, scorer='bm25f'), expected[:3])
+
+    def test_bm25f_scores(self):
+        """
+        Field lengths are normalized by their average and the term frequencies saturate
+        :return: None
+        """
+        self.assertMatchesReference()
+        # the title repeating "toy story" is only partly normalized by its length, b < 1
+        self.assertEquals(self.index.lookup("toy story", 2, scorer='bm25f'), [6, 3])
+        self.assertEquals(self.index.lookup("toy story", 2, scorer='bm25f'),
+                          self.index.lookup_page("toy story", per_page=2, scorer='bm25f')[0])
+        self.assertNotEqual([self.index.lookup(query) for query in self.queries],
+                            [self.index.lookup(query, scorer='bm25f') for query in self.queries])
+        with self.assertRaises(ValueError):
+            self.index.lookup("toy", scorer='bm42')
+
+    @override_settings(SEARCH_SCORER='bm25f', SEARCH_BM25_K1=2.0, SEARCH_BM25_B=0.5)
+    def test_bm25f_settings(self):
+        """
+        Queries that do not name a scorer use settings.SEARCH_SCORER, with the settings' parameters
+        :return: None
+        """
+        loaded_index.clear()
+        self.assertMatchesReference(k1=2.0, b=0.5)
+        ranked = [self.index.lookup(query) for query in self.queries]
+        self.assertEquals(ranked, [self.index.lookup(query, scorer='bm25f') for query in self.queries])
+        self.assertEquals(list(self.index.lookup_many(self.queries)), ranked)
+        self.assertNotEqual(ranked, [self.index.lookup(query, scorer='tfidf') for query in self.queries])
+
+    @override_settings(SEARCH_BM25_B=1.0)
+    def test_bm25f_full_normalization(self):
+        """
+        With b = 1 the fields a movie leaves empty keep finite bounds
+        :return: None
+        """
+        Movies.objects.create(id=30, original_title="Toy", overview="", tagline="Toys at night.", title="Toy")
+        self.index.calibrate()
+        scorer = get_scorer(loaded_index.get(), 'bm25f')
+        self.assertTrue(np.isfinite(scorer.norms).all())
+        self.assertTrue(np.isfinite(scorer.max_norms).all())
+        self.assertMatchesReference(b=1.0)
+
+    def test_bm25f_segments(self):
+        """
+        Delta segments and their merge keep the field lengths of the current movies
+        :return: None
+        """
+        Movies.objects.filter(id=6).update(title="Toy Story Toy Story Toy Story")
+        record_changes([6])
+        Movies.objects.get(id=9).delete()
+        Movies.objects.create(id=30, original_title="Toy", overview="", tagline="", title="Toy")
+        self.index.update()
+        self.assertEquals(len(loaded_index.get().segments), 2)
+        self.assertMatchesReference()
+
+        SegmentManager().compact(full=True)
+        self.assertEquals(len(loaded_index.get().segments), 1)
+        self.assertMatchesReference()
+
+
+##############################
+#   Test Incremental Updates
+##############################
+class IncrementalTestCase(TestCase):
+    """
+    Test the changelog and the delta segment of SearchIndexWrapper.update
+    """
+
+    def setUp(self):
+        self.index_dir = use_test_index_dir(self)
+        for i, title in enumerate(["Toy Story", "Space Cowboy", "Dark Night", "River House", "Night Train"], start=1):
+            movie = Movies.objects.create(id=i, original_title=title, title=title, tagline="",
+                                          overview="{} is a story about a long night.".format(title))
+            movie.keywords_set.add(Keywords.objects.create(name=title.split(" ")[0].lower()))
+        loaded_index.clear()
+        self.index = SearchIndexWrapper()
+        self.index.calibrate()
+
+    def assertMatchesCalibration(self, queries):
+        """
+        The base and delta segments score like a full calibration of the same database
+        :param queries: list of str
+        :return: None
+        """
+        updated = loaded_index.get()
+        results = [self.index.lookup(query) for query in queries]
+        self.index.calibrate()
+        calibrated = loaded_index.get()
+        self.assertEquals(len(calibrated.segments), 1)
+        self.assertEquals(results, [self.index.lookup(query) for query in queries])
+        for i in range(len(calibrated.segments[0])):
+            term = calibrated.segments[0].term(i).decode('utf-8')
+            ids, scores = updated.get(term)
+            expected_ids, expected_scores = calibrated.get(term)
+            self.assertEquals(ids.tolist(), expected_ids.tolist())
+            np.testing.assert_allclose(scores, expected_scores, rtol=1e-6)
+
+    def test_incremental_changelog(self):
+        """
+        ORM edits record the movies they touch, calibration empties the changelog
+        :return: None
+        """
+        self.assertEquals(IndexChangelog.objects.count(), 0)
+        Movies.objects.create(id=6, original_title="Robot", overview="", tagline="", title="Robot")
+        Keywords.objects.filter(name='dark').first().movies.add(1)
+        Casts.objects.create(character="Woody", name="Tom Hanks").movies.add(1, 2)
+        Movies.objects.get(id=4).delete()
+        self.assertEquals(set(IndexChangelog.objects.values_list('movie_id', flat=True)), {1, 2, 4, 6})
+        self.index.calibrate()
+        self.assertEquals(IndexChangelog.objects.count(), 0)
+
+    def test_incremental_update(self):
+        """
+        New, edited and deleted movies are searchable after an update without recalibrating
+        :return: None
+        """
+        Movies.objects.create(id=6, original_title="Robot Night", overview="A robot story.", tagline="",
+                              title="Robot Night")
+        Movies.objects.filter(id=2).update(title="Space Robot")
+        record_changes([2])
+        Movies.objects.get(id=4).delete()
+        self.index.update()
+        self.assertEquals(len(loaded_index.get().segments), 2)
+        self.assertEquals(IndexChangelog.objects.count(), 0)
+        self.assertEquals(self.index.lookup("robot"), [6, 2])
+        self.assertEquals(self.index.lookup("house"), [])
+
+        # a second update stacks a delta masking the first one's movie
+        Keywords.objects.get(name='toy').movies.add(6)
+        self.index.update()
+        self.assertEquals(len(self.index.search_index.get_segments()), 3)
+        self.assertMatchesCalibration(["robot", "night", "toy story", "space cowboy", "house", "long night story"])
+
+    def test_incremental_update_older_movie(self):
+        """
+        An update touching only movies below the highest id an earlier delta added
+        :return: None
+        """
+        Movies.objects.create(id=6, original_title="Robot Night", overview="A robot story.", tagline="",
+                              title="Robot Night")
+        self.index.update()
+        Movies.objects.filter(id=1).update(title="Toy Robot")
+        record_changes([1])
+        self.index.update()
+        self.assertEquals(len(self.index.search_index.get_segments()), 3)
+        self.assertEquals(sorted(self.index.lookup("robot")), [1, 6])
+        self.assertMatchesCalibration(["robot", "night", "toy story", "space cowboy", "long night story"])
+
+    def test_incremental_compaction(self):
+        """
+        Merging segments keeps the same scores and removes the merged files
+        :return: None
+        """
+        for i in range(6, 12):
+            Movies.objects.create(id=i, original_title="Robot {}".format(i), title="Robot {}".format(i), tagline="",
+                                  overview="Night number {}.".format(i))
+            Movies.objects.filter(id=i - 4).update(tagline="Another night")
+            record_changes([i - 4])
+            self.index.update()
+        manager = SegmentManager()
+        segments = manager.get_segments()
+        self.assertEquals(len(segments), 7)
+        expected = {query: self.index.lookup(query) for query in ["robot", "night", "another night", "toy"]}
+
+        self.assertEquals(manager.compact(), 1)
+        self.assertEquals(len(manager.get_segments()), 1)
+        self.assertFalse(any(path.exists(path.join(self.index_dir, x)) for x in segments))
+        self.assertEquals({query: self.index.lookup(query) for query in expected}, expected)
+        Movies.objects.get(id=7).delete()
+        self.index.update()
+        self.assertMatchesCalibration(list(expected))
+
+    def test_incremental_merge_policy(self):
+        """
+        Only runs of consecutive segments in the same size tier are merged
+        :return: None
+        """
+        small, large = TIER_FLOOR // 2, TIER_FLOOR * 100
+        self.assertIsNone(plan_merge([large, small, small, small]))
+        self.assertEquals(plan_merge([large, small, small, small, small]), (1, 5))
+        self.assertEquals(plan_merge([small] * 4), (0, 4))
+        self.assertEquals(plan_merge([large * 4, large, large, large, large, small]), (1, 5))
+        self.assertEquals(plan_merge([large, small, large] * 5), (1, 5))
+
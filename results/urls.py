@@ -4,5 +4,7 @@ from .views import *
 
 app_name = "results"
 urlpatterns = [
-    path('', index, name="index")
+    path('', index, name="index"),
+    path('search/', search, name="search"),
+    path('suggest/', suggest, name="suggest"),
 ]
@@ -1,7 +1,52 @@
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import JsonResponse
 from django.shortcuts import render
+from concurrent.futures import ThreadPoolExecutor
 from .forms import SearchQuery
+from .hydration import ahydrate
 from results.search_index import SearchIndexWrapper
-from .models import Movies
+import asyncio
+import threading
+
+
+PER_PAGE = 10
+SUGGESTIONS = 5
+# threads scoring the searches of the async view, and seconds a search may take
+DEFAULT_WORKERS = 4
+DEFAULT_TIMEOUT = 5.0
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _page(request):
+    """
+    Page requested with ?page=
+    :param request: HttpRequest
+    :return: int, from 1
+    """
+    try:
+        return max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        return 1
+
+
+def _context(search_query, search_results=None, page=1, has_next=False, error=None):
+    """
+    Context of the search page
+    :param search_query: SearchQuery
+    :param search_results: list of dict(id, title, snippet), None before searching
+    :param page: int
+    :param has_next: bool
+    :param error: str, shown above the results
+    :return: dict
+    """
+    return {'search_query': search_query,
+            'search_results': search_results,
+            'page': page,
+            'previous_page': page - 1 if page > 1 else None,
+            'next_page': page + 1 if has_next else None,
+            'error': error,}
 
 
 def index(request):
@@ -12,17 +57,78 @@ def index(request):
 
     addition features
         display results while typing search
-        pagination
+        pagination: ?query=...&page=2 serves the following pages
     """
     search_index = SearchIndexWrapper()
-    search_results = None
-    if request.method == "POST":
-        search_query = SearchQuery(request.POST)
-        search_results = search_index.lookup(search_query['query'].value(), limit=10)
-        search_results = Movies.objects.filter(id__in=search_results)
+    if request.method == "POST" or 'query' in request.GET:
+        search_query = SearchQuery(request.POST if request.method == "POST" else request.GET)
+        page = _page(request)
+        # titles and snippets in rank order, read from the index
+        search_results, has_next = search_index.search_page(search_query['query'].value(), page, PER_PAGE)
+        context = _context(search_query, search_results, page, has_next)
     else:
-        search_query = SearchQuery()
+        context = _context(SearchQuery())
     template = "results/index.html"
-    context = {'search_query': search_query,
-               'search_results': search_results,}
     return render(request, template, context)
+
+
+def executor():
+    """
+    Bounded pool of threads scoring the searches of the async view, settings.SEARCH_WORKERS threads
+    :return: ThreadPoolExecutor
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'SEARCH_WORKERS', DEFAULT_WORKERS),
+                                           thread_name_prefix='search')
+        return _executor
+
+
+def _lookup_page(query, page):
+    """
+    Rank a page of results, runs on the executor's threads
+    :param query: str
+    :param page: int
+    :return: (list of Movie ids, bool True if there is a next page, IndexView the ids were ranked with)
+    """
+    try:
+        index, movie_ids, has_next = SearchIndexWrapper().lookup_page_with_index(query, page, PER_PAGE)
+        return movie_ids, has_next, index
+    finally:
+        # the threads outlive the request, close their connections like the end of a request does
+        close_old_connections()
+
+
+async def search(request):
+    """
+    Async version of index, for ASGI servers
+        the scoring runs on a bounded pool of threads, the event loop keeps serving other requests
+        a search taking more than settings.SEARCH_TIMEOUT seconds is answered with a 503
+    """
+    template = "results/index.html"
+    if request.method != "POST" and 'query' not in request.GET:
+        return render(request, template, _context(SearchQuery()))
+    search_query = SearchQuery(request.POST if request.method == "POST" else request.GET)
+    page = _page(request)
+    loop = asyncio.get_running_loop()
+    try:
+        movie_ids, has_next, segment = await asyncio.wait_for(
+            loop.run_in_executor(executor(), _lookup_page, search_query['query'].value(), page),
+            getattr(settings, 'SEARCH_TIMEOUT', DEFAULT_TIMEOUT))
+    except asyncio.TimeoutError:
+        # the thread finishes the search on its own, its result is dropped
+        context = _context(search_query, page=page, error="The search took too long, try a more specific query.")
+        return render(request, template, context, status=503)
+    search_results = await ahydrate(movie_ids, segment)
+    return render(request, template, _context(search_query, search_results, page, has_next))
+
+
+def suggest(request):
+    """
+    Search as you type, called on every keystroke
+        ?query=star wa
+        return the completions of the last word and the top results of the best one, as JSON
+    """
+    suggestions = SearchIndexWrapper().suggest(request.GET.get('query', ''), limit=SUGGESTIONS)
+    return JsonResponse(suggestions)